@@ -21,6 +21,8 @@ class UserAdmin(DjangoUserAdmin):
         "is_staff",
         "is_superuser",
     )
+    # 部門名の表示で1行ごとにSELECTが走らないようJOINで取得する
+    list_select_related = ("department",)
     list_filter = ("role","department","is_active","is_staff","is_superuser")
     search_fields = ("username","email")
 
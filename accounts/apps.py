@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from .models import Department
+        from .services.department_cache import invalidate_department_cache
+
+        # 部門の追加/変更/削除を即座にキャッシュへ反映する
+        post_save.connect(invalidate_department_cache, sender=Department, dispatch_uid="department_cache_save")
+        post_delete.connect(invalidate_department_cache, sender=Department, dispatch_uid="department_cache_delete")
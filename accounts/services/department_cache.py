@@ -0,0 +1,38 @@
+from django.core.cache import cache
+
+from accounts.models import Department
+
+# 部門コード一覧はチャット毎ターンで参照されるが、変更は管理操作時のみなのでキャッシュする
+DEPARTMENT_CODES_CACHE_KEY = "accounts:department_codes:v1"
+DEPARTMENT_CODES_TTL = 60  # 秒
+# コード → Department の対応表（回答部門の解決で毎POST参照される）
+DEPARTMENTS_BY_CODE_CACHE_KEY = "accounts:departments_by_code:v1"
+
+
+def get_department_codes() -> list[str]:
+    """
+    部門コード一覧を返す。
+    キャッシュにあればそれを使い、なければDBから取得してキャッシュする。
+    """
+    codes = cache.get(DEPARTMENT_CODES_CACHE_KEY)
+    if codes is None:
+        codes = list(Department.objects.values_list("code", flat=True))
+        cache.set(DEPARTMENT_CODES_CACHE_KEY, codes, DEPARTMENT_CODES_TTL)
+    return codes
+
+
+def get_department_by_code(code: str) -> Department | None:
+    """
+    部門コードに対応する Department を返す（存在しなければ None）。
+    部門は件数が少ないため、対応表ごとキャッシュして1件ずつのDB問い合わせを避ける。
+    """
+    departments = cache.get(DEPARTMENTS_BY_CODE_CACHE_KEY)
+    if departments is None:
+        departments = {d.code: d for d in Department.objects.all()}
+        cache.set(DEPARTMENTS_BY_CODE_CACHE_KEY, departments, DEPARTMENT_CODES_TTL)
+    return departments.get(code)
+
+
+def invalidate_department_cache(**kwargs) -> None:
+    """Department の保存/削除時に呼ばれ、キャッシュを破棄する（signal receiver）"""
+    cache.delete_many([DEPARTMENT_CODES_CACHE_KEY, DEPARTMENTS_BY_CODE_CACHE_KEY])
@@ -1,3 +1,34 @@
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from accounts.models import Department
+from accounts.services.department_cache import get_department_by_code, get_department_codes
+
+
+class DepartmentCodeCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_codes_are_cached_between_calls(self):
+        """2回目以降はDBに問い合わせない"""
+        Department.objects.create(name="経理", code="finance")
+        self.assertEqual(get_department_codes(), ["finance"])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_department_codes(), ["finance"])
+
+    def test_cache_invalidated_on_department_save(self):
+        """部門追加でキャッシュが破棄され、新しいコードが見える"""
+        Department.objects.create(name="経理", code="finance")
+        get_department_codes()
+        Department.objects.create(name="人事総務", code="hr")
+        self.assertEqual(sorted(get_department_codes()), ["finance", "hr"])
+
+    def test_department_by_code_is_cached_and_invalidated(self):
+        """コード→部門の解決はキャッシュされ、部門名の変更で更新される"""
+        dept = Department.objects.create(name="経理", code="finance")
+        self.assertEqual(get_department_by_code("finance"), dept)
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_department_by_code("unknown"))
+        dept.name = "財務経理"
+        dept.save()
+        self.assertEqual(get_department_by_code("finance").name, "財務経理")
@@ -13,6 +13,7 @@ class ChatMessageInline(admin.TabularInline):
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "title", "created_at", "updated_at")
+    list_select_related = ("user",)
     list_filter = ("user",)
     inlines = [ChatMessageInline]
 
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from documents.signals import documents_changed
+        from .services import clear_semantic_cache, refresh_routing_prototypes
+
+        # 検索対象の文書が変わったら、古い検索結果から作った回答を返さないようにする
+        documents_changed.connect(clear_semantic_cache, dispatch_uid="semantic_cache_documents_changed")
+        # 部門ごとのチャンク構成も変わるので、ローカル分類器のプロトタイプも作り直す
+        documents_changed.connect(refresh_routing_prototypes, dispatch_uid="routing_prototypes_documents_changed")
@@ -71,6 +71,11 @@ class ChatMessage(models.Model):
         verbose_name = "チャットメッセージ"
         verbose_name_plural = "チャットメッセージ"
         ordering = ["created_at"]
+        indexes = [
+            # 直近メッセージ(session絞り込み → created_at降順 LIMIT)をソートなしで返す
+            # 履歴取得の role 絞り込みはこの順に読みながらのフィルタで足りる
+            models.Index(fields=["session", "-created_at"], name="chat_msg_session_recent_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"[{self.role}] {self.content[:20]}"
\ No newline at end of file
@@ -22,15 +22,11 @@ class RoutingResult(BaseModel):
             raise ValueError("needs_clarification=true の場合は、clarifying_question は必須です。")
         
         # secondaryの重複除去  + primary除外(安全側)
-        sec = []
-        for d in self.secondary_departments:
-            if not d:
-                continue
-            if d == self.primary_department:
-                continue
-            if d not in sec:
-                sec.append(d)
-        self.secondary_departments = sec
+        # dict.fromkeys で順序を保ったまま O(k) で重複除去する
+        self.secondary_departments = list(dict.fromkeys(
+            d for d in self.secondary_departments
+            if d and d != self.primary_department
+        ))
 
         # primary が空は不可(unknownに寄せたい場合はunknownを返却させる)
         if not self.primary_department.strip():
@@ -1,18 +1,74 @@
+import threading
+
 from django.conf import settings
-from documents.services.embedding_service import EmbeddingService
-from documents.search_backends.faiss_backend import FaissSearchBackend
-from chat.services.rag_chat import RAGChatService
-from chat.services.llm_client import OpenAILlmClient
-
-embedding_service = EmbeddingService()
-search_backend = FaissSearchBackend(
-    index_path=settings.FAISS_INDEX_PATH,
-    embedding_service=embedding_service,
-)
-llm_client = OpenAILlmClient(api_key=settings.OPENAI_API_KEY)
-
-rag_service = RAGChatService(
-    search_backend=search_backend,
-    embedding_service=embedding_service,
-    llm_client=llm_client,
-)
\ No newline at end of file
+
+# 各サービスは初回のチャット処理時に生成する（遅延初期化）
+# import しただけで FAISS index の読み込みや OpenAI クライアント生成が走らないようにするため、
+# 重い依存もここではimportしない
+_rag_service = None
+_rag_service_lock = threading.Lock()
+
+
+def get_rag_service():
+    """RAGChatService のシングルトンを返す。最初の呼び出しで組み立てる。"""
+    global _rag_service
+    if _rag_service is None:
+        with _rag_service_lock:
+            if _rag_service is None:
+                from documents.services.embedding_service import EmbeddingService
+                from chat.services.rag_chat import RAGChatService
+                from chat.services.llm_client import OpenAILlmClient
+                from chat.services.semantic_cache import SemanticCache
+
+                embedding_service = EmbeddingService()
+                if settings.SEARCH_BACKEND == "pgvector":
+                    from documents.search_backends.pgvector_backend import PgVectorSearchBackend
+                    search_backend = PgVectorSearchBackend()
+                else:
+                    import faiss
+                    from documents.search_backends.faiss_backend import FaissSearchBackend
+                    if settings.FAISS_OMP_THREADS > 0:
+                        faiss.omp_set_num_threads(settings.FAISS_OMP_THREADS)
+                    search_backend = FaissSearchBackend(
+                        index_path=settings.FAISS_INDEX_PATH,
+                        embedding_service=embedding_service,
+                        use_gpu=settings.FAISS_USE_GPU,
+                        batch_window_ms=settings.FAISS_BATCH_WINDOW_MS,
+                    )
+                llm_client = OpenAILlmClient(api_key=settings.OPENAI_API_KEY)
+                semantic_cache = None
+                if settings.SEMANTIC_CACHE_TTL > 0:
+                    semantic_cache = SemanticCache(
+                        threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+                        ttl_seconds=settings.SEMANTIC_CACHE_TTL,
+                    )
+
+                _rag_service = RAGChatService(
+                    search_backend=search_backend,
+                    embedding_service=embedding_service,
+                    llm_client=llm_client,
+                    semantic_cache=semantic_cache,
+                )
+    return _rag_service
+
+
+def clear_semantic_cache(**kwargs) -> None:
+    """文書の追加・削除・再インデックス時に呼ばれ、意味キャッシュの回答を破棄する（signal receiver）"""
+    service = _rag_service
+    if service is not None and service.semantic_cache is not None:
+        service.semantic_cache.clear()
+
+
+def refresh_routing_prototypes(**kwargs) -> None:
+    """文書の追加・削除・再インデックス時に呼ばれ、部門プロトタイプを作り直す（signal receiver）"""
+    service = _rag_service
+    classifier = getattr(service.router, "classifier", None) if service is not None else None
+    if classifier is not None:
+        classifier.invalidate()
+
+
+def __getattr__(name):
+    # 旧来の `from chat.services import rag_service` も動くようにしておく
+    if name == "rag_service":
+        return get_rag_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,53 @@
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# チャット応答(Embedding + 検索 + LLM)をリクエスト処理から切り離して実行するワーカー
+# 結果はキャッシュに置き、フロントは task_id でポーリングして受け取る
+# ※ 複数プロセスで動かす場合は CACHES を共有バックエンド(Redis等)にすること
+CHAT_TASK_WORKERS = 4
+CHAT_TASK_TTL = 600  # 秒
+CHAT_TASK_CACHE_PREFIX = "chat:task:v1:"
+
+_executor = ThreadPoolExecutor(max_workers=CHAT_TASK_WORKERS, thread_name_prefix="chat-task")
+
+
+def _cache_key(task_id: str) -> str:
+    return f"{CHAT_TASK_CACHE_PREFIX}{task_id}"
+
+
+def submit_chat_task(func, *args, owner=None) -> str:
+    """
+    func(*args) をバックグラウンドで実行し、task_id を返す。
+    owner には結果を参照できる主体(チャットセッションID等)を渡す。
+    """
+    task_id = uuid.uuid4().hex
+    cache.set(_cache_key(task_id), {"status": "pending", "owner": owner}, CHAT_TASK_TTL)
+    _executor.submit(_run_task, task_id, owner, func, *args)
+    return task_id
+
+
+def _run_task(task_id: str, owner, func, *args) -> None:
+    # ワーカースレッドはリクエストサイクル外なので、DB接続の後始末を自前で行う
+    close_old_connections()
+    try:
+        state = {"status": "done", "owner": owner, "result": func(*args)}
+    except Exception:
+        logger.exception("chat task failed: %s", task_id)
+        state = {"status": "error", "owner": owner}
+    finally:
+        close_old_connections()
+    cache.set(_cache_key(task_id), state, CHAT_TASK_TTL)
+
+
+def get_chat_task(task_id: str, *, owner=None) -> dict | None:
+    """task の状態を返す。存在しない / owner が一致しない場合は None"""
+    state = cache.get(_cache_key(task_id))
+    if state is None or state.get("owner") != owner:
+        return None
+    return state
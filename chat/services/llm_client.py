@@ -1,9 +1,30 @@
 import os
-from typing import Optional
+from typing import Iterator, Optional
+
+import httpx
 from openai import OpenAI
 
+try:
+    import h2  # noqa: F401  HTTP/2 は h2 がインストールされている場合のみ有効化
+    HTTP2_AVAILABLE = True
+except Exception:  # pragma: no cover
+    HTTP2_AVAILABLE = False
+
 _client_singleton: Optional[OpenAI] = None
 
+
+def _build_http_client() -> httpx.Client:
+    """
+    OpenAI SDK に渡す HTTP クライアント。
+    接続を使い回して(keep-alive)毎回のTCP/TLSハンドシェイクを避け、
+    同時リクエスト(ルーティング/回答生成)が多くても詰まらないようプールを広げる。
+    """
+    return httpx.Client(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
 # OpenAIとの接続処理を書く
 def get_client() -> OpenAI:
     """
@@ -15,7 +36,7 @@ def get_client() -> OpenAI:
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY が未設定です（.env を確認）")
-        _client_singleton = OpenAI(api_key=api_key)  # envから拾う場合は OpenAI() でもOK
+        _client_singleton = OpenAI(api_key=api_key, http_client=_build_http_client())
     return _client_singleton
 
 class OpenAILlmClient():
@@ -23,10 +44,12 @@ class OpenAILlmClient():
     OpenAI ChatAPIをたたくための薄いラッパークラス
     RAGChatServiceからは、complete(prompt: str)だけを意識
     """
+    __slots__ = ("api_key", "model", "temperature", "client")
+
     def __init__(self,api_key: str, model: str = "gpt-4.1-nano", temperature: float = 0.2) -> None:
         self.api_key = api_key
         self.model = model
-        self.temparture = temperature
+        self.temperature = temperature
         self.client = get_client()
 
     def complete(self, prompt: str) -> str:
@@ -42,8 +65,31 @@ class OpenAILlmClient():
                         "content": prompt, 
                     }
                 ],
-                temperature=self.temparture,
+                temperature=self.temperature,
         )
         choice = response.choices[0]
         answer_text = (choice.message.content or "").strip()
-        return answer_text
\ No newline at end of file
+        return answer_text
+
+    def complete_stream(self, prompt: str) -> Iterator[str]:
+        """
+        complete() のストリーミング版。
+        生成されたテキスト断片(delta)を届いた順に返す。
+        """
+        stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                temperature=self.temperature,
+                stream=True,
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
@@ -1,14 +1,83 @@
+import copy
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+from textwrap import dedent
+from types import MappingProxyType
+from typing import Iterator
+
+import numpy as np
+
 from chat.models import ChatMessage,ChatSession
 from chat.services.routing_service import RoutingService
-from accounts.models import Department
+from chat.services.routing_classifier import DepartmentPrototypeClassifier
+from chat.services.semantic_cache import SemanticCache
+from accounts.services.department_cache import get_department_codes
+
+# クエリのEmbeddingをDB読み込みと並行で走らせるためのスレッドプール
+# Embedding呼び出しはORMに触れないので別スレッドで実行しても安全
+_io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-chat-io")
+
+# 部門ごとのシステムプロンプト（毎ターン組み立てずにimport時に確定させる）
+_SYSTEM_PROMPT_BASE = (
+    "あなたは社内問合せ専用のアシスタントです。"
+    "以下の社内資料（検索で取得したコンテキスト）を根拠に、日本語で簡潔かつ丁寧に回答してください。"
+    "根拠が不足している場合は推測で断定せず、「手元の資料からは判断できません」と答えてください。"
+)
+_SYSTEM_PROMPTS = MappingProxyType({
+    code: f"{_SYSTEM_PROMPT_BASE}\n{role}"
+    for code, role in {
+        "hr": "あなたは人事総務の担当者です。",
+        "finance": "あなたは経理の担当者です。",
+        "legal": "あなたは法務の担当者です。",
+        "it": "あなたは情シスの担当者です。",
+    }.items()
+})
+_DEFAULT_SYSTEM_PROMPT = f"{_SYSTEM_PROMPT_BASE}\nあなたは総合窓口の担当者です。"
+
+# LLMに渡すプロンプトの雛形（行頭のインデントがトークンとして送られないよう字下げなしで保持）
+_PROMPT_TEMPLATE = Template(dedent("""\
+    [system]
+    $system_prompt
+
+    [Conversation history]
+    $history_block
+
+    [Retrieved context]
+    $context
+
+    [Instruction]
+    - 必ず「Question」に対しての回答をしてください。
+    - 根拠は「Retrieved context」と「Conversation history」のみです。
+    - 根拠が不足して断定できない場合は「手元の資料からは判断できません」と答えてください。
+    - 推測で事実を作らないでください。
+
+    [Question]
+    $user_message
+    """))
+
+# 会話履歴の行頭ラベル（role → 表示名）
+_HISTORY_ROLE_LABELS = MappingProxyType({"user": "User", "assistant": "Assistant"})
 
 
 class RAGChatService:
-    def __init__(self,search_backend,embedding_service,llm_client, router: RoutingService | None = None):
+    def __init__(
+        self,
+        search_backend,
+        embedding_service,
+        llm_client,
+        router: RoutingService | None = None,
+        semantic_cache: SemanticCache | None = None,
+    ):
         self.search_backend = search_backend
         self.embedding_service = embedding_service
         self.llm_client = llm_client
-        self.router = router or RoutingService(model="gpt-4.1-nano")
+        # Noneならキャッシュしない
+        self.semantic_cache = semantic_cache
+        self.router = router or RoutingService(
+            model="gpt-4.1-nano",
+            classifier=DepartmentPrototypeClassifier(),
+        )
         
     def chat(self, session: ChatSession, user_message: str) -> tuple[str, dict]:
         """
@@ -17,32 +86,85 @@ class RAGChatService:
         - LLMに投げて回答を生成
         - 回答本文とメタ情報(出典など)を返す
         """
+        prompt, early_answer, meta, cache_key = self._prepare(session, user_message)
+        if prompt is None:
+            return early_answer, meta
+
+        # 6. LLMを読んで、回答を生成
+        answer_text = self.llm_client.complete(prompt)
+        self._cache_answer(cache_key, answer_text, meta)
+        return answer_text, meta
 
-        dept_codes = list(Department.objects.values_list("code", flat=True))
+    def chat_stream(self, session: ChatSession, user_message: str) -> tuple[Iterator[str], dict]:
+        """
+        chat() のストリーミング版。
+        回答本文はLLMが生成した断片から順に返すイテレータ、メタ情報は生成前に確定したものを返す。
+        """
+        prompt, early_answer, meta, cache_key = self._prepare(session, user_message)
+        if prompt is None:
+            return iter([early_answer]), meta
+
+        def stream() -> Iterator[str]:
+            parts: list[str] = []
+            for delta in self.llm_client.complete_stream(prompt):
+                parts.append(delta)
+                yield delta
+            # 最後まで生成できた回答だけをキャッシュする
+            self._cache_answer(cache_key, "".join(parts).strip(), meta)
+
+        return stream(), meta
+
+    def _prepare(self, session: ChatSession, user_message: str) -> tuple[str | None, str | None, dict, tuple | None]:
+        """
+        LLMで回答を生成する直前までの処理(ルーティング・検索・プロンプト組み立て)。
+        戻り値: (prompt, early_answer, meta, cache_key)
+        - LLMに進む場合は prompt を返す
+        - 業務外/検索が弱い/キャッシュヒットの場合は prompt=None とし、early_answer にそのまま返す文言を入れる
+        - cache_key は生成した回答を意味キャッシュに入れるときのキー（scope, query_embedding）
+        """
+
+        # 1. ユーザのクエリをベクトル化する(embeddingservice)
+        # ルーティング(ローカル分類)とFAISS検索の両方で使うので最初に開始し、DB読み込みと重ねる
+        embedding_future = _io_executor.submit(self.embedding_service.embed_text, user_message)
+
+        dept_codes = get_department_codes()
         # 過去メッセージを取得してプロンプトやルート判定に含める
         # 直近10往復分だけの履歴を使う
         HISTORY_LIMIT = 20
+        # 使うのは role/content だけなので、JSONField(meta/citations)の取得とデコードを省く
         history_qs = ChatMessage.objects.filter(
             session=session,
             role__in=[ChatMessage.Role.USER, ChatMessage.Role.ASSISTANT],
-        ).order_by("-created_at")[:HISTORY_LIMIT] # 新しい順に取り出す
-        history_messages = list(history_qs)[::-1] # LLMに渡すために古い順に戻す
+        ).only("role", "content").order_by("-created_at")[:HISTORY_LIMIT] # 新しい順に取り出す
+        history_newest_first = list(history_qs)
 
         
         MAX_CHARS = 1000  # コンテキストが大きくならないように調整
         SNIP = 200 # １メッセージ当たりの上限
-        session_context = ""
-        for m in reversed(history_messages):
+        # 新しい順に詰めて上限を超えたら打ち切り、最後に古い順へ戻して1回だけjoinする
+        context_lines: list[str] = []
+        context_len = 0
+        for m in history_newest_first:
             line = f"{m.role}: {m.content[:SNIP]}\n"
-            if len(session_context) + len(line) > MAX_CHARS:
+            if context_len + len(line) > MAX_CHARS:
                 break
-            session_context = line + session_context
+            context_lines.append(line)
+            context_len += len(line)
+        session_context = "".join(reversed(context_lines))
+        history_messages = history_newest_first
+        history_messages.reverse() # LLMに渡すために古い順に戻す（その場で反転）
+
+        # ルーティング分類・意味キャッシュ・ベクトル検索で使い回すため、float32配列へ一度だけ変換する
+        query_embedding = np.asarray(embedding_future.result(), dtype="float32")
+
         # 0-1.分類器に業務判定と部門判定を委託する
         route = self.router.route(
             user_text=user_message,
             department_codes=dept_codes,
             # 直近の会話を挿入してルーティングの精度を上げる
             session_context=session_context or None,
+            # ローカル分類器で判定できればLLM呼び出しを省略する
+            query_embedding=query_embedding,
         )
 
         # ルーティング結果をmetaに載せる
@@ -50,14 +172,29 @@ class RAGChatService:
 
         # 0-2. 業務外なら、RAG処理に進まず返す
         if not route.is_business:
-            return "本件は社内業務に関する問い合わせではない可能性が高いです。業務に関する内容であれば目的や対象手続きを具体的に教えてください。",{
+            return None, "本件は社内業務に関する問い合わせではない可能性が高いです。業務に関する内容であれば目的や対象手続きを具体的に教えてください。",{
                 "routing": route_meta,
                 "reason": "not_business",
-            }
+            }, None
+
+        # 0-3. 曖昧で誤回答リスクが高いなら、検索に進まず確認の質問を返す
+        if route.needs_clarification:
+            return None, route.clarifying_question, {
+                "routing": route_meta,
+                "reason": "needs_clarification",
+            }, None
+
+        # 0-4. 意味的に近い質問への回答がキャッシュにあれば、検索とLLM呼び出しを省略する
+        # 回答は部門と会話の流れにも依存するので、それらが同じ scope の中だけで引く
+        cache_key = None
+        if self.semantic_cache is not None:
+            scope = self._cache_scope(session, route.primary_department, history_messages)
+            cache_key = (scope, query_embedding)
+            cached = self.semantic_cache.lookup(*cache_key)
+            if cached is not None:
+                cached_answer, cached_meta = cached
+                return None, cached_answer, {**copy.deepcopy(cached_meta), "semantic_cache": "hit"}, None
 
-        # 1. ユーザのクエリをベクトル化する(embeddingservice)
-        query_embedding = self.embedding_service.embed_text(user_message)
-        
         # 2. FAISSにクエリを投げて似ているチャンクをtop_k件頂戴と聞く(search_backend)
         search_results, retrieval_meta = self._search_with_fallback(
             query_embedding=query_embedding,
@@ -82,26 +219,23 @@ class RAGChatService:
         # 検索結果が弱いならclarificationを返す
         if search_weak:
             return (
-            "関連資料を特定できませんでした。対象の制度・手続き名（または担当部署の心当たり）を教えてください。",
+                None,
+                "関連資料を特定できませんでした。対象の制度・手続き名（または担当部署の心当たり）を教えてください。",
                 {
                     "routing" : route_meta,
                     "retrieval": retrieval_meta,
                     "reason": "search_weak",
                 },
+                None,
             )
             
         
         # 3. チャンク内容をもとにコンテキストを組み立てる
-        context_texts = []
-        used_documents = set()
-
-        for result in search_results:
-            chunk = result.chunk
-            context_texts.append(chunk.content)
-            if chunk.document:
-                used_documents.add(chunk.document)
-        
-        context_block = "\n\n".join(context_texts)
+        context_block = "\n\n".join(result.chunk.content for result in search_results)
+        # FKをたどらずに済むよう、Documentインスタンスではなく document_id で重複除去する
+        used_document_ids = {
+            result.chunk.document_id for result in search_results if result.chunk.document_id is not None
+        }
     
         # 4. システムプロンプトを第一候補の部門から作成する
         system_prompt =self._select_system_prompt(route.primary_department)
@@ -114,54 +248,55 @@ class RAGChatService:
             user_message=user_message,
         )
 
-        # 6. LLMを読んで、回答を生成
-        answer_text = self.llm_client.complete(prompt)
-
-        # 7. meta 情報を (どのドキュメントを使ったか等) を組み立てて返す
+        # 6. meta 情報を (どのドキュメントを使ったか等) を組み立てて返す（LLM呼び出しは呼び出し側）
         meta = {
             "routing": route_meta,
             "retrieval":retrieval_meta,
-            "used_document_ids": [doc.id for doc in used_documents],
+            "used_document_ids": sorted(used_document_ids),
             "num_context_chunks": len(search_results),
             "citations": self._build_citations(search_results),
         }
 
-        return answer_text, meta
+        return prompt, None, meta, cache_key
+
+    # --- semantic cache ---
+
+    @staticmethod
+    def _cache_scope(session: ChatSession, primary_department: str, history) -> tuple:
+        """
+        意味キャッシュの scope。ログインユーザ単位（未ログインはセッション単位）・第一候補の部門・
+        今回の発話より前の会話履歴が一致するときだけ回答を使い回す。
+        """
+        user_id = getattr(session, "user_id", None)
+        owner = ("user", user_id) if user_id is not None else ("session", getattr(session, "id", None))
+        digest = hashlib.sha256("\n".join(f"{m.role}:{m.content}" for m in history).encode("utf-8")).hexdigest()
+        return (*owner, primary_department, digest)
+
+    def _cache_answer(self, cache_key: tuple | None, answer_text: str, meta: dict) -> None:
+        if self.semantic_cache is None or cache_key is None or not answer_text:
+            return
+        self.semantic_cache.put(*cache_key, (answer_text, copy.deepcopy(meta)))
     
     def _build_prompt(self, system_prompt, history, context, user_message) -> str:
         """
         LLMに渡す入力文字列を組み立てるヘルパー
         最初はシンプルで。あとで ChatCompletion 形式に変えるなり拡張。
         """
-        history_lines = []
-        for msg in history:
-            role = "User" if msg.role == "user" else "Assistant"
-            history_lines.append(f"{role}: {msg.content}")
+        history_lines = [
+            f"{_HISTORY_ROLE_LABELS.get(msg.role, 'Assistant')}: {msg.content}" for msg in history
+        ]
         # 履歴の最後がUserでないなら今回の発話を追加する
         if not history or history[-1].role != "user" or history[-1].content != user_message:
             history_lines.append(f"User: {user_message}")
 
         history_block = "\n".join(history_lines)
 
-        prompt = f"""[system]
-        {system_prompt}
-
-        [Conversation history]
-        {history_block}
-
-        [Retrieved context]
-        {context}
-
-        [Instruction]
-        - 必ず「Question」に対しての回答をしてください。
-        - 根拠は「Retrieved context」と「Conversation history」のみです。
-        - 根拠が不足して断定できない場合は「手元の資料からは判断できません」と答えてください。
-        - 推測で事実を作らないでください。
-
-        [Question]
-        {user_message}
-        """
-        return prompt
+        return _PROMPT_TEMPLATE.substitute(
+            system_prompt=system_prompt,
+            history_block=history_block,
+            context=context,
+            user_message=user_message,
+        )
 
     
     def _search_with_fallback(self, *, query_embedding, route, top_k: int):
@@ -175,8 +310,10 @@ class RAGChatService:
             if d and d != "unknown" and d not in scopes:
                 scopes.append(d)
 
-        # 1) primary → secondary
+        # 1) primary → secondary（閾値を超えた時点で打ち切り、残りのスコープは検索しない）
+        scopes_probed: list[str] = []
         for scope in scopes:
+            scopes_probed.append(scope)
             results = self.search_backend.search(
                 query_embedding=query_embedding,
                 top_k=top_k,
@@ -193,9 +330,11 @@ class RAGChatService:
                     "hit_count": len(results),
                     "k": top_k,
                     "score_threshold": SCORE_THRESHOLD,
+                    "scopes_probed": scopes_probed,
                 }
 
         # 2) 全社フォールバック
+        scopes_probed.append("company")
         results = self.search_backend.search(
             query_embedding=query_embedding,
             top_k=top_k,
@@ -211,27 +350,15 @@ class RAGChatService:
             "hit_count": len(results),
             "k": top_k,
             "score_threshold": SCORE_THRESHOLD,
+            "scopes_probed": scopes_probed,
         }
 
     def _select_system_prompt(self, dept_code: str) -> str:
-        base = (
-            "あなたは社内問合せ専用のアシスタントです。"
-            "以下の社内資料（検索で取得したコンテキスト）を根拠に、日本語で簡潔かつ丁寧に回答してください。"
-            "根拠が不足している場合は推測で断定せず、「手元の資料からは判断できません」と答えてください。"
-        )
-
-        roles = {
-            "hr": "あなたは人事総務の担当者です。",
-            "finance": "あなたは経理の担当者です。",
-            "legal": "あなたは法務の担当者です。",
-            "it": "あなたは情シスの担当者です。",
-        }
-
-        role = roles.get(dept_code, "あなたは総合窓口の担当者です。")
-        return f"{base}\n{role}"
+        return _SYSTEM_PROMPTS.get(dept_code, _DEFAULT_SYSTEM_PROMPT)
     
     # 引用構築
     def _build_citations(self, search_results) -> list[dict]:
+        # pages/chunks は dict を順序付き集合として使い、挿入時に重複除去する
         by_doc: dict[int, dict] = {}
 
         for r in (search_results or []):
@@ -240,38 +367,31 @@ class RAGChatService:
                 continue
 
             doc_id = int(chunk.document_id)
-            doc = chunk.document
-
-            if doc_id not in by_doc:
-                by_doc[doc_id] = {
-                    "document_id": doc_id,
-                    "title": (getattr(doc, "title", "") or f"Document#{doc_id}"),
-                    "has_page": False,
-                    "pages": set(),
-                    "chunks": set(),
+            acc = by_doc.get(doc_id)
+            if acc is None:
+                acc = by_doc[doc_id] = {
+                    "title": chunk.document.title or f"Document#{doc_id}",
+                    "pages": {},
+                    "chunks": {},
                 }
 
             if chunk.page is not None:
-                by_doc[doc_id]["has_page"] = True
-                by_doc[doc_id]["pages"].add(int(chunk.page))
-            else:
-                if chunk.chunk_index is not None:
-                    # ingestionは0-basedなので、表示は1-based推奨
-                    by_doc[doc_id]["chunks"].add(int(chunk.chunk_index) + 1)
-
-        citations: list[dict] = []
-        for doc_id, acc in by_doc.items():
-            if acc["has_page"] and acc["pages"]:
-                locator = {"type": "page_set", "pages": sorted(acc["pages"])}
-            else:
-                locator = {"type": "chunk_set", "chunks": sorted(acc["chunks"])}
-
-            citations.append({
-                "document_id": acc["document_id"],
+                acc["pages"][int(chunk.page)] = None
+            elif chunk.chunk_index is not None:
+                # ingestionは0-basedなので、表示は1-based推奨
+                acc["chunks"][int(chunk.chunk_index) + 1] = None
+
+        citations = [
+            {
+                "document_id": doc_id,
                 "title": acc["title"],
-                "locator": locator,
-            })
-
-        citations.sort(key=lambda x: (x.get("title") or "", x.get("document_id") or 0))
+                "locator": (
+                    {"type": "page_set", "pages": sorted(acc["pages"])}
+                    if acc["pages"]
+                    else {"type": "chunk_set", "chunks": sorted(acc["chunks"])}
+                ),
+            }
+            for doc_id, acc in by_doc.items()
+        ]
+        citations.sort(key=lambda x: (x["title"], x["document_id"]))
         return citations
-
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, Sequence
+
+import numpy as np
+from django.db import connection
+
+from documents.services.embedding_service import EmbeddingService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DepartmentGuess:
+    primary_department: str
+    confidence: float
+    secondary_departments: list[str]
+
+
+class DepartmentPrototypeClassifier:
+    """
+    ローカルで部門を推定する軽量分類器（業務判定・clarification 判定はしない）。
+    - 部門ごとに登録済みチャンクの埋め込みを平均した「プロトタイプ」を持つ
+    - クエリ埋め込みとの cos 類似度が十分高く、2位との差も十分ある場合だけ結果を返す
+    - 自信がない場合は None を返し、呼び出し側(LLMの部門判定)に任せる
+    - 会話の流れに依存する質問は最新の発話だけでは部門が決まらないので判定しない
+    - プロトタイプの作成はバックグラウンドスレッドで行い、リクエスト処理をブロックしない
+    """
+
+    def __init__(
+        self,
+        min_score: float = 0.5,
+        min_margin: float = 0.05,
+        ttl_seconds: float = 600.0,
+        dimension: int = EmbeddingService.dimension,
+    ) -> None:
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.ttl_seconds = ttl_seconds
+        self.dimension = dimension
+
+        self._lock = threading.Lock()
+        self._codes: list[str] = []
+        self._matrix: np.ndarray | None = None  # (num_depts, dim) / 各行L2正規化済み
+        self._loaded_at: float | None = None
+        self._refresh_thread: threading.Thread | None = None
+        self._refresh_requested = False
+
+    # --- prototypes ---
+
+    def _load_prototypes(self) -> tuple[list[str], np.ndarray | None]:
+        """
+        Chunk.embedding を部門コードごとに平均してプロトタイプ行列を作る。
+        集計はDB側で行い、Pythonには (部門数 x 次元数) の合計値だけを持ってくる。
+        各行は足す前にL2正規化する（長い/短いベクトルに平均が引っ張られないように）。
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT dep.code, u.i, SUM(u.e / n.norm)"
+                " FROM documents_chunk c"
+                " JOIN documents_document d ON d.id = c.document_id"
+                " JOIN accounts_department dep ON dep.id = d.department_id"
+                " CROSS JOIN LATERAL (SELECT sqrt(SUM(x * x)) AS norm FROM unnest(c.embedding) AS x) n"
+                " CROSS JOIN LATERAL unnest(c.embedding) WITH ORDINALITY AS u(e, i)"
+                " WHERE array_length(c.embedding, 1) = %s AND n.norm > 0"
+                " GROUP BY dep.code, u.i",
+                [self.dimension],
+            )
+            rows = cursor.fetchall()
+
+        if not rows:
+            return [], None
+
+        codes = sorted({code for code, _, _ in rows})
+        row_of = {code: r for r, code in enumerate(codes)}
+        matrix = np.zeros((len(codes), self.dimension), dtype="float32")
+        for code, i, total in rows:
+            matrix[row_of[code], i - 1] = total
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0.0] = 1.0
+        matrix /= norms
+        return codes, matrix
+
+    def refresh(self) -> None:
+        """プロトタイプを作り直して差し替える（DBを走査するのでリクエストスレッドからは呼ばない）"""
+        codes, matrix = self._load_prototypes()
+        with self._lock:
+            self._codes, self._matrix = codes, matrix
+            self._loaded_at = time.monotonic()
+
+    def _refresh_worker(self) -> None:
+        try:
+            while True:
+                with self._lock:
+                    self._refresh_requested = False
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception("部門プロトタイプの作成に失敗しました。")
+                    # 失敗時も ttl_seconds の間は作り直さない（リクエストごとに再試行しない）
+                    with self._lock:
+                        self._loaded_at = time.monotonic()
+                with self._lock:
+                    # 作成中に文書が変わっていたら、読み直しが必要なのでもう一周する
+                    if not self._refresh_requested:
+                        self._refresh_thread = None
+                        return
+        finally:
+            # スレッドごとに開いたDB接続を残さない
+            connection.close()
+
+    def refresh_in_background(self) -> None:
+        """プロトタイプの作り直しをバックグラウンドで始める（作成中なら終わった後にもう一度作る）"""
+        with self._lock:
+            self._refresh_requested = True
+            if self._refresh_thread is not None:
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_worker, name="routing-prototypes", daemon=True
+            )
+            self._refresh_thread.start()
+
+    def _get_prototypes(self) -> tuple[list[str], np.ndarray | None]:
+        """今あるプロトタイプを返す。古ければ作り直しを始めるが、完了は待たない"""
+        with self._lock:
+            codes, matrix, loaded_at = self._codes, self._matrix, self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= self.ttl_seconds:
+            self.refresh_in_background()
+        return codes, matrix
+
+    def invalidate(self) -> None:
+        """文書の変更時に呼ばれ、プロトタイプをバックグラウンドで作り直す（signal receiver からも使う）"""
+        with self._lock:
+            self._loaded_at = None
+        self.refresh_in_background()
+
+    # --- classify ---
+
+    def classify(
+        self,
+        query_embedding: Sequence[float],
+        department_codes: Iterable[str],
+        *,
+        session_context: str | None = None,
+    ) -> DepartmentGuess | None:
+        # 直前の会話を受けた質問は最新の発話だけでは意味が決まらないので、文脈を見られるLLMに任せる
+        if session_context:
+            return None
+
+        codes, matrix = self._get_prototypes()
+        if matrix is None:
+            return None
+
+        q = np.asarray(query_embedding, dtype="float32")
+        if q.ndim != 1 or q.shape[0] != matrix.shape[1]:
+            return None
+        q_norm = float(np.linalg.norm(q))
+        if q_norm == 0.0:
+            return None
+
+        scores = matrix @ (q / q_norm)
+
+        allowed = set(department_codes)
+        ranked = [
+            (codes[i], float(scores[i]))
+            for i in np.argsort(scores)[::-1]
+            if not allowed or codes[i] in allowed
+        ]
+        # 比べる相手がいなければ2位との差で自信を測れないので判定しない
+        if len(ranked) < 2:
+            return None
+
+        (top_code, top_score), (_, second_score) = ranked[0], ranked[1]
+        if top_score < self.min_score or (top_score - second_score) < self.min_margin:
+            return None
+
+        logger.info("routing:local primary=%s score=%.3f second=%.3f", top_code, top_score, second_score)
+        return DepartmentGuess(
+            primary_department=top_code,
+            confidence=min(max(top_score, 0.0), 1.0),
+            secondary_departments=[c for c, s in ranked[1:3] if s >= self.min_score],
+        )
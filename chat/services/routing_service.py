@@ -1,28 +1,62 @@
 from __future__ import annotations
 
-from typing import Iterable, Optional
+from functools import lru_cache
+from typing import Iterable, Optional, Sequence, TYPE_CHECKING
 
 from openai import OpenAI
 from pydantic import ValidationError
 
 from chat.schemas.routing import RoutingResult
+from chat.services.llm_client import get_client
+
+if TYPE_CHECKING:
+    from chat.services.routing_classifier import DepartmentPrototypeClassifier
 
 import logging
 logger = logging.getLogger(__name__)
 
+
+@lru_cache(maxsize=8)
+def _build_instructions(dept_hint: str) -> str:
+    """
+    ルーティング用のsystem指示文を組み立てる。
+    部門コード一覧はほぼ固定なので、dept_hint単位でメモ化して毎回の文字列生成を省く。
+    """
+    return (
+        "あなたは社内問い合わせ回答アシスタントのルーティング担当です。\n"
+        "次のJSONスキーマに厳密に従って出力してください。\n"
+        "判定の方針:\n"
+        "- 業務かどうか曖昧なら is_business は true 寄りにする\n"
+        "- ただし曖昧で誤回答リスクが高い場合は needs_clarification=true にし、clarifying_question を1つだけ作る\n"
+        "- primary_department は必ず部門コードで返す（不明なら unknown）\n"
+        "- secondary_departments は最大2つ程度まで（不要なら空配列）\n"
+        "\n"
+        f"利用可能な部門コード一覧: {dept_hint}\n"
+    )
+
+
 class RoutingService:
     """
     - 1回のLLM呼び出しで、業務判定 + 部門判定 + clarification判定を返す
     - Structured Outputs で「JSONスキーマ準拠」を強制
     - その上で、Pydanticで整合性チェック
     - 失敗時は安全側（業務扱い + clarification）へ倒す
+    - classifier があれば部門だけはローカル分類の結果を使う
+      （業務判定と clarification 判定は常にLLMが行う。ローカル分類器にはそれを判断する材料がない）
     """
 
     ROUTING_MODEL = "gpt-4.1-nano"
 
-    def __init__(self, model: str | None = None, client: OpenAI | None = None):
+    def __init__(
+        self,
+        model: str | None = None,
+        client: OpenAI | None = None,
+        classifier: "DepartmentPrototypeClassifier | None" = None,
+    ):
         self.model = model or self.ROUTING_MODEL
-        self.client = client or OpenAI()
+        # 回答生成と同じ接続プールを共有する
+        self.client = client or get_client()
+        self.classifier = classifier
 
     def route(
         self,
@@ -30,24 +64,23 @@ class RoutingService:
         *,
         department_codes: Iterable[str],
         session_context: Optional[str] = None,
+        query_embedding: Optional[Sequence[float]] = None,
     ) -> RoutingResult:
-        dept_codes = sorted(set([c.strip() for c in department_codes if c and c.strip()]))
+        dept_codes = sorted({c.strip() for c in department_codes if c and c.strip()})
+
+        # ローカル分類器で確信度の高い部門が出れば、LLMの部門判定より優先する
+        local = None
+        if self.classifier is not None and query_embedding is not None:
+            try:
+                local = self.classifier.classify(query_embedding, dept_codes, session_context=session_context)
+            except Exception:
+                logger.exception("ローカル分類に失敗しました。部門もLLMの判定を使います。")
 
         # ここで「DBにある部門コード」だけを候補としてモデルに提示する
         # （部門追加にも追従できる）
         dept_hint = ", ".join(dept_codes) if dept_codes else "(none)"
 
-        instructions = (
-            "あなたは社内問い合わせ回答アシスタントのルーティング担当です。\n"
-            "次のJSONスキーマに厳密に従って出力してください。\n"
-            "判定の方針:\n"
-            "- 業務かどうか曖昧なら is_business は true 寄りにする\n"
-            "- ただし曖昧で誤回答リスクが高い場合は needs_clarification=true にし、clarifying_question を1つだけ作る\n"
-            "- primary_department は必ず部門コードで返す（不明なら unknown）\n"
-            "- secondary_departments は最大2つ程度まで（不要なら空配列）\n"
-            "\n"
-            f"利用可能な部門コード一覧: {dept_hint}\n"
-        )
+        instructions = _build_instructions(dept_hint)
 
         # session_context はあれば「補助情報」として入れる（ないなら省略）
         user_payload = (
@@ -68,6 +101,10 @@ class RoutingService:
             )
 
             result: RoutingResult = resp.output_parsed
+            if local is not None and result.is_business and not result.needs_clarification:
+                result.primary_department = local.primary_department
+                result.department_confidence = local.confidence
+                result.secondary_departments = local.secondary_departments
 
             # 追加の“業務ロジック側”検証（DBにない部門コードが来た場合など）
             return self._post_validate(result, dept_codes)
@@ -100,8 +137,9 @@ class RoutingService:
 
 
     def _post_validate(self, result: RoutingResult, dept_codes: list[str]) -> RoutingResult:
+        valid_codes = set(dept_codes)
         # unknown は許容
-        if result.primary_department != "unknown" and dept_codes and result.primary_department not in dept_codes:
+        if result.primary_department != "unknown" and valid_codes and result.primary_department not in valid_codes:
             # DBにないコード → ルーティング結果としては使えないので clarification へ
             result.needs_clarification = True
             result.clarifying_question = (
@@ -113,10 +151,10 @@ class RoutingService:
             result.secondary_departments = []
 
         # secondary も同様にフィルタ
-        if dept_codes:
+        if valid_codes:
             result.secondary_departments = [
                 d for d in result.secondary_departments
-                if d in dept_codes and d != result.primary_department
+                if d in valid_codes and d != result.primary_department
             ][:2]
 
         return result
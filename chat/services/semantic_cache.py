@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, Sequence
+
+import numpy as np
+
+
+@dataclass
+class _CacheEntry:
+    scope: Hashable
+    keys: tuple[int, ...]  # テーブルごとのLSHバケットキー
+    vector: np.ndarray  # L2正規化済み float32
+    value: Any
+    created_at: float
+    nbytes: int
+
+
+class SemanticCache:
+    """
+    クエリ埋め込みの近さ(cos類似度)で引けるプロセス内キャッシュ。
+    - ランダム射影LSH(符号ビット)でバケットを引き、候補だけ cos 類似度を計算する
+    - 1テーブルのビット数を増やすと言い換えが別バケットに落ちやすいので、複数テーブルで拾う
+    - scope(ユーザ/セッション)単位で分離し、TTL と合計バイト数上限(LRU)で古いものから捨てる
+    """
+
+    def __init__(
+        self,
+        *,
+        threshold: float = 0.95,
+        ttl_seconds: float = 600.0,
+        max_bytes: int = 32 * 1024 * 1024,
+        num_tables: int = 4,
+        bits_per_table: int = 8,
+        seed: int = 0,
+    ) -> None:
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.num_tables = num_tables
+        self.bits_per_table = bits_per_table
+        self.seed = seed
+
+        self._lock = threading.Lock()
+        self._planes: np.ndarray | None = None  # (dim, num_tables * bits_per_table)
+        self._bit_weights = (1 << np.arange(bits_per_table, dtype=np.int64))
+        self._entries: OrderedDict[int, _CacheEntry] = OrderedDict()  # LRU順（末尾が最新）
+        self._buckets: dict[tuple[Hashable, int, int], set[int]] = {}
+        self._next_id = 0
+        self._total_bytes = 0
+
+    # --- public ---
+
+    def lookup(self, scope: Hashable, embedding: Sequence[float]) -> Any | None:
+        """閾値以上に近いエントリがあればその値を返す。なければ None"""
+        q = self._normalize(embedding)
+        if q is None:
+            return None
+
+        with self._lock:
+            keys = self._hash(q)
+            if keys is None:
+                return None
+
+            now = time.monotonic()
+            candidates: set[int] = set()
+            for t, key in enumerate(keys):
+                candidates |= self._buckets.get((scope, t, key), set())
+
+            best_id, best_score = None, self.threshold
+            for entry_id in candidates:
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                if now - entry.created_at > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                score = float(entry.vector @ q)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id].value
+
+    def put(self, scope: Hashable, embedding: Sequence[float], value: Any) -> None:
+        q = self._normalize(embedding)
+        if q is None:
+            return
+
+        with self._lock:
+            if self._planes is None:
+                rng = np.random.default_rng(self.seed)
+                self._planes = rng.standard_normal(
+                    (q.shape[0], self.num_tables * self.bits_per_table)
+                ).astype("float32")
+            keys = self._hash(q)
+            if keys is None:
+                return
+
+            entry_id = self._next_id
+            self._next_id += 1
+            nbytes = int(q.nbytes) + _approx_size(value)
+            self._entries[entry_id] = _CacheEntry(
+                scope=scope,
+                keys=keys,
+                vector=q,
+                value=value,
+                created_at=time.monotonic(),
+                nbytes=nbytes,
+            )
+            for t, key in enumerate(keys):
+                self._buckets.setdefault((scope, t, key), set()).add(entry_id)
+            self._total_bytes += nbytes
+
+            # 上限を超えたら古い(最後に使われていない)ものから捨てる
+            while self._total_bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._total_bytes = 0
+
+    # --- internal ---
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray | None:
+        q = np.asarray(embedding, dtype="float32").reshape(-1)
+        n = float(np.linalg.norm(q))
+        if q.size == 0 or n == 0.0:
+            return None
+        return q / n
+
+    def _hash(self, q: np.ndarray) -> tuple[int, ...] | None:
+        if self._planes is None or self._planes.shape[0] != q.shape[0]:
+            return None
+        bits = (q @ self._planes > 0).reshape(self.num_tables, self.bits_per_table)
+        return tuple(int(k) for k in bits.astype(np.int64) @ self._bit_weights)
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry.nbytes
+        for t, key in enumerate(entry.keys):
+            bucket = self._buckets.get((entry.scope, t, key))
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[(entry.scope, t, key)]
+
+
+def _approx_size(value: Any) -> int:
+    """キャッシュ値のおおよそのバイト数（上限管理用）"""
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+    except Exception:
+        return 1024
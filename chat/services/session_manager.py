@@ -1,4 +1,3 @@
-from django.db import transaction
 from django.utils import timezone
 
 from chat.models import  ChatSession
@@ -14,7 +13,10 @@ class ChatSessionService:
         session_id = request.session.get("chat_session_id")
 
         if session_id:
-            qs = ChatSession.objects.filter(id=session_id, ended_at__isnull=True)
+            # 回答部門名を画面に出すので、部門もJOINで一緒に取得する（表示時の追加SELECTを避ける）
+            qs = ChatSession.objects.select_related("answer_department").filter(
+                id=session_id, ended_at__isnull=True
+            )
 
             # ログイン中であれば自分のセッションのみ
             if request.user.is_authenticated:
@@ -49,13 +51,8 @@ class ChatSessionService:
         else:
             qs = qs.filter(user__isnull=True)
 
-        session = qs.first()
-        if not session:
-            request.session.pop("chat_session_id", None)
-            return
-        with transaction.atomic():
-            session.ended_at = timezone.now()
-            session.save(update_fields=["ended_at"])
+        # SELECTせずに条件付きUPDATE 1本で終了扱いにする（対象がなければ0件更新）
+        qs.update(ended_at=timezone.now())
 
         # 次回は新規セッションを作らせる
         request.session.pop("chat_session_id", None)
\ No newline at end of file
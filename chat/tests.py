@@ -4,6 +4,7 @@ from __future__ import annotations
 from django.test import TestCase
 from unittest.mock import Mock
 
+from chat.models import ChatSession
 from chat.services.rag_chat import RAGChatService  
 from documents.search_backends.base import SearchResult
 
@@ -58,7 +59,7 @@ class RAGChatFallbackTests(TestCase):
 class _DummyResult:
     def __init__(self, score: float):
         self.score = score
-        self.chunk = type("Chunk", (), {"content": "x", "document": None})()
+        self.chunk = type("Chunk", (), {"content": "x", "document": None, "document_id": None})()
 
 
 class _DummyRoute:
@@ -84,6 +85,7 @@ class RAGChatBranchingTests(TestCase):
     def setUp(self):
         self.search_backend = Mock()
         self.embedding_service = Mock()
+        self.embedding_service.embed_text.return_value = [0.1, 0.2, 0.3]
         self.llm_client = Mock()
         self.router = Mock()
 
@@ -91,7 +93,8 @@ class RAGChatBranchingTests(TestCase):
             self.search_backend, self.embedding_service, self.llm_client, router=self.router
         )
 
-        self.session = Mock()
+        # 履歴はORMで引くので実セッションを使う
+        self.session = ChatSession.objects.create()
 
     def test_needs_clarification_short_circuits(self):
         """needs_clarificationなら検索・LLMに進まない"""
@@ -104,7 +107,7 @@ class RAGChatBranchingTests(TestCase):
         self.assertIn("確認です", answer)
         self.assertEqual(meta["reason"], "needs_clarification")
 
-        self.embedding_service.embed_text.assert_not_called()
+        # Embeddingはルーティングより先に開始するので呼ばれるが、検索・LLMには進まない
         self.search_backend.search.assert_not_called()
         self.llm_client.complete.assert_not_called()
 
@@ -115,7 +118,7 @@ class RAGChatBranchingTests(TestCase):
         answer, meta = self.svc.chat(session=self.session, user_message="おすすめのラーメンは？")
         self.assertEqual(meta["reason"], "not_business")
 
-        self.embedding_service.embed_text.assert_not_called()
+        # Embeddingはルーティングと並行で投機的に走るため、呼ばれても結果は使われない
         self.search_backend.search.assert_not_called()
         self.llm_client.complete.assert_not_called()
 
@@ -166,6 +169,9 @@ class RAGChatFallbackMoreTests(TestCase):
         self.assertEqual(meta["scope_used"], "finance")
         self.assertFalse(meta["fallback_triggered"])
         self.assertAlmostEqual(meta["top_score"], 0.55, places=6)
+        # primaryで確定したら secondary / company は検索しない
+        self.assertEqual(meta["scopes_probed"], ["finance"])
+        self.assertEqual(search_backend.search.call_count, 1)
 
 
 class PromptBuildTests(TestCase):
@@ -179,4 +185,295 @@ class PromptBuildTests(TestCase):
             user_message="経費精算の締め日は？",
         )
         self.assertIn("[Question]", prompt)
-        self.assertTrue(prompt.strip().endswith("経費精算の締め日は？"))
\ No newline at end of file
+        self.assertTrue(prompt.strip().endswith("経費精算の締め日は？"))
+
+class DepartmentPrototypeClassifierTests(TestCase):
+    def _classifier(self):
+        from chat.services.routing_classifier import DepartmentPrototypeClassifier
+        import numpy as np
+
+        clf = DepartmentPrototypeClassifier(min_score=0.5, min_margin=0.05)
+        matrix = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]], dtype="float32")
+        clf._load_prototypes = Mock(return_value=(["finance", "hr"], matrix))
+        return clf
+
+    def test_confident_query_is_routed_locally(self):
+        """プロトタイプに十分近いクエリは部門が決まる"""
+        clf = self._classifier()
+        clf.refresh()
+        result = clf.classify([0.9, 0.1, 0.0], ["finance", "hr"])
+        self.assertIsNotNone(result)
+        self.assertEqual(result.primary_department, "finance")
+
+    def test_ambiguous_query_falls_back(self):
+        """上位2部門の差が小さい場合はNone（LLMルーティングへ）"""
+        clf = self._classifier()
+        clf.refresh()
+        self.assertIsNone(clf.classify([1.0, 1.0, 0.0], ["finance", "hr"]))
+
+    def test_abstains_with_a_single_candidate_department(self):
+        """比較する2位がいない場合は差で自信を測れないのでNone"""
+        clf = self._classifier()
+        clf.refresh()
+        self.assertIsNone(clf.classify([0.9, 0.1, 0.0], ["finance"]))
+
+    def test_follow_up_query_is_left_to_llm(self):
+        """会話に依存する質問は部門もLLMに任せる"""
+        clf = self._classifier()
+        clf.refresh()
+        self.assertIsNone(
+            clf.classify([0.9, 0.1, 0.0], ["finance", "hr"], session_context="user: 出張の申請について\n")
+        )
+
+    def test_prototypes_are_built_off_the_request_thread(self):
+        """プロトタイプ作成を待たずにLLMへフォールバックし、作成はバックグラウンドで行う"""
+        import threading
+
+        clf = self._classifier()
+        loaded_on = []
+        prototypes = clf._load_prototypes.return_value
+
+        def _load():
+            loaded_on.append(threading.current_thread())
+            return prototypes
+
+        clf._load_prototypes.side_effect = _load
+        self.assertIsNone(clf.classify([0.9, 0.1, 0.0], ["finance", "hr"]))
+
+        thread = clf._refresh_thread
+        if thread is not None:
+            thread.join(timeout=5)
+        self.assertEqual(len(loaded_on), 1)
+        self.assertIsNot(loaded_on[0], threading.current_thread())
+        result = clf.classify([0.9, 0.1, 0.0], ["finance", "hr"])
+        self.assertEqual(result.primary_department, "finance")
+
+    def test_prototypes_are_normalized_means_per_department(self):
+        """プロトタイプはDB側で集計した「正規化済み埋め込みの平均」"""
+        from django.contrib.auth import get_user_model
+        from accounts.models import Department
+        from chat.services.routing_classifier import DepartmentPrototypeClassifier
+        from documents.models import Chunk, Document
+        import numpy as np
+
+        user = get_user_model().objects.create_user(username="proto", password="pass12345")
+        for code, embeddings in {"finance": [[2.0, 0.0, 0.0], [0.0, 3.0, 0.0]], "hr": [[0.0, 0.0, 5.0]]}.items():
+            dep = Department.objects.create(name=code, code=code)
+            doc = Document.objects.create(title=code, file_path=f"dummy/{code}.pdf", department=dep, uploaded_by=user)
+            for i, emb in enumerate(embeddings):
+                Chunk.objects.create(document=doc, content=code, chunk_index=i, embedding=emb)
+
+        codes, matrix = DepartmentPrototypeClassifier(dimension=3)._load_prototypes()
+
+        self.assertEqual(codes, ["finance", "hr"])
+        np.testing.assert_allclose(matrix, [[0.70710677, 0.70710677, 0.0], [0.0, 0.0, 1.0]], rtol=1e-5)
+
+
+class RoutingServiceLocalClassifierTests(TestCase):
+    def _route(self, llm_result):
+        from chat.schemas.routing import RoutingResult
+        from chat.services.routing_classifier import DepartmentGuess
+        from chat.services.routing_service import RoutingService
+
+        client = Mock()
+        client.responses.parse.return_value = Mock(output_parsed=RoutingResult(**llm_result))
+        classifier = Mock()
+        classifier.classify.return_value = DepartmentGuess("finance", 0.9, [])
+        router = RoutingService(client=client, classifier=classifier)
+        result = router.route("今日のランチのおすすめは？", department_codes=["finance", "hr"], query_embedding=[1.0])
+        return client, result
+
+    def test_llm_still_decides_business_and_clarification(self):
+        """ローカル分類器が部門を決められても、業務外判定はLLMの結果に従う"""
+        client, result = self._route(
+            {"is_business": False, "business_confidence": 0.9, "primary_department": "unknown",
+             "department_confidence": 0.0, "secondary_departments": [], "needs_clarification": False},
+        )
+        client.responses.parse.assert_called_once()
+        self.assertFalse(result.is_business)
+        self.assertEqual(result.primary_department, "unknown")
+
+    def test_local_department_is_used_for_business_queries(self):
+        _, result = self._route(
+            {"is_business": True, "business_confidence": 0.9, "primary_department": "hr",
+             "department_confidence": 0.6, "secondary_departments": [], "needs_clarification": False},
+        )
+        self.assertEqual((result.primary_department, result.department_confidence), ("finance", 0.9))
+
+
+class ChatStreamViewTests(TestCase):
+    def test_stream_returns_deltas_and_saves_answer(self):
+        """ストリーミング時は断片→doneの順で返し、最終回答を保存する"""
+        import json
+        from unittest.mock import patch
+        from chat.models import ChatMessage
+
+        rag = Mock()
+        rag.chat_stream.return_value = (iter(["経費は", "月末締めです。"]), {"citations": []})
+
+        with patch("chat.views.get_rag_service", return_value=rag):
+            res = self.client.post(
+                "/",
+                {"message": "経費精算の締め日は？"},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+                HTTP_X_CHAT_STREAM="1",
+            )
+            events = [
+                json.loads(line)
+                for line in b"".join(res.streaming_content).decode("utf-8").splitlines()
+                if line.strip()
+            ]
+
+        self.assertEqual([e["type"] for e in events], ["delta", "delta", "done"])
+        self.assertEqual(events[-1]["assistant"], "経費は月末締めです。")
+        self.assertTrue(
+            ChatMessage.objects.filter(role=ChatMessage.Role.ASSISTANT, content="経費は月末締めです。").exists()
+        )
+
+
+class _InlineExecutor:
+    """テスト用: submit された処理をその場で(テストのトランザクション内で)実行する"""
+    def submit(self, fn, *args):
+        from unittest.mock import patch
+        # ワーカー用のDB接続後始末がテストの接続を閉じないようにする
+        with patch("chat.services.chat_tasks.close_old_connections"):
+            fn(*args)
+
+
+class ChatAsyncViewTests(TestCase):
+    def test_async_post_returns_task_and_result_is_polled(self):
+        """非同期時は202でtask_idを返し、結果URLで回答を受け取れる"""
+        from unittest.mock import patch
+        from chat.models import ChatMessage
+
+        rag = Mock()
+        rag.chat.return_value = ("月末締めです。", {"citations": []})
+
+        with patch("chat.views.get_rag_service", return_value=rag), \
+                patch("chat.services.chat_tasks._executor", _InlineExecutor()):
+            res = self.client.post(
+                "/",
+                {"message": "経費精算の締め日は？"},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+                HTTP_X_CHAT_ASYNC="1",
+            )
+        self.assertEqual(res.status_code, 202)
+
+        result = self.client.get(res.json()["result_url"])
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json()["status"], "done")
+        self.assertEqual(result.json()["assistant"], "月末締めです。")
+        # 画面に返す meta は表示用の項目だけに絞られる
+        self.assertEqual(set(result.json()["meta"]), {"routing", "retrieval", "citations"})
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+    def test_result_of_other_session_is_not_visible(self):
+        """他セッションの task_id は参照できない"""
+        from chat.services.chat_tasks import submit_chat_task
+        from unittest.mock import patch
+
+        with patch("chat.services.chat_tasks._executor", _InlineExecutor()):
+            task_id = submit_chat_task(lambda: {"assistant": "x"}, owner=-1)
+        self.assertEqual(self.client.get(f"/result/{task_id}/").status_code, 404)
+
+
+class SemanticCacheTests(TestCase):
+    def test_near_duplicate_query_hits_within_scope(self):
+        """ほぼ同じ埋め込みならヒットし、scopeが違えばヒットしない"""
+        from chat.services.semantic_cache import SemanticCache
+
+        cache = SemanticCache(threshold=0.95)
+        cache.put(("user", 1), [1.0, 0.0, 0.0, 0.0], ("answer", {"citations": []}))
+
+        self.assertEqual(cache.lookup(("user", 1), [0.99, 0.01, 0.0, 0.0])[0], "answer")
+        self.assertIsNone(cache.lookup(("user", 2), [1.0, 0.0, 0.0, 0.0]))
+        self.assertIsNone(cache.lookup(("user", 1), [0.0, 1.0, 0.0, 0.0]))
+
+    def test_expired_entry_is_not_returned(self):
+        """TTLを過ぎたエントリは返さない"""
+        from chat.services.semantic_cache import SemanticCache
+
+        cache = SemanticCache(ttl_seconds=0.0)
+        cache.put("s", [1.0, 0.0], "answer")
+        self.assertIsNone(cache.lookup("s", [1.0, 0.0]))
+
+
+class RAGChatSemanticCacheTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        from chat.services.semantic_cache import SemanticCache
+
+        self.user = get_user_model().objects.create_user(username="cache", password="pass12345")
+        search_backend = Mock()
+        search_backend.search.return_value = [_DummyResult(0.9)]
+        embedding_service = Mock()
+        # 言い換えた質問も同じ埋め込みになる状況
+        embedding_service.embed_text.return_value = [1.0, 0.0, 0.0]
+        self.llm_client = Mock()
+        self.llm_client.complete.return_value = "answer"
+        self.router = Mock()
+        self.router.route.return_value = _DummyRoute(primary="finance")
+        self.svc = RAGChatService(
+            search_backend, embedding_service, self.llm_client, router=self.router, semantic_cache=SemanticCache()
+        )
+
+    def _ask(self, text, history=()):
+        """新しいセッションで、history の後に text を質問する（ビューと同じく発話は chat() の後に保存する）"""
+        from chat.models import ChatMessage
+
+        session = ChatSession.objects.create(user=self.user)
+        for role, content in history:
+            ChatMessage.objects.create(session=session, role=role, content=content)
+        answer, meta = self.svc.chat(session=session, user_message=text)
+        ChatMessage.objects.create(session=session, role="user", content=text)
+        ChatMessage.objects.create(session=session, role="assistant", content=answer)
+        return answer, meta
+
+    def test_answer_is_reused_only_for_same_department_and_history(self):
+        self._ask("q1")
+        answer, meta = self._ask("q1 rephrased")
+        self.assertEqual((answer, meta.get("semantic_cache")), ("answer", "hit"))
+        self.assertEqual(self.llm_client.complete.call_count, 1)
+
+        # 会話の流れが違えば使い回さない
+        _, meta = self._ask("q1", history=[("user", "prev"), ("assistant", "prev answer")])
+        self.assertNotIn("semantic_cache", meta)
+
+        # 第一候補の部門が違えば使い回さない
+        self.router.route.return_value = _DummyRoute(primary="hr")
+        _, meta = self._ask("q1")
+        self.assertNotIn("semantic_cache", meta)
+        self.assertEqual(self.llm_client.complete.call_count, 3)
+
+    def test_document_changes_clear_cached_answers(self):
+        from unittest.mock import patch
+        from documents.signals import documents_changed
+
+        with patch("chat.services._rag_service", self.svc):
+            self._ask("q1")
+            documents_changed.send(sender=__name__)
+            _, meta = self._ask("q1")
+
+        self.assertNotIn("semantic_cache", meta)
+        self.assertEqual(self.llm_client.complete.call_count, 2)
+
+
+class ChatSessionServiceTests(TestCase):
+    def test_existing_session_is_loaded_with_answer_department(self):
+        """既存セッションの取得時に回答部門もJOINで取得し、表示で追加クエリを出さない"""
+        from django.test import RequestFactory
+        from accounts.models import Department
+        from chat.models import ChatSession
+        from chat.services.session_manager import ChatSessionService
+        from django.contrib.auth.models import AnonymousUser
+
+        dept = Department.objects.create(name="経理", code="finance")
+        chat_session = ChatSession.objects.create(answer_department=dept)
+
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        request.session = {"chat_session_id": chat_session.id}
+
+        with self.assertNumQueries(1):
+            session = ChatSessionService.get_or_create_session(request)
+            self.assertEqual(session.answer_department.name, "経理")
@@ -1,10 +1,11 @@
 from django.contrib import admin
 from django.urls import path, include
-from .views import index,reset_view
+from .views import index,reset_view,result_view
 
 app_name = "chat"
 
 urlpatterns = [
     path('', index, name='index'),
     path('reset/', reset_view, name="reset"),
+    path('result/<str:task_id>/', result_view, name="result"),
 ]
@@ -1,15 +1,22 @@
 from django.shortcuts import render,redirect
-from django.views.decorators.http import require_POST
-from django.http import JsonResponse
+from django.urls import reverse
+from django.views.decorators.http import require_GET, require_POST
+from django.http import JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from .models import ChatMessage
-from .services import rag_service
+from .services import get_rag_service
+from .services.chat_tasks import get_chat_task, submit_chat_task
 from .services.session_manager import ChatSessionService
 RECENT_MESSAGE_LIMIT = 30
 from accounts.models import Department
+from accounts.services.department_cache import get_department_by_code
 
+import json
 import logging
 logger = logging.getLogger(__name__)
 
+CHAT_ERROR_MESSAGE = "申し訳ありません。回答生成中にエラーが発生しました。もう一度お試しください。"
+
 def index(request):
     # 1.セッションを特定(なければ作る)
     session = ChatSessionService.get_or_create_session(request)
@@ -24,74 +31,48 @@ def index(request):
                 return JsonResponse({"error": "empty_message"}, status=400)
             return redirect("chat:index")
         
-        # 2.ユーザメッセージを保存
-        user_msg = ChatMessage.objects.create(
+        # 2.ユーザメッセージを組み立てる(routing_meta が揃ってから1回のINSERTで保存する)
+        user_msg = ChatMessage(
             session=session,
             role=ChatMessage.Role.USER,
             content=user_text,
         )
-        # 3.結果をRAGServiceに「このセッションでチャットして」と依頼
-            # 1.FAISSにクエリを渡して検索を依頼し、LLMも呼び出す
-        try:
-            answer, meta = rag_service.chat(session=session,user_message=user_text)
-        except Exception:
-            logger.exception("rag_service.chat failed")
-            answer = "申し訳ありません。回答生成中にエラーが発生しました。もう一度お試しください。"
-            meta = {}
-        finally:
-            update_session_answer_department_from_meta(session, meta)
-            session.refresh_from_db(fields=["answer_department"])
-
-        # routing_metaをユーザメッセージに保存
-        routing = meta.get("routing")
-        if routing is not None:
-            user_msg.routing_meta = routing
-            user_msg.save(update_fields=["routing_meta"])
-        
-        # 4.ユーザに回答を返す(画面表示)
-        assistant_msg = ChatMessage.objects.create(
-            session=session,
-            role=ChatMessage.Role.ASSISTANT,
-            content=answer,
-        )
+        # ストリーミング要求(fetch + X-Chat-Stream)なら、回答を生成しながら NDJSON で返す
+        if request.headers.get("x-chat-stream") == "1":
+            return _stream_chat_response(session, user_msg, user_text)
 
-        # retrieval_metaを assistant側に保存
-        retrieval = meta.get("retrieval")
-        if retrieval is not None:
-            assistant_msg.retrieval_meta = retrieval
-        
-        # citationsをassistant側に保存
-        assistant_msg.citations = meta.get("citations", []) or []
+        # 非同期要求(X-Chat-Async)なら、回答生成をワーカーに任せて task_id だけ即座に返す
+        if request.headers.get("x-chat-async") == "1":
+            task_id = submit_chat_task(_run_chat_turn, session, user_msg, user_text, owner=session.id)
+            return JsonResponse(
+                {"task_id": task_id, "result_url": reverse("chat:result", args=[task_id])},
+                status=202,
+            )
 
-        # まとめて保存
-        assistant_msg.save(update_fields=["retrieval_meta", "citations"])
+        # 3.結果をRAGServiceに「このセッションでチャットして」と依頼し、4.回答を保存
+        payload = _run_chat_turn(session, user_msg, user_text)
 
         # AJAX（fetch）ならJSONを返す（ページ遷移しない）
         if request.headers.get("x-requested-with") == "XMLHttpRequest":
-            return JsonResponse({
-                "assistant": answer,
-                "meta": meta, # meta肥大化するなら将来はused_document_idsを返すだけ等調整する
-                "answer_department": display_answer_department(session),  # 日本語名
-                # 必要ならコードも返せる
-                # "answer_department_code": session.answer_department.code if session.answer_department else None,
-            })
+            return JsonResponse(payload)
         # POST-redirect-GET パターンで再読み込み時の二重送信を防ぐ
         return redirect("chat:index")
     
+    # 画面表示と出典(最新のassistant)の両方を1クエリで賄う（meta系のJSONFieldは読まない）
     qs = (
         ChatMessage.objects
         .filter(session=session)
+        .only("id", "role", "content", "created_at", "citations")
         .order_by("-created_at")[:RECENT_MESSAGE_LIMIT]
     )
-    messages = list(qs)[::-1] #古い→新しい順に並び替え
-    
-    latest_assistant = (
-        ChatMessage.objects
-        .filter(session=session, role=ChatMessage.Role.ASSISTANT)
-        .order_by("-created_at")
-        .first()
-    )
-    initial_citations = (latest_assistant.citations if latest_assistant else []) or []
+    messages = list(qs)  # 新しい順
+
+    # 出典は最新のassistantのものを使う（新しい順のまま先頭から探す）
+    initial_citations = next(
+        (m.citations for m in messages if m.role == ChatMessage.Role.ASSISTANT),
+        [],
+    ) or []
+    messages.reverse()  # 画面表示用に古い→新しい順へ（コピーを作らずその場で反転）
 
     context = {
         "messages":messages,
@@ -107,7 +88,141 @@ def reset_view(request):
     return redirect("chat:index")
 
 
+@require_GET
+def result_view(request, task_id):
+    """非同期チャット(X-Chat-Async)の結果をポーリングで返す。未完了なら202"""
+    state = get_chat_task(task_id, owner=request.session.get("chat_session_id"))
+    if state is None:
+        return JsonResponse({"error": "not_found"}, status=404)
+    if state["status"] == "pending":
+        return JsonResponse({"status": "pending"}, status=202)
+    if state["status"] == "error":
+        return JsonResponse({"status": "error", "assistant": CHAT_ERROR_MESSAGE})
+    return JsonResponse({"status": "done", **state["result"]})
+
+
+def _run_chat_turn(session, user_msg, user_text) -> dict:
+    """
+    RAGで回答を生成し、ユーザ/アシスタントのメッセージを保存して応答用の dict を返す。
+    通常のPOSTと非同期タスクの両方から呼ばれる。
+    """
+    # FAISSにクエリを渡して検索を依頼し、LLMも呼び出す
+    try:
+        answer, meta = get_rag_service().chat(session=session,user_message=user_text)
+    except Exception:
+        logger.exception("rag_service.chat failed")
+        answer = CHAT_ERROR_MESSAGE
+        meta = {}
+    finally:
+        # 変更時は解決済みの Department をセッションに載せるので、再読み込み(SELECT)は不要
+        update_session_answer_department_from_meta(session, meta)
+
+    # routing_metaを載せてユーザメッセージを保存
+    save_user_message(user_msg, meta)
+
+    # 回答を retrieval_meta / citations と一緒に保存
+    save_assistant_message(session, answer, meta)
+
+    return {
+        "assistant": answer,
+        "meta": _project_meta_for_client(meta),
+        "answer_department": display_answer_department(session),  # 日本語名
+        # 必要ならコードも返せる
+        # "answer_department_code": session.answer_department.code if session.answer_department else None,
+    }
+
+
+# --- ストリーミング応答 ---
+def _stream_chat_response(session, user_msg, user_text) -> StreamingHttpResponse:
+    """
+    回答本文をLLMの生成に合わせて逐次返す。
+    1行1JSON(NDJSON)で {"type": "delta"} を送り、最後に {"type": "done"} で meta 等を送る。
+    """
+    try:
+        answer_stream, meta = get_rag_service().chat_stream(session=session, user_message=user_text)
+    except Exception:
+        logger.exception("rag_service.chat_stream failed")
+        answer_stream, meta = iter([CHAT_ERROR_MESSAGE]), {}
+    finally:
+        # 変更時は解決済みの Department をセッションに載せるので、再読み込み(SELECT)は不要
+        update_session_answer_department_from_meta(session, meta)
+
+    save_user_message(user_msg, meta)
+
+    def events():
+        parts: list[str] = []
+        result_meta = meta
+        try:
+            for delta in answer_stream:
+                parts.append(delta)
+                yield _ndjson({"type": "delta", "text": delta})
+        except Exception:
+            logger.exception("rag_service.chat_stream failed while streaming")
+            parts = [CHAT_ERROR_MESSAGE]
+            result_meta = {}
+            yield _ndjson({"type": "error", "text": CHAT_ERROR_MESSAGE})
+
+        answer = "".join(parts).strip()
+        # 生成し終えた回答を保存してから完了イベントを送る
+        save_assistant_message(session, answer, result_meta)
+        yield _ndjson({
+            "type": "done",
+            "assistant": answer,
+            "meta": _project_meta_for_client(result_meta),
+            "answer_department": display_answer_department(session),
+        })
+
+    response = StreamingHttpResponse(events(), content_type="application/x-ndjson; charset=utf-8")
+    # プロキシでバッファリングされると逐次表示にならないため無効化を依頼する
+    response["X-Accel-Buffering"] = "no"
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def _ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, cls=DjangoJSONEncoder) + "\n"
+
+
 # --- ヘルパー関数群 ---
+def _project_meta_for_client(meta) -> dict:
+    """
+    画面に返す meta を表示に必要な項目だけに絞る。
+    ルーティング/検索の詳細はDB(routing_meta / retrieval_meta)に残っているので、ここでは返さない。
+    """
+    meta = meta or {}
+    routing = meta.get("routing") or {}
+    retrieval = meta.get("retrieval") or {}
+    return {
+        "routing": {"primary_department": routing.get("primary_department")},
+        "retrieval": {
+            "scope_used": retrieval.get("scope_used"),
+            "top_score": retrieval.get("top_score"),
+            "fallback_triggered": retrieval.get("fallback_triggered"),
+            "used_document_ids": meta.get("used_document_ids", []),
+        },
+        "citations": meta.get("citations", []) or [],
+    }
+
+def save_user_message(user_msg, meta) -> ChatMessage:
+    """未保存のユーザメッセージに routing_meta を載せて1回のINSERTで保存する"""
+    routing = (meta or {}).get("routing")
+    if routing is not None:
+        user_msg.routing_meta = routing
+    user_msg.save()
+    return user_msg
+
+def save_assistant_message(session, answer, meta) -> ChatMessage:
+    """アシスタントの回答を retrieval_meta / citations と一緒に保存する"""
+    meta = meta or {}
+    # retrieval_meta / citations を最初から載せて1回のINSERTで保存する
+    return ChatMessage.objects.create(
+        session=session,
+        role=ChatMessage.Role.ASSISTANT,
+        content=answer,
+        retrieval_meta=meta.get("retrieval"),
+        citations=meta.get("citations", []) or [],
+    )
+
 def extract_department_code_from_meta(meta) -> str | None:
     routing = (meta or {}).get("routing")
     if not isinstance(routing, dict):
@@ -117,23 +232,28 @@ def extract_department_code_from_meta(meta) -> str | None:
         return None
     return code
 
-def update_session_answer_department_from_meta(session, meta) -> None:
+def update_session_answer_department_from_meta(session, meta) -> Department | None:
     """
     metaから部門コードを抽出し、解決できた場合のみ session.answer_department を更新する。
     metaに部門が無い / unknown / DBに存在しない場合は更新しない（既存値維持）。
+    戻り値: 新たに設定した Department（変更がなければ None）
     """
     dept_code = extract_department_code_from_meta(meta)
     if not dept_code:
-        return
+        return None
 
-    dept = Department.objects.filter(code=dept_code).first()
+    dept = get_department_by_code(dept_code)
     if not dept:
-        return
+        return None
 
     # 既に同じなら無駄なUPDATEを避ける
-    if getattr(session, "answer_department_id", None) != dept.id:
-        session.answer_department = dept
-        session.save(update_fields=["answer_department"])
+    if getattr(session, "answer_department_id", None) == dept.id:
+        return None
+
+    # 代入でFKキャッシュにも載るので、表示時に改めてDepartmentを引かない
+    session.answer_department = dept
+    session.save(update_fields=["answer_department"])
+    return dept
 
 # 日本語名表示の補助関数
 def display_answer_department(session) -> str | None:
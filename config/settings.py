@@ -6,7 +6,10 @@ import dj_database_url
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-load_dotenv(os.path.join(BASE_DIR, '.env'))
+# .env はローカル開発用。本番(コンテナ)では環境変数を直接渡すので、ファイルがある時だけ読む
+ENV_FILE = BASE_DIR / ".env"
+if ENV_FILE.exists():
+    load_dotenv(ENV_FILE)
 
 # OPENAI_API_KEY
 OPENAI_API_KEY = os.getenv("OPENAI_KEY")
@@ -19,9 +22,54 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 # FAISS のインデックスファイルのパス
 FAISS_INDEX_PATH = BASE_DIR / "var" / "faiss" / "chunks.index"
 
+# 埋め込みベクトルの次元数。未設定(0)なら EmbeddingService.dimension を使う
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "0")) or None
+
+# 新規作成する FAISS index の種類（"flat": 全件走査(float16で保持) / "flat32": 全件走査(float32) /
+# "hnsw": グラフによる近似探索 / "ivfpq": 転置リスト + 直積量子化 / "ivf": 転置リスト(1万件未満は flat) /
+# "sq8": 全件走査(int8で保持)。"ivfpq" / "ivf" / "sq8" は学習が必要なため rebuild_index で作成される）
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+
+# チャット検索用の FAISS index を GPU に載せるか（faiss-gpu 環境のみ有効。なければCPUで動作）
+FAISS_USE_GPU = os.getenv("FAISS_USE_GPU", "0") == "1"
+
+# 同時に来た検索クエリをまとめて FAISS に投げる待ち時間(ミリ秒)。0なら1件ずつ検索する
+FAISS_BATCH_WINDOW_MS = float(os.getenv("FAISS_BATCH_WINDOW_MS", "0"))
+
+# FAISS 検索のOpenMPスレッド数（0ならfaissの既定）。1クエリずつの検索が中心なので、
+# 複数ワーカーで動かす場合は1にしてプロセス並列に任せるとスレッドの取り合いを避けられる
+FAISS_OMP_THREADS = int(os.getenv("FAISS_OMP_THREADS", "0"))
+
+# チャット検索に使うバックエンド（"faiss" または "pgvector"）
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "faiss")
+
+# 意味的キャッシュ（近い質問への回答を再利用）。TTL(秒)を0にすると無効（既定は無効）
+# 文書の更新時に破棄されるのは同じプロセスのキャッシュだけなので、複数ワーカーでは他ワーカーの回答は TTL まで残る
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "0"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+# bulk_create で1回のINSERTに載せる行数。Chunk は1536次元のベクトルを含むので大きくしすぎない
+BULK_CREATE_BATCH_SIZE = int(os.getenv("DJANGO_BULK_CREATE_BATCH_SIZE", "100"))
+
+# 再インデックスで、本文が変わっていないチャンクの保存済み埋め込み(Chunk.embedding)を使い回すか
+# （埋め込みモデルを変えて全件を埋め込み直すときは 0 にする）
+EMBEDDING_REUSE_ENABLED = os.getenv("EMBEDDING_REUSE_ENABLED", "1") == "1"
+
+# PyPDF2 でページ数の多いPDFを抽出するとき、ページ範囲に分けて並列に抽出するプロセス数。
+# 1なら並列化しない（2以上にすると Web ワーカーごとに spawn のプロセスプールを常駐させる）
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", "1"))
+
+# 全件再インデックスで同時に取り込む文書数（スレッド数）。1なら逐次に処理する
+# PyMuPDF による PDF 抽出はプロセス内で1スレッドずつに直列化されるので、並行になるのは主に埋め込みAPIの待ち
+REINDEX_CONCURRENCY = int(os.getenv("REINDEX_CONCURRENCY", "4"))
+
+# アップロード時の取り込み(抽出→埋め込み→FAISS登録)をリクエスト外のワーカースレッドで行うか。
+# 有効ならアップロードはファイル保存と Document 作成だけで返り、結果は監査ログに残る
+DOCUMENT_INGEST_ASYNC = os.getenv("DOCUMENT_INGEST_ASYNC", "0") == "1"
+
 # ファイルのアップロード先
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_ROOT = BASE_DIR / 'media'
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -94,8 +142,6 @@ WSGI_APPLICATION = 'config.wsgi.application'
 #     }
 # }
 
-DEBUG = os.environ.get("DJANGO_DEBUG", "True") == "True"
-
 def strtobool(v: str | None) -> bool:
     return str(v).lower() in ("1", "true", "yes", "on")
 
@@ -107,6 +153,7 @@ if DATABASE_URL:
         "default": dj_database_url.parse(
             DATABASE_URL,
             conn_max_age=int(os.getenv("DB_CONN_MAX_AGE", "600")),
+            conn_health_checks=True,
             ssl_require=strtobool(os.getenv("DB_SSL_REQUIRE", "false")),
         )
     }
@@ -127,7 +174,9 @@ else:
             "PASSWORD": os.getenv("POSTGRES_PASSWORD", ""),
             "HOST": os.getenv("POSTGRES_HOST", "localhost"),
             "PORT": os.getenv("POSTGRES_PORT", "5432"),
-            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "0")),
+            # 本番と同じく接続を使い回す（リクエスト毎の接続確立を避ける）
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "600")),
+            "CONN_HEALTH_CHECKS": True,
         }
     }
 
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save
 
 
 class DocumentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'documents'
+
+    def ready(self):
+        from .models import Document
+        from .signals import document_saved
+
+        # 管理画面で文書の部門を変えたとき、FAISS の部門対応表も付け替える
+        post_save.connect(document_saved, sender=Document, dispatch_uid="document_department_sync")
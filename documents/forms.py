@@ -15,13 +15,12 @@ class MultipleFileField(forms.FileField):
         if data is None:
             return []
 
+        # 親クラスの clean を一度だけ束縛してループ内の属性解決を省く
+        _clean = super().clean
         if isinstance(data, (list, tuple)):
-            cleaned = []
-            for item in data:
-                cleaned.append(super().clean(item, initial))
-            return cleaned
+            return [_clean(item, initial) for item in data]
 
-        return [super().clean(data, initial)]
+        return [_clean(data, initial)]
 
 
 class DocumentUploadForm(forms.Form):
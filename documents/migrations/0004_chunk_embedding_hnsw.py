@@ -0,0 +1,39 @@
+from django.db import migrations
+
+# pgvector の HNSW インデックスを Chunk.embedding(float8[]) のキャスト式に張る。
+# 次元の違う行はキャストできないため、1536次元の行だけを対象にした部分インデックスにする。
+# pgvector が入っていない環境では何もしない（FAISS バックエンドのみで動作する）。
+EMBEDDING_DIMENSION = 1536
+
+
+def create_hnsw_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'vector'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS chunk_embedding_hnsw ON documents_chunk"
+        f" USING hnsw ((embedding::vector({EMBEDDING_DIMENSION})) vector_cosine_ops)"
+        " WITH (m = 16, ef_construction = 200)"
+        f" WHERE array_length(embedding, 1) = {EMBEDDING_DIMENSION}"
+    )
+
+
+def drop_hnsw_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS chunk_embedding_hnsw")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0003_alter_auditlog_action'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_hnsw_index, drop_hnsw_index),
+    ]
@@ -1,7 +1,25 @@
 from abc import ABC, abstractmethod
 from typing import Sequence
+from asgiref.sync import sync_to_async
 from dataclasses import dataclass
 from documents.models import Chunk
+
+# search() が返す Chunk に載せる列（プロンプト組み立て・引用表示・部門フィルタで使うもの）
+# 各バックエンドで .only() に渡し、返す Chunk の形を揃える
+SEARCH_RESULT_FIELDS = (
+    "id",
+    "content",
+    "page",
+    "chunk_index",
+    "document_id",
+    "document__id",
+    "document__title",
+    "document__department_id",
+    "document__department__id",
+    "document__department__code",
+    "document__department__name",
+)
+
 @dataclass
 class SearchResult:
     chunk: Chunk
@@ -23,8 +41,17 @@ class SearchBackend(ABC):
     @abstractmethod
     def search(
         self,
-        query_embedding: list[float],
+        query_embedding: Sequence[float],  # list[float] / float32 の np.ndarray
         top_k: int = 5,
         filters: dict | None = None,  # department_id など
     ) -> list[SearchResult]:
-        """類似チャンク検索"""
\ No newline at end of file
+        """類似チャンク検索"""
+
+    async def asearch(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int = 5,
+        filters: dict | None = None,
+    ) -> list[SearchResult]:
+        """search() の async 版（既定ではスレッドで search() を実行する）"""
+        return await sync_to_async(self.search)(query_embedding, top_k, filters)
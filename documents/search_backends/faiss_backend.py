@@ -1,51 +1,337 @@
+from concurrent.futures import Future
+import asyncio
+import itertools
+from contextlib import contextmanager
+import json
 from pathlib import Path
 from typing import Sequence
+import math
 import os
+import queue
 import threading
+import time
 import faiss
 import numpy as np
 import logging
 
-from .base import SearchBackend, SearchResult
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba は任意。なければ numpy + faiss.normalize_L2 で同じ結果を作る
+    njit = None
+
+from .base import SEARCH_RESULT_FIELDS, SearchBackend, SearchResult
+from accounts.services.department_cache import get_department_by_code
 from documents.models import Chunk
 from documents.services.embedding_service import EmbeddingService
 
 logger = logging.getLogger(__name__)
 
+# GPU のメモリプール等はプロセスで1つを共有する（faiss-gpu 環境でのみ使用）
+_gpu_resources = None
+_gpu_resources_lock = threading.Lock()
+
+
+def gpu_available() -> bool:
+    """faiss-gpu がインストールされ、GPUが1枚以上見えるか"""
+    return hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+
+
+def _get_gpu_resources():
+    global _gpu_resources
+    if _gpu_resources is None:
+        with _gpu_resources_lock:
+            if _gpu_resources is None:
+                _gpu_resources = faiss.StandardGpuResources()
+    return _gpu_resources
+
+
+def _is_gpu_index(index: faiss.Index) -> bool:
+    gpu_index_cls = getattr(faiss, "GpuIndex", None)
+    if gpu_index_cls is None:
+        return False
+    base = faiss.downcast_index(index.index) if hasattr(index, "index") else faiss.downcast_index(index)
+    return isinstance(base, gpu_index_cls)
+
+
+# SIMD 用バッファの先頭をそろえる境界（AVX2 は 32 バイト、AVX-512 とキャッシュラインは 64 バイト）
+VECTOR_ALIGNMENT = 64
+
+
+def _aligned_empty(shape: tuple[int, ...], dtype="float32") -> np.ndarray:
+    """
+    先頭を VECTOR_ALIGNMENT バイト境界にそろえた未初期化配列を返す。
+    numpy の既定は 16 バイト境界までしか保証しないため、少し多めに確保してずらす。
+    （行の長さが 64 バイトの倍数なら、全行の先頭がそろう。1536次元 float32 は 6144 バイト）
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + VECTOR_ALIGNMENT, dtype=np.uint8)
+    offset = -raw.ctypes.data % VECTOR_ALIGNMENT
+    return raw[offset : offset + nbytes].view(dtype).reshape(shape)
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _normalize_to_f32(src, dst):
+        """src(n, d) を1回だけ読み、L2正規化した float32 を dst に書く（変換と正規化を1パスで行う）"""
+        for i in prange(src.shape[0]):
+            s = 0.0
+            for j in range(src.shape[1]):
+                v = src[i, j]
+                s += v * v
+            inv = 1.0 / math.sqrt(s + 1e-12)
+            for j in range(src.shape[1]):
+                dst[i, j] = np.float32(src[i, j] * inv)
+
+else:
+    _normalize_to_f32 = None
+
+
+_tmp_counter = itertools.count()
+
+
+def _tmp_path_for(final_path: str) -> str:
+    """
+    tmp→replace 用の一時ファイル名。同じ index を複数プロセス/スレッドが同時に保存しても
+    互いの書きかけの tmp を上書き・replace しないよう、pid とスレッドIDを付ける。
+    rebuild は書き出した tmp を replace まで持ち越すので、同じスレッド内でも重ならないよう連番も付ける。
+    """
+    return f"{final_path}.tmp.{os.getpid()}.{threading.get_ident()}.{next(_tmp_counter)}"
+
+
+class _RWLock:
+    """
+    読み取りは何スレッドでも同時に、書き込みは排他で行うロック。
+    書き込み待ちがいる間は新しい読み取りを待たせる（更新が検索に埋もれて進まないのを防ぐ）。
+    書き込み中のスレッドは読み取り・書き込みとも再入できる。
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer: int | None = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_locked(self):
+        if self._writer == threading.get_ident():
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_locked(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+            else:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+                self._write_depth = 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class _SearchCoalescer:
+    """
+    複数スレッドから同時に来た1件ずつのクエリを (B, d) にまとめて1回の index.search で処理する。
+    flat index の全件走査は1回で B 件分まかなえるので、同時アクセス時の走査回数が減る。
+    """
+    MAX_BATCH = 32
+
+    def __init__(self, search_fn, *, max_wait: float) -> None:
+        self._search_fn = search_fn  # (xq: (B, d), k) -> (D, I)
+        self._max_wait = max_wait
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        threading.Thread(target=self._run, name="faiss-search-coalescer", daemon=True).start()
+
+    def search(self, xq: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        future: Future = Future()
+        self._queue.put((xq, k, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self.MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            k = max(item[1] for item in batch)
+            try:
+                D, I = self._search_fn(np.vstack([item[0] for item in batch]), k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            # 行ごとに呼び出し元へ返す（k が小さい呼び出しには先頭だけ渡す）
+            for row, (_, row_k, future) in enumerate(batch):
+                future.set_result((D[row : row + 1, :row_k], I[row : row + 1, :row_k]))
+
 
 class FaissSearchBackend(SearchBackend):
+    # index_type="hnsw" のときのグラフ構築/探索パラメータ
+    HNSW_M = 32
+    HNSW_EF_CONSTRUCTION = 40
+    HNSW_EF_SEARCH_MIN = 16
+    # HNSW は remove_ids 非対応のため、削除・再登録で無効になったエントリの割合がこれを超えたら詰め直す
+    # （IVF も IDMap 越しの remove_ids では内部IDがずれるため、同じ扱いにする）
+    HNSW_COMPACT_RATIO = 0.2
+
+    # index_type="ivfpq" のときのパラメータ
+    IVF_NLIST = 1024
+    IVF_NPROBE = 16
+    IVF_TRAIN_SAMPLE = 100_000
+    # k-means が安定するのに必要な、セル1つあたりの学習ベクトル数
+    IVF_MIN_POINTS_PER_LIST = 39
+    PQ_M = 32
+    # PQ のコードブック(8bit = 256セントロイド)の学習に最低限必要なベクトル数
+    PQ_MIN_TRAIN = 256
+    # セル1つあたりの平均件数が、前回 rebuild 時のこの倍率を超えたら学習し直す（それまでは追加だけで更新する）
+    IVF_REBUILD_GROWTH = 1.5
+
+    # index_type="ivf" のときのパラメータ。件数がこれ未満なら学習せず flat のまま使う（全件走査で十分速い）
+    IVF_FLAT_MIN_VECTORS = 10_000
+    IVF_FLAT_MIN_NLIST = 16
+    IVF_FLAT_MIN_NPROBE = 8
+
+    # 学習してからでないとベクトルを追加できない index 種別（rebuild_index で作られるまでは flat で動く）
+    TRAINED_INDEX_TYPES = ("ivfpq", "ivf", "sq8")
+
+    # search() がファイル更新を確認する間隔（秒）。この間は stat を呼ばない
+    RELOAD_CHECK_INTERVAL = 0.5
+
     def __init__(
         self,
         index_path: str | Path,
         embedding_service: EmbeddingService | None = None,
         dimension: int | None = None,
+        index_type: str | None = None,
+        use_gpu: bool = False,
+        batch_window_ms: float = 0,
     ) -> None:
+        """
+        index_type: 新規作成する index の種類。"flat"(全件走査・float16) / "flat32"(全件走査・float32) /
+        "hnsw"(近似探索) / "ivfpq"(量子化+近似探索) / "ivf"(転置リスト・ベクトルは量子化しない) /
+        "sq8"(全件走査・次元ごとに int8 へ量子化)。
+        省略時は settings.FAISS_INDEX_TYPE。既存ファイルがあればその種類がそのまま使われる。
+        "ivfpq" / "ivf" / "sq8" は学習済みでないと追加できないため、rebuild_index で学習するまでは flat で動く。
+        use_gpu: 検索用の index を GPU に載せる（faiss-gpu と GPU がある場合のみ。なければCPUのまま）。
+        GPU上の flat index は remove_ids 等の更新に対応しないため、検索専用のインスタンスで使うこと。
+        batch_window_ms: 0より大きければ、この時間内に同時に来たクエリを1回の index.search にまとめる。
+        """
         self.index_path = Path(index_path)
+        self._index_path_str = str(self.index_path)
+        self._last_stat_check = 0.0
         self.embedding_service = embedding_service or EmbeddingService()
+        self.index_type = index_type or getattr(settings, "FAISS_INDEX_TYPE", "flat")
+        self.use_gpu = use_gpu and gpu_available()
+        if use_gpu and not self.use_gpu:
+            logger.warning("faiss:GPU requested but not available, using CPU index")
 
         if dimension is None:
-            sample_vec = self.embedding_service.embed_chunks(["__probe__"])[0]
-            dimension = len(sample_vec)
+            # settings / 埋め込みサービスで分かればそれを使い、分からないときだけ試しに1件埋め込む
+            dimension = (
+                getattr(settings, "EMBEDDING_DIM", None)
+                or getattr(self.embedding_service, "dimension", None)
+                or len(self.embedding_service.embed_chunks(["__probe__"])[0])
+            )
 
         self.dimension = dimension
-        self._lock = threading.RLock()
+        # 検索(index.search)は読み取りロックで並行に、index の差し替え・更新は書き込みロックで排他に行う
+        self._lock = _RWLock()
+
+        # chunk_id → department_id の対応表（index の隣に保存）。部門フィルタを FAISS 側で掛けるのに使う
+        self._chunk_departments: dict[int, int] = self._read_departments_file()
+        # department_id → (IDSelector, 件数)。対応表が変わるたびに作り直す
+        self._department_selectors: dict[int, tuple] = {}
+        # 対応表が index の全IDを網羅しているか（index を直接操作された場合は網羅しない）
+        self._departments_coverage: tuple | None = None
+        # HNSW / IVF で削除済みのID（墓標）と、削除・再登録で無効になったエントリ数（index の隣に保存）
+        self._tombstones, self._stale_entries = self._read_tombstones_file()
 
-        self.index = self._load_or_create_index()
+        self.index = self._to_serving_index(self._load_or_create_index())
         self._index_mtime = self._get_file_mtime_or_none()
 
+        # 直近クエリのFAISS検索結果。同一クエリで部門スコープだけ変えた検索
+        # (primary → secondary → 全社)は、1回のindex走査結果をフィルタし直して使い回す
+        self._index_version = 0
+        self._last_search: tuple | None = None
+        # 直近クエリの候補 Chunk（部門で絞らずに取得）。スコープ違いの検索はDBに行かずPython側で絞り込む
+        self._last_candidates: tuple | None = None
+
+        # search() のクエリ用 (1, d) バッファ。スレッドごとに1つを使い回し、クエリ毎の配列確保をなくす
+        self._xq_tls = threading.local()
+
+        self._coalescer = (
+            _SearchCoalescer(self._index_search_locked, max_wait=batch_window_ms / 1000.0)
+            if batch_window_ms > 0
+            else None
+        )
+
     # --- index file helpers ---
 
     def _get_file_mtime_or_none(self) -> float | None:
+        # exists() + stat() の2回ではなく、os.stat 1回で済ませる
         try:
-            if self.index_path.exists():
-                return self.index_path.stat().st_mtime
+            return os.stat(self._index_path_str).st_mtime
         except OSError:
             return None
-        return None
+
+    def _reload_if_changed(self) -> None:
+        """
+        search 用のファイル追従。mtime の確認はロックなしで行い、
+        変わっていたときだけ書き込みロックを取ってリロードする（普段の検索は互いを止めない）。
+        確認は RELOAD_CHECK_INTERVAL 秒に1回だけ行い、検索ごとの stat を省く。
+        """
+        now = time.monotonic()
+        if now - self._last_stat_check < self.RELOAD_CHECK_INTERVAL:
+            return
+        self._last_stat_check = now
+
+        current_mtime = self._get_file_mtime_or_none()
+        if current_mtime is None or (self._index_mtime is not None and current_mtime <= self._index_mtime):
+            return
+        with self._lock.write_locked():
+            self._maybe_reload_index()
 
     def _maybe_reload_index(self) -> None:
         """
-        index ファイルが更新されていれば reload する。
+        index ファイルが更新されていれば reload する（呼び出し側で書き込みロック取得済みの前提）。
         reload 失敗時は既存 index を維持（サービス継続優先）。
         """
         current_mtime = self._get_file_mtime_or_none()
@@ -57,14 +343,17 @@ class FaissSearchBackend(SearchBackend):
             return
 
         try:
-            new_index = faiss.read_index(str(self.index_path))
+            new_index = self._read_index_file()
             # dimension の整合性チェック
             d = getattr(new_index, "d", None)
             if d is not None and int(d) != int(self.dimension):
                 raise RuntimeError(f"FAISS dimension mismatch: file_d={d} expected={self.dimension}")
 
-            self.index = new_index  # type: ignore[assignment]
+            self.index = self._to_serving_index(new_index)  # type: ignore[assignment]
+            self._set_chunk_departments(self._read_departments_file())
+            self._tombstones, self._stale_entries = self._read_tombstones_file()
             self._index_mtime = current_mtime
+            self._index_version += 1
             logger.warning(
                 "faiss:index reloaded path=%s ntotal=%d mtime=%.3f",
                 str(self.index_path), int(self.index.ntotal), current_mtime
@@ -75,64 +364,491 @@ class FaissSearchBackend(SearchBackend):
     # --- index create/load/save ---
 
     def _create_empty_index(self) -> faiss.IndexIDMap2:
-        base_index = faiss.IndexFlatIP(self.dimension)
+        if self.index_type == "hnsw":
+            # 内積(正規化済みなのでcosine)のまま、全件走査ではなくグラフ探索で近傍を引く
+            base_index = faiss.IndexHNSWFlat(self.dimension, self.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            base_index.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+        elif self.index_type == "flat32" or self.use_gpu:
+            # GPU に載せられる flat は float32 の IndexFlatIP だけ
+            base_index = faiss.IndexFlatIP(self.dimension)
+        else:
+            # 正規化済みベクトルの cosine には float32 の精度は要らないので float16 で保持する
+            # （メモリと全件走査で読む量が半分になる。add/search は float32 のまま渡せる）
+            # "ivfpq" / "ivf" / "sq8" も学習前はベクトルを追加できないので、rebuild_index で作り直すまでは flat を使う
+            base_index = faiss.IndexScalarQuantizer(
+                self.dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+            )
         return faiss.IndexIDMap2(base_index)
 
+    def _create_trained_index(self, sample: np.ndarray, total: int | None = None) -> faiss.IndexIDMap2:
+        """
+        sample で学習した index を作る（index_type="ivfpq" / "ivf" / "sq8" 用）。
+        ivfpq: ベクトルは m バイトに量子化され、検索時は nprobe 個のセルだけを走査する。
+        学習に足りる件数がない場合は flat のまま作る。
+        ivf: セル数は登録する総件数 total から 4√N で決め、検索は nprobe 個のセルだけを走査する。
+        total が IVF_FLAT_MIN_VECTORS 未満なら flat のまま作る。
+        sq8: 次元ごとの値域を sample から決めて 1 バイトに量子化する（fp16 の半分、float32 の 1/4 のサイズ）。
+        """
+        n = len(sample)
+        if self.index_type == "ivf":
+            total = max(total or 0, n)
+            # k-means が安定するよう、セル数は学習件数からも抑える
+            nlist = min(max(self.IVF_FLAT_MIN_NLIST, int(4 * math.sqrt(total))), n // self.IVF_MIN_POINTS_PER_LIST)
+            if total < self.IVF_FLAT_MIN_VECTORS or nlist < self.IVF_FLAT_MIN_NLIST:
+                logger.warning("faiss:ivf training skipped (n=%d total=%d), using flat index", n, total)
+                return self._create_empty_index()
+            quantizer = faiss.IndexFlatIP(self.dimension)
+            base_index = faiss.IndexIVFFlat(quantizer, self.dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+            base_index.train(sample)
+            # IndexIVFFlat は quantizer を所有しないので、Python 側の参照が切れても消えないよう持たせる
+            base_index.own_fields = True
+            quantizer.this.disown()
+            base_index.nprobe = max(self.IVF_FLAT_MIN_NPROBE, nlist // 32)
+            logger.warning("faiss:ivf trained n=%d total=%d nlist=%d nprobe=%d", n, total, nlist, base_index.nprobe)
+            return faiss.IndexIDMap2(base_index)
+        if self.index_type == "sq8":
+            base_index = faiss.IndexScalarQuantizer(
+                self.dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+            base_index.train(sample)
+            logger.warning("faiss:sq8 trained n=%d", n)
+            return faiss.IndexIDMap2(base_index)
+
+        nlist = min(self.IVF_NLIST, n // self.IVF_MIN_POINTS_PER_LIST)
+        if n < self.PQ_MIN_TRAIN or nlist < 1:
+            logger.warning("faiss:ivfpq training skipped (too few vectors n=%d), using flat index", n)
+            return self._create_empty_index()
+
+        pq_m = math.gcd(self.dimension, self.PQ_M)  # PQ の分割数は次元を割り切る必要がある
+        base_index = faiss.index_factory(self.dimension, f"IVF{nlist},PQ{pq_m}", faiss.METRIC_INNER_PRODUCT)
+        base_index.train(sample)
+        base_index.nprobe = self.IVF_NPROBE
+        logger.warning("faiss:ivfpq trained n=%d nlist=%d m=%d", n, nlist, pq_m)
+        return faiss.IndexIDMap2(base_index)
+
+    def _hnsw_base(self, index: faiss.Index | None = None):
+        """IDMap の中身が HNSW ならそれを返す（flat なら None）"""
+        index = index if index is not None else self.index
+        base = faiss.downcast_index(index.index) if hasattr(index, "index") else index
+        return base if isinstance(base, faiss.IndexHNSW) else None
+
+    def _ivf_base(self, index: faiss.Index | None = None):
+        """IDMap の中身が IVF ならそれを返す"""
+        index = index if index is not None else self.index
+        base = faiss.downcast_index(index.index) if hasattr(index, "index") else index
+        return base if isinstance(base, faiss.IndexIVF) else None
+
+    def _is_trained_as_configured(self) -> bool:
+        """index_type が学習の要る種別なら、学習済みのその種別の index になっているか"""
+        if self.index_type == "ivfpq":
+            return self._ivf_base() is not None
+        if self.index_type == "ivf":
+            # 件数が IVF_FLAT_MIN_VECTORS に届くまでは flat のままが正しい状態
+            return self._ivf_base() is not None or int(self.index.ntotal) < self.IVF_FLAT_MIN_VECTORS
+        if self.index_type == "sq8":
+            base = faiss.downcast_index(self.index.index) if hasattr(self.index, "index") else self.index
+            return isinstance(base, faiss.IndexScalarQuantizer) and base.sq.qtype == faiss.ScalarQuantizer.QT_8bit
+        return True
+
+    def _is_append_only(self) -> bool:
+        """remove_ids が使えず、削除を墓標・再登録を重複として扱う index か（HNSW / IVF）"""
+        return self._hnsw_base() is not None or self._ivf_base() is not None
+
+    def _count_indexed(self, ids_np: np.ndarray) -> int:
+        """ids_np のうち index に登録済み(かつ墓標でない)IDの数"""
+        indexed = faiss.vector_to_array(self.index.id_map)
+        live = [i for i in ids_np[np.isin(ids_np, indexed)].tolist() if i not in self._tombstones]
+        return len(live)
+
+    def _maybe_compact_index(self) -> None:
+        """
+        HNSW / IVF の無効エントリが増えたら、保持しているベクトルから index を作り直す（呼び出し側でlock取得済みの前提）。
+        埋め込みAPIは呼ばない。同じIDは最後に登録したものだけを残す。
+        """
+        ntotal = int(self.index.ntotal)
+        if ntotal == 0 or self._stale_entries <= ntotal * self.HNSW_COMPACT_RATIO:
+            return
+
+        ids = faiss.vector_to_array(self.index.id_map)
+        ivf = self._ivf_base()
+        if ivf is not None:
+            # IVF-PQ は復元(量子化後の近似ベクトル)に direct map が要る。作り直しても学習結果は引き継ぐ
+            ivf.make_direct_map()
+            vectors = ivf.reconstruct_n(0, ntotal)
+            new_base = faiss.clone_index(ivf)
+            new_base.reset()
+            new_index = faiss.IndexIDMap2(new_base)
+        else:
+            vectors = self._hnsw_base().reconstruct_n(0, ntotal)
+            new_index = self._create_empty_index()
+        _, first_in_reversed = np.unique(ids[::-1], return_index=True)
+        keep = np.sort(len(ids) - 1 - first_in_reversed)
+        if self._tombstones:
+            keep = keep[~np.isin(ids[keep], np.fromiter(self._tombstones, dtype="int64"))]
+
+        if len(keep):
+            new_index.add_with_ids(vectors[keep], ids[keep])
+        logger.warning("faiss:compact_index ntotal=%d -> %d", ntotal, int(new_index.ntotal))
+
+        self.index = new_index  # type: ignore[assignment]
+        self._tombstones.clear()
+        self._stale_entries = 0
+
+    def _read_index_file(self) -> faiss.Index:
+        """
+        index ファイルを mmap(読み取り専用)で開く。
+        ベクトル本体はページキャッシュから参照されるため、同じファイルを開くワーカー間でメモリを共有できる。
+        保存は tmp→replace なので、開いている旧ファイルが書き換わることはない。
+        （add/remove 時は faiss がプロセス内にコピーしてから変更する）
+        """
+        path = str(self.index_path)
+        try:
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            if self._ivf_base(index) is not None:
+                # mmap で開いた IVF は書き戻すと壊れたファイルになるため通常読み込みにする
+                # （IVF-PQ はコードが小さいので mmap の恩恵も小さい）
+                return faiss.read_index(path)
+            return index
+        except Exception:
+            # mmap 非対応の faiss / index 種別なら通常読み込みにフォールバック
+            logger.warning("faiss:mmap read failed, falling back to regular read path=%s", path)
+            return faiss.read_index(path)
+
+    def _to_serving_index(self, index: faiss.Index) -> faiss.Index:
+        """use_gpu なら検索用に GPU へ載せ替える。非対応の index 種別(HNSW等)は CPU のまま使う"""
+        if not self.use_gpu:
+            return index
+        try:
+            return faiss.index_cpu_to_gpu(_get_gpu_resources(), 0, index)
+        except Exception:
+            logger.exception("faiss:index_cpu_to_gpu failed, keeping CPU index")
+            return index
+
+    def _reopen_saved_index(self, fallback: faiss.Index | None = None) -> None:
+        """
+        保存直後のファイルを mmap で開き直して self.index を差し替える（呼び出し側でlock取得済みの前提）。
+        更新のためにプロセス内へコピーされたベクトルを手放し、他ワーカーとページキャッシュを共有する状態に戻す。
+        開き直せなかった場合は、保存したのと同じ内容のメモリ上の index(fallback)を使い続ける。
+        """
+        try:
+            self.index = self._to_serving_index(self._read_index_file())  # type: ignore[assignment]
+        except Exception:
+            logger.exception("faiss:reopen after save failed path=%s", str(self.index_path))
+            if fallback is not None:
+                self.index = self._to_serving_index(fallback)  # type: ignore[assignment]
+
+    # --- department sidecar ---
+
+    @property
+    def departments_path(self) -> Path:
+        return self.index_path.with_name(self.index_path.name + ".departments.npy")
+
+    def _read_departments_file(self) -> dict[int, int]:
+        """
+        chunk_id → department_id の対応表を読む。(2, n) の int64 配列で保存している。
+        ファイルがない / 壊れている場合は空（部門フィルタはDB側で掛ける従来の経路になる）。
+        """
+        try:
+            pairs = np.load(self.departments_path, allow_pickle=False)
+            return dict(zip(pairs[0].tolist(), pairs[1].tolist()))
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            logger.exception("faiss:departments read failed path=%s", str(self.departments_path))
+            return {}
+
+    def _write_departments_tmp(self, departments: dict[int, int]) -> str:
+        """対応表を一時ファイルに書き出してそのパスを返す（replace は呼び出し側で行う）"""
+        pairs = np.empty((2, len(departments)), dtype="int64")
+        pairs[0] = np.fromiter(departments.keys(), dtype="int64", count=len(departments))
+        pairs[1] = np.fromiter(departments.values(), dtype="int64", count=len(departments))
+
+        tmp_path = _tmp_path_for(str(self.departments_path))
+        with open(tmp_path, "wb") as f:
+            np.save(f, pairs, allow_pickle=False)
+        return tmp_path
+
+    def _set_chunk_departments(self, departments: dict[int, int]) -> None:
+        """対応表を差し替え、部門ごとの IDSelector を捨てる（呼び出し側でlock取得済みの前提）"""
+        self._chunk_departments = departments
+        self._department_selectors = {}
+        self._departments_coverage = None
+
+    def _departments_cover_index(self) -> bool:
+        """
+        index 内の有効なIDがすべて対応表に載っているか（呼び出し側でlock取得済みの前提）。
+        index の状態が変わったときだけ id_map を走査し直す。
+        """
+        key = (id(self.index), int(self.index.ntotal), self._index_version, len(self._chunk_departments))
+        if self._departments_coverage is not None and self._departments_coverage[0] == key:
+            return self._departments_coverage[1]
+
+        ids = faiss.vector_to_array(self.index.id_map)
+        if self._tombstones:
+            ids = ids[~np.isin(ids, np.fromiter(self._tombstones, dtype="int64"))]
+        known = np.fromiter(self._chunk_departments.keys(), dtype="int64", count=len(self._chunk_departments))
+        covered = bool(np.isin(ids, known).all())
+        self._departments_coverage = (key, covered)
+        return covered
+
+    def _department_selector(self, department_id: int) -> tuple:
+        """部門に属する chunk_id だけを通す IDSelector と、その件数（呼び出し側でlock取得済みの前提）"""
+        cached = self._department_selectors.get(department_id)
+        if cached is None:
+            allowed_ids = np.fromiter(
+                (cid for cid, dep in self._chunk_departments.items() if dep == department_id), dtype="int64"
+            )
+            cached = (faiss.IDSelectorBatch(allowed_ids), len(allowed_ids))
+            self._department_selectors[department_id] = cached
+        return cached
+
+    # --- tombstones sidecar ---
+
+    @property
+    def tombstones_path(self) -> Path:
+        return self.index_path.with_name(self.index_path.name + ".tombstones.npz")
+
+    def _read_tombstones_file(self) -> tuple[set[int], int]:
+        """
+        墓標のIDと無効エントリ数を読む。別インスタンス・別ワーカー・再起動後も削除済みIDを除外し、
+        詰め直しの判定を続けられるようにする。ファイルがない / 壊れている場合は (空, 0)。
+        """
+        try:
+            with np.load(self.tombstones_path, allow_pickle=False) as data:
+                return set(data["ids"].tolist()), int(data["stale_entries"])
+        except FileNotFoundError:
+            return set(), 0
+        except Exception:
+            logger.exception("faiss:tombstones read failed path=%s", str(self.tombstones_path))
+            return set(), 0
+
+    def _write_tombstones_tmp(self, tombstones: set[int], stale_entries: int) -> str:
+        """墓標を一時ファイルに書き出してそのパスを返す（replace は呼び出し側で行う）"""
+        tmp_path = _tmp_path_for(str(self.tombstones_path))
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                ids=np.fromiter(tombstones, dtype="int64", count=len(tombstones)),
+                stale_entries=np.int64(stale_entries),
+            )
+        return tmp_path
+
+    # --- rebuild stats sidecar ---
+
+    @property
+    def meta_path(self) -> Path:
+        return self.index_path.with_name(self.index_path.name + ".meta.json")
+
+    def _read_meta_file(self) -> dict | None:
+        """前回 rebuild 時の統計を読む。ファイルがない / 壊れている場合は None"""
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception("faiss:meta read failed path=%s", str(self.meta_path))
+            return None
+
+    def _write_meta_file(self, meta: dict) -> None:
+        final_path = str(self.meta_path)
+        tmp_path = _tmp_path_for(final_path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, final_path)
+
+    def _ivf_avg_list_size(self, index: faiss.Index | None = None) -> float | None:
+        """IVF のセルごとの件数の平均（IVF でなければ None）"""
+        ivf = self._ivf_base(index)
+        if ivf is None:
+            return None
+        invlists = ivf.invlists
+        sizes = np.fromiter((invlists.list_size(i) for i in range(ivf.nlist)), dtype="int64", count=ivf.nlist)
+        return float(sizes.mean())
+
+    def needs_rebuild(self) -> bool:
+        """
+        差分更新(index_chunks / delete_chunks)では足りず、rebuild_index で作り直すべきか。
+        rebuild の記録がない、ivfpq / ivf / sq8 なのに未学習、または IVF のセルが前回 rebuild 時より
+        IVF_REBUILD_GROWTH 倍以上に膨らんでいる（学習時の分布からずれて探索が粗くなる）場合に True。
+        """
+        meta = self._read_meta_file()
+        if meta is None:
+            return True
+        with self._lock.write_locked():
+            self._maybe_reload_index()
+            if not self._is_trained_as_configured():
+                return True
+            current = self._ivf_avg_list_size()
+        if current is None:
+            return False
+        baseline = meta.get("avg_list_size")
+        if not baseline:
+            return True
+        return current > baseline * self.IVF_REBUILD_GROWTH
+
     def _load_or_create_index(self) -> faiss.IndexIDMap2:
         if self.index_path.exists():
-            index = faiss.read_index(str(self.index_path))
+            index = self._read_index_file()
             return index  # type: ignore[return-value]
         index = self._create_empty_index()
         self._save_index(index)
         return index
 
-    def _save_index(self, index: faiss.Index | None = None) -> None:
+    def _write_index_tmp(
+        self, index: faiss.Index, departments: dict[int, int], tombstones: set[int], stale_entries: int
+    ) -> tuple[str, str, str]:
         """
-        atomic write（tmp→replace）
-        読み手が書き込み途中のファイルを掴まないようにする。
+        index と部門の対応表・墓標を一時ファイルに書き出し、(index, 対応表, 墓標) の tmp を返す。
+        まだ replace しないので、書き出している間も self.index / 本番のファイル / mtime は変わらない。
         """
-        index = index or self.index
+        if _is_gpu_index(index):
+            # GPU上の index はそのまま書き出せないので CPU にコピーしてから保存する
+            index = faiss.index_gpu_to_cpu(index)
         self.index_path.parent.mkdir(parents=True, exist_ok=True)
 
-        final_path = str(self.index_path)
-        tmp_path = final_path + ".tmp"
+        departments_tmp = self._write_departments_tmp(departments)
+        tombstones_tmp = self._write_tombstones_tmp(tombstones, stale_entries)
+        tmp_path = _tmp_path_for(str(self.index_path))
 
-        faiss.write_index(index, tmp_path)
-        os.replace(tmp_path, final_path)
+        # write_index は fsync しない（整合性は同じディレクトリ内の tmp→replace で担保している）。
+        # BufferedIOWriter や serialize_index でメモリに溜めてから書く方法も試したが、
+        # faiss はベクトル配列を大きな塊で書くため、直接ファイルに書くこの形が最も速かった
+        try:
+            faiss.write_index(index, tmp_path)
+        except BaseException:
+            self._discard_tmp_files((tmp_path, departments_tmp, tombstones_tmp))
+            raise
+        return tmp_path, departments_tmp, tombstones_tmp
 
-        # 保存後のmtimeを保持
+    def _replace_index_files(self, tmp_paths: tuple[str, str, str]) -> None:
+        """
+        _write_index_tmp で書いた一時ファイルを本番のパスへ replace し、保存後の mtime を保持する。
+        対応表と墓標を先に差し替えるので、index の mtime 変化を見てリロードした側は新しい対応表・墓標を読める。
+        """
+        tmp_path, departments_tmp, tombstones_tmp = tmp_paths
+        os.replace(departments_tmp, str(self.departments_path))
+        os.replace(tombstones_tmp, str(self.tombstones_path))
+        os.replace(tmp_path, self._index_path_str)
         self._index_mtime = self._get_file_mtime_or_none()
 
+    @staticmethod
+    def _discard_tmp_files(tmp_paths: tuple[str, ...]) -> None:
+        # 書きかけ / 使わなかった tmp を残さない（ディスクを圧迫し、次回以降の保存とも無関係なため）
+        for path in tmp_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _save_index(self, index: faiss.Index | None = None, departments: dict[int, int] | None = None) -> None:
+        """
+        atomic write（tmp→replace）
+        読み手が書き込み途中のファイルを掴まないようにする。
+        """
+        tmp_paths = self._write_index_tmp(
+            index or self.index,
+            self._chunk_departments if departments is None else departments,
+            self._tombstones,
+            self._stale_entries,
+        )
+        try:
+            self._replace_index_files(tmp_paths)
+        except BaseException:
+            self._discard_tmp_files(tmp_paths)
+            raise
+
     # --- index mutate ops ---
 
+    def _to_vectors(self, embeddings) -> np.ndarray:
+        """
+        埋め込みを (n, d) の float32 配列にする。
+        書き込み先を先に確保して1行ずつ埋めるので、中間の一時配列を作らない（float32 の連続配列ならそのまま使う）。
+        """
+        if isinstance(embeddings, np.ndarray) and embeddings.dtype == np.float32 and embeddings.flags.c_contiguous:
+            return embeddings
+        vectors = _aligned_empty((len(embeddings), self.dimension))
+        for i, embedding in enumerate(embeddings):
+            vectors[i] = embedding
+        return vectors
+
+    def _normalized_vectors(self, embeddings) -> np.ndarray:
+        """埋め込みを L2 正規化済みの (n, d) float32 配列にする。numba があれば変換と正規化を1パスで行う"""
+        if isinstance(embeddings, np.ndarray) and embeddings.dtype == np.float32 and embeddings.flags.c_contiguous:
+            # EmbeddingService.embed_chunks が返す float32 配列は、そのまま正規化して使う（コピーしない）
+            faiss.normalize_L2(embeddings)
+            return embeddings
+        if _normalize_to_f32 is None or len(embeddings) == 0:
+            vectors = self._to_vectors(embeddings)
+            faiss.normalize_L2(vectors)
+            return vectors
+        src = embeddings if isinstance(embeddings, np.ndarray) else np.asarray(embeddings, dtype="float64")
+        vectors = _aligned_empty(src.shape)
+        _normalize_to_f32(src, vectors)
+        return vectors
+
+    def _chunk_vectors(self, texts: Sequence[str], stored: Sequence[list[float] | None]) -> np.ndarray:
+        """
+        Chunk.embedding に保存済みのベクトルを L2 正規化して (n, d) float32 配列にする。
+        保存されていない（次元が合わない）行だけ埋め込みAPIで埋め込む。
+        """
+        missing = [i for i, embedding in enumerate(stored) if embedding is None or len(embedding) != self.dimension]
+        if not missing:
+            return self._normalized_vectors(stored)
+        if len(missing) == len(stored):
+            return self._normalized_vectors(self.embedding_service.embed_chunks(list(texts)))
+        vectors = _aligned_empty((len(stored), self.dimension))
+        vectors[missing] = self.embedding_service.embed_chunks([texts[i] for i in missing])
+        missing_set = set(missing)
+        for i, embedding in enumerate(stored):
+            if i not in missing_set:
+                vectors[i] = embedding
+        faiss.normalize_L2(vectors)
+        return vectors
+
     def index_chunks(self, chunk_ids: Sequence[int]) -> None:
         chunk_ids = list(chunk_ids)
         if not chunk_ids:
             return
 
-        chunks = list(Chunk.objects.filter(id__in=chunk_ids).select_related("document"))
+        # 取り込み時に保存した埋め込みを使う（本文は埋め込みが保存されていない行のためだけに読む）
+        chunks = list(
+            Chunk.objects.filter(id__in=chunk_ids)
+            .select_related("document")
+            .only("id", "content", "embedding", "document__department_id")
+        )
         if not chunks:
             return
 
-        texts = [c.content for c in chunks]
-        ids_np = np.array([c.id for c in chunks], dtype="int64")
+        ids_np = np.fromiter((c.id for c in chunks), dtype="int64", count=len(chunks))
 
-        embeddings = self.embedding_service.embed_chunks(texts)
-        vectors = np.array(embeddings, dtype="float32")
-        faiss.normalize_L2(vectors)
+        vectors = self._chunk_vectors([c.content for c in chunks], [c.embedding for c in chunks])
 
-        with self._lock:
+        with self._lock.write_locked():
             # 最新ファイルがあればリロード
             self._maybe_reload_index()
 
-            try:
-                selector = faiss.IDSelectorBatch(ids_np)
-                self.index.remove_ids(selector)
-            except Exception:
-                pass
+            if self._is_append_only():
+                # 再登録分の旧エントリは残るので無効として数え、検索時は同じIDの重複を除く
+                self._stale_entries += self._count_indexed(ids_np)
+                self._tombstones.difference_update(ids_np.tolist())
+                self.index.add_with_ids(vectors, ids_np)
+                self._maybe_compact_index()
+            else:
+                try:
+                    selector = faiss.IDSelectorBatch(ids_np)
+                    self.index.remove_ids(selector)
+                except Exception:
+                    pass
+                self.index.add_with_ids(vectors, ids_np)
+
+            departments = dict(self._chunk_departments)
+            departments.update((c.id, c.document.department_id) for c in chunks)
+            self._set_chunk_departments(departments)
 
-            self.index.add_with_ids(vectors, ids_np)
+            self._index_version += 1
             self._save_index()
+            self._reopen_saved_index()
 
     def delete_chunks(self, chunk_ids: Sequence[int]) -> None:
         chunk_ids = list(chunk_ids)
@@ -140,112 +856,468 @@ class FaissSearchBackend(SearchBackend):
             return
 
         ids_np = np.array(chunk_ids, dtype="int64")
-        selector = faiss.IDSelectorBatch(ids_np)
 
-        with self._lock:
+        with self._lock.write_locked():
             self._maybe_reload_index()
-            self.index.remove_ids(selector)
+            if self._is_append_only():
+                # HNSW はグラフからノードを外せない（IVF は IDMap 越しだと内部IDがずれる）ので墓標にして検索結果から除外する
+                self._stale_entries += self._count_indexed(ids_np)
+                self._tombstones.update(ids_np.tolist())
+                self._maybe_compact_index()
+            else:
+                self.index.remove_ids(faiss.IDSelectorBatch(ids_np))
+            departments = dict(self._chunk_departments)
+            for chunk_id in chunk_ids:
+                departments.pop(int(chunk_id), None)
+            self._set_chunk_departments(departments)
+            self._index_version += 1
             self._save_index()
+            self._reopen_saved_index()
+
+    def update_document_department(self, document_id: int, department_id: int) -> bool:
+        """
+        文書の部門が変わったとき、対応表にあるその文書のチャンクを新しい部門に付け替えて保存する。
+        ベクトルは変わらないので index には追加・削除しない。付け替えがあれば True。
+        """
+        chunk_ids = list(Chunk.objects.filter(document_id=document_id).values_list("id", flat=True))
+        if not chunk_ids:
+            return False
+
+        with self._lock.write_locked():
+            self._maybe_reload_index()
+            moved = [
+                cid for cid in chunk_ids
+                if cid in self._chunk_departments and self._chunk_departments[cid] != department_id
+            ]
+            if not moved:
+                return False
+            departments = dict(self._chunk_departments)
+            departments.update((cid, department_id) for cid in moved)
+            self._set_chunk_departments(departments)
+            self._index_version += 1
+            self._save_index()
+            self._reopen_saved_index()
+        return True
 
     def rebuild_index(self) -> None:
         """
         新しい index をローカルで完成させてから swap する。
         途中状態（ntotal=0）を外に見せない。
         """
-        total = Chunk.objects.count()
-        logger.warning("faiss:rebuild_index:start chunk_count=%d", total)
-
-        if total == 0:
+        # 件数は要らないので COUNT(*) で全件を数えず、1行あるかだけを見る（件数は finish のログで出す）
+        if not Chunk.objects.exists():
             # 空で上書きしてチャンク全滅を防ぐ
             logger.error("faiss:rebuild_index:aborted chunk_count=0 (skip overwrite)")
             return
+        logger.warning("faiss:rebuild_index:start")
+
+        new_departments: dict[int, int] = {}
+        # モデルインスタンスは作らず、必要な列をタプルで受け取る（埋め込みは取り込み時に保存したものを使う）
+        rows_qs = Chunk.objects.order_by("id").values_list("id", "content", "embedding", "document__department_id")
 
-        new_index = self._create_empty_index()
-        qs = Chunk.objects.all().order_by("id")
+        # DB読み込み・埋め込み(API待ち)と index への追加(CPU)を別スレッドで並行させる
+        # キューを小さくして、追加が追いつかないときは埋め込み側を待たせる（メモリを溜め込まない）
+        add_queue: queue.Queue = queue.Queue(maxsize=2)
+        built: dict = {}
+        if self.index_type == "ivf":
+            # セル数を総件数から決めるので、学習用のバッチが揃う前に件数だけ数えておく
+            built["total"] = Chunk.objects.count()
+        adder = threading.Thread(
+            target=self._add_batches_worker, args=(add_queue, built), name="faiss-rebuild-add", daemon=True
+        )
+        adder.start()
 
         batch_size = 256
-        offset = 0
-        while True:
-            batch = list(qs[offset: offset + batch_size])
-            if not batch:
-                break
+        # OFFSET だと後半のバッチほど読み飛ばす行が増えるので、id の続きから読む（keyset pagination）
+        last_id = 0
+        first_batch = True
+        try:
+            while "error" not in built:
+                rows = list(rows_qs.filter(id__gt=last_id)[:batch_size])
+                if not rows:
+                    break
+                # 行のタプル列を列ごと(ID / 本文 / 埋め込み / 部門)に分ける
+                batch_ids, texts, stored, department_ids = zip(*rows)
+                last_id = batch_ids[-1]
 
-            texts = [c.content for c in batch]
-            ids_np = np.array([c.id for c in batch], dtype="int64")
+                ids_np = np.fromiter(batch_ids, dtype="int64", count=len(batch_ids))
 
-            embeddings = self.embedding_service.embed_chunks(texts)
-            vectors = np.array(embeddings, dtype="float32")
+                vectors = self._chunk_vectors(texts, stored)
+                if first_batch:
+                    first_batch = False
+                    norms2 = np.linalg.norm(vectors, axis=1)
+                    logger.warning(
+                        "faiss:rebuild_index norms(after_norm) mean=%.3f min=%.3f max=%.3f",
+                        float(norms2.mean()), float(norms2.min()), float(norms2.max())
+                    )
+                new_departments.update(zip(batch_ids, department_ids))
+                add_queue.put((vectors, ids_np))
+        finally:
+            add_queue.put(None)
+            adder.join()
 
-            faiss.normalize_L2(vectors)
-            if offset == 0:
-                norms2 = np.linalg.norm(vectors, axis=1)
-                logger.warning(
-                    "faiss:rebuild_index norms(after_norm) mean=%.3f min=%.3f max=%.3f",
-                    float(norms2.mean()), float(norms2.min()), float(norms2.max())
-                )
+        if "error" in built:
+            raise built["error"]
+        new_index = built["index"]
+        meta = {"ntotal": int(new_index.ntotal), "avg_list_size": self._ivf_avg_list_size(new_index)}
+
+        # 大きな index の書き出しには時間がかかるので、一時ファイルへの書き出しはロックの外で行い、その間も検索は旧 index で続ける。
+        # replace と mtime の更新は書き込みロックの中で行う。ロックの外で mtime を進めると、
+        # 並行する index_chunks / delete_chunks がリロードを省いて旧 index を更新し、作り直したファイルを上書きしてしまう
+        # 作り直した index には無効エントリがないので、墓標は空で保存する
+        tmp_paths = self._write_index_tmp(new_index, new_departments, set(), 0)
+        try:
+            with self._lock.write_locked():
+                self._replace_index_files(tmp_paths)
+                # 次回以降の needs_rebuild の基準にする
+                self._write_meta_file(meta)
+                # 組み立てに使ったメモリ上の index は捨て、保存したファイルを mmap で開き直す
+                self._reopen_saved_index(fallback=new_index)
+                del new_index
+                self._set_chunk_departments(new_departments)
+                self._tombstones.clear()
+                self._stale_entries = 0
+                self._index_version += 1
+        except BaseException:
+            self._discard_tmp_files(tmp_paths)
+            raise
+
+        logger.warning("faiss:rebuild_index:finish ntotal=%d", int(self.index.ntotal))
+
+    def _add_batches_worker(self, add_queue: queue.Queue, built: dict) -> None:
+        """
+        rebuild_index の追加側スレッド。キューから (vectors, ids) を受け取って新しい index に追加し、
+        None を受け取ったら完成した index を built["index"] に置く。失敗時は built["error"] に例外を置く。
+        """
+        received_all = False
+        try:
+            new_index = self._create_empty_index()
+            # ivfpq / ivf / sq8 は学習してからでないと追加できないので、学習用の件数が揃うまでバッチを溜めておく
+            pending: list[tuple[np.ndarray, np.ndarray]] | None = (
+                [] if self.index_type in self.TRAINED_INDEX_TYPES else None
+            )
+            pending_count = 0
+            while (item := add_queue.get()) is not None:
+                vectors, ids_np = item
+                if pending is not None:
+                    pending.append((vectors, ids_np))
+                    pending_count += len(ids_np)
+                    if pending_count >= self.IVF_TRAIN_SAMPLE:
+                        new_index = self._add_pending_batches(pending, built.get("total"))
+                        pending = None
+                    continue
+                new_index.add_with_ids(vectors, ids_np)
+            received_all = True
+
+            if pending:
+                new_index = self._add_pending_batches(pending, built.get("total"))
+            built["index"] = new_index
+        except BaseException as e:
+            built["error"] = e
+            # 埋め込み側が put で止まらないよう、終端まで読み捨てる
+            while not received_all and add_queue.get() is not None:
+                pass
+
+    def _add_pending_batches(
+        self, pending: list[tuple[np.ndarray, np.ndarray]], total: int | None = None
+    ) -> faiss.IndexIDMap2:
+        """溜めたバッチで IVF-PQ / IVF / SQ8 を学習し、そのバッチを追加した index を返す"""
+        new_index = self._create_trained_index(np.vstack([vectors for vectors, _ in pending]), total)
+        for vectors, ids_np in pending:
             new_index.add_with_ids(vectors, ids_np)
+        pending.clear()
+        return new_index
 
-            offset += batch_size
+    def search(
+        self,
+        query_embedding: Sequence[float] | np.ndarray,
+        top_k: int = 5,
+        filters: dict | None = None,
+    ) -> list[SearchResult]:
+        # filter / search_k ロジック
+        department_id = None
+        department_code = None
+        if filters:
+            department_id = filters.get("department_id")
+            department_code = filters.get("department_code")
+        if department_id is not None:
+            department_id = int(department_id)
 
-        with self._lock:
-            # 先に保存（atomic）→ 成功したら swap
-            self._save_index(new_index)
-            self.index = new_index  # type: ignore[assignment]
+        # ファイル更新に追従（更新があったときだけ書き込みロックを取る）
+        self._reload_if_changed()
 
-        logger.warning("faiss:rebuild_index:finish ntotal=%d", int(self.index.ntotal))
+        # 検索同士は読み取りロックなので並行に進む（index.search 自体は _run_index_search 内で取る）
+        with self._lock.read_locked():
+            ntotal = int(self.index.ntotal)
+            prefilter = (
+                ntotal > 0
+                and (department_id is not None or department_code is not None)
+                and not _is_gpu_index(self.index)  # GPU index は IDSelector 非対応
+                and self._departments_cover_index()
+            )
 
-    def search(self, query_embedding: list[float], top_k: int = 5, filters: dict | None = None) -> list[SearchResult]:
-        with self._lock:
-            # ファイル更新に追従
-            self._maybe_reload_index()
+        if ntotal == 0:
+            return []
 
-            if self.index.ntotal == 0:
-                return []
+        xq = self._query_buffer(query_embedding)
 
-            xq = np.array([query_embedding], dtype="float32")
-            faiss.normalize_L2(xq)
-
-            # filter / search_k ロジック
-            department_id = None
-            department_code = None
-            if filters:
-                department_id = filters.get("department_id")
-                department_code = filters.get("department_code")
-
-            max_k = min(int(self.index.ntotal), top_k * 50)
-            search_k = min(max_k, top_k * 5)
-
-            while True:
-                D, I = self.index.search(xq, search_k)
-                ids = I[0]
-                scores = D[0]
-
-                valid_ids = [int(i) for i in ids if i != -1]
-                if not valid_ids:
-                    return []
-
-                qs = Chunk.objects.filter(id__in=valid_ids).select_related("document__department")
-                if department_id is not None:
-                    qs = qs.filter(document__department_id=department_id)
-                if department_code is not None:
-                    qs = qs.filter(document__department__code=department_code)
-
-                chunks = list(qs)
-                chunk_by_id = {c.id: c for c in chunks}
-
-                results: list[SearchResult] = []
-                for chunk_id, score in zip(ids, scores):
-                    if chunk_id == -1:
-                        continue
-                    cid = int(chunk_id)
-                    chunk = chunk_by_id.get(cid)
-                    if chunk is None:
-                        continue
-                    results.append(SearchResult(chunk=chunk, score=float(score)))
-                    if len(results) >= top_k:
-                        return results
-
-                if search_k >= max_k:
+        if prefilter:
+            return self._search_department(xq, top_k, department_id, department_code)
+
+        max_k = min(ntotal, top_k * 50)
+        # 部門フィルタありは他部門のヒットで上位が埋まりやすいので、倍々で広げず最初から広めに見る
+        filtered = department_id is not None or department_code is not None
+        search_k = min(max_k, top_k * 20 if filtered else top_k * 5)
+        # 上限まで先取りしておくのは、広げて検索し直す見込みが高い部門フィルタありのときだけ
+        # （部門指定なしで毎回 max_k 件取ると、HNSW では efSearch もそれに合わせて大きくなる）
+        prefetch_k = max_k if filtered else search_k
+
+        results: list[SearchResult] = []
+        # 判定済みの件数。広げたときは前回の続き（新しく見える候補）だけを判定する
+        # （重複除去は先に出た方を残すので、短い結果の候補列は長い結果の候補列の先頭と一致する）
+        checked = 0
+        while True:
+            D, I = self._search_index(xq, search_k, prefetch_k=prefetch_k)
+            valid_ids, valid_scores = self._live_hits(D, I)
+            new_ids = valid_ids[checked:]
+            new_scores = valid_scores[checked:]
+            checked = len(valid_ids)
+
+            chunk_by_id = self._fetch_candidates(xq, new_ids) if new_ids else {}
+            for cid, score in zip(new_ids, new_scores):
+                chunk = chunk_by_id.get(cid)
+                if chunk is None:
+                    continue
+                if department_id is not None and chunk.document.department_id != department_id:
+                    continue
+                if department_code is not None and chunk.document.department.code != department_code:
+                    continue
+                results.append(SearchResult(chunk=chunk, score=score))
+                if len(results) >= top_k:
                     return results
 
-                search_k = min(max_k, search_k * 2)
+            if search_k >= max_k:
+                return results
+
+            search_k = min(max_k, search_k * 2)
+
+    def _query_buffer(self, query_embedding: Sequence[float] | np.ndarray) -> np.ndarray:
+        """
+        クエリをスレッドごとの (1, d) float32 バッファにコピーして L2 正規化する。
+        float32配列が渡されても呼び出し元の配列は書き換えない。
+        返す配列は同じスレッドの次の search() で上書きされるので、保持する場合はコピーすること。
+        """
+        buf = getattr(self._xq_tls, "buf", None)
+        if buf is None or buf.shape[1] != self.dimension:
+            buf = self._xq_tls.buf = _aligned_empty((1, self.dimension))
+        np.copyto(buf[0], query_embedding)
+        faiss.normalize_L2(buf)
+        return buf
+
+    def _search_department(
+        self, xq: np.ndarray, top_k: int, department_id: int | None, department_code: str | None
+    ) -> list[SearchResult]:
+        """
+        部門の対応表から作った IDSelector で、FAISS 側で部門を絞って検索する。
+        他部門のヒットで上位が埋まることがないので、search_k を広げて検索し直す必要がなく、
+        DB には返す top_k 件分の Chunk を取りに行くだけになる。
+        """
+        if department_code is not None:
+            department = get_department_by_code(department_code)
+            if department is None or (department_id is not None and department.id != department_id):
+                return []
+            department_id = department.id
+
+        hits = self._department_hits(xq, top_k, department_id)
+        if not hits:
+            return []
+
+        chunk_by_id = self._fetch_candidates(xq, [cid for cid, _ in hits])
+        # 対応表は文書の部門変更に遅れて追従することがあるので、DB上の部門でも確かめる
+        return [
+            SearchResult(chunk=chunk, score=float(score))
+            for cid, score in hits
+            if (chunk := chunk_by_id.get(cid)) is not None and chunk.document.department_id == department_id
+        ]
+
+    def _department_hits(self, xq: np.ndarray, top_k: int, department_id: int) -> list[tuple[int, float]]:
+        """部門の IDSelector で FAISS を検索し、(chunk_id, score) を上位 top_k 件まで返す（DBは使わない）"""
+        with self._lock.read_locked():
+            selector, allowed_count = self._department_selector(department_id)
+        if allowed_count == 0:
+            return []
+
+        # HNSW / IVF は再登録前の旧エントリが同じIDで残り得るので、重複を除いても top_k 件残るよう多めに取る
+        k = top_k * 2 if self._is_append_only() else min(allowed_count, top_k)
+        key = (xq.tobytes(), id(self.index), int(self.index.ntotal), self._index_version, department_id)
+        cached = self._last_search
+        if cached is not None and cached[0] == key and cached[1] >= k:
+            D, I = cached[2], cached[3]
+        else:
+            D, I = self._index_search_locked(xq, k, selector=selector)
+            self._last_search = (key, k, D, I)
+        return self._unique_hits(D, I, top_k)
+
+    def _live_hits(self, D: np.ndarray, I: np.ndarray) -> tuple[list[int], list[float]]:
+        """
+        検索結果の1行目から、空き(-1)・墓標・同じIDの重複を除いた chunk_id とスコアを順位順に返す。
+        HNSW / IVF では再登録前の旧エントリが同じIDで残り得るので、先に出た(高スコアの)方だけ使う。
+        要素ごとの判定は numpy でまとめて行い、Python に渡すのは残った分だけにする。
+        """
+        ids = I[0]
+        scores = D[0]
+        mask = ids != -1
+        tombstones = self._tombstones
+        if tombstones:
+            mask &= ~np.isin(ids, np.fromiter(tombstones, dtype="int64", count=len(tombstones)))
+        ids = ids[mask]
+        scores = scores[mask]
+        _, first = np.unique(ids, return_index=True)
+        if len(first) < len(ids):
+            first.sort()
+            ids = ids[first]
+            scores = scores[first]
+        return ids.tolist(), scores.tolist()
+
+    def _unique_hits(self, D: np.ndarray, I: np.ndarray, top_k: int) -> list[tuple[int, float]]:
+        """_live_hits の上位 top_k 件を (chunk_id, score) で返す"""
+        ids, scores = self._live_hits(D, I)
+        return list(zip(ids[:top_k], scores[:top_k]))
+
+    async def asearch(
+        self,
+        query_embedding: Sequence[float] | np.ndarray,
+        top_k: int = 5,
+        filters: dict | None = None,
+    ) -> list[SearchResult]:
+        """
+        search() の async 版。FAISS の検索はスレッドで実行し、Chunk の取得は async ORM で待つ。
+        部門の対応表で絞れない場合(DB上の部門で絞り込む経路)は search() をスレッドで実行する。
+        """
+        department_id = None
+        department_code = None
+        if filters:
+            department_id = filters.get("department_id")
+            department_code = filters.get("department_code")
+        if department_id is not None:
+            department_id = int(department_id)
+        if department_code is not None:
+            department = await sync_to_async(get_department_by_code)(department_code)
+            if department is None or (department_id is not None and department.id != department_id):
+                return []
+            department_id = department.id
+
+        hits = await asyncio.to_thread(self._faiss_hits, query_embedding, top_k, department_id)
+        if hits is None:
+            return await sync_to_async(self.search)(query_embedding, top_k, filters)
+        if not hits:
+            return []
+
+        chunk_by_id = await (
+            Chunk.objects.select_related("document__department")
+            .only(*SEARCH_RESULT_FIELDS)
+            .ain_bulk([cid for cid, _ in hits])
+        )
+        # 対応表で絞った場合も、DB上の部門で確かめる（search() と同じ）
+        return [
+            SearchResult(chunk=chunk, score=float(score))
+            for cid, score in hits
+            if (chunk := chunk_by_id.get(cid)) is not None
+            and (department_id is None or chunk.document.department_id == department_id)
+        ]
+
+    def _faiss_hits(
+        self, query_embedding: Sequence[float] | np.ndarray, top_k: int, department_id: int | None
+    ) -> list[tuple[int, float]] | None:
+        """
+        FAISS だけで上位 top_k 件の (chunk_id, score) を決める（asearch 用。DBには触れない）。
+        部門指定があるのに対応表で絞れない場合は None。
+        """
+        self._reload_if_changed()
+        with self._lock.read_locked():
+            ntotal = int(self.index.ntotal)
+            prefilter = (
+                department_id is not None
+                and ntotal > 0
+                and not _is_gpu_index(self.index)
+                and self._departments_cover_index()
+            )
+        if ntotal == 0:
+            return []
+        if department_id is not None and not prefilter:
+            return None
+
+        xq = self._query_buffer(query_embedding)
+        if department_id is not None:
+            return self._department_hits(xq, top_k, department_id)
+        # 部門指定なし: 重複(HNSW / IVF の旧エントリ)を除いても足りるよう多めに取る
+        k = min(ntotal, top_k * 2)
+        D, I = self._search_index(xq, k, prefetch_k=k)
+        return self._unique_hits(D, I, top_k)
+
+    def _fetch_candidates(self, xq: np.ndarray, valid_ids: list[int]) -> dict[int, Chunk]:
+        """
+        候補 Chunk を部門で絞らずに取得する。
+        同じクエリベクトルなら取得済みの行を使い回し、足りないIDだけを追加で取得する。
+        primary → secondary → 全社 の各スコープ検索は、DB往復1回分の候補をPython側で絞り込むだけになる。
+        """
+        key = (xq.tobytes(), id(self.index), int(self.index.ntotal), self._index_version)
+        cached = self._last_candidates
+        # 他スレッドが同じ dict を読んでいる可能性があるので、使い回す場合もコピーに追記する
+        chunk_by_id: dict[int, Chunk] = dict(cached[1]) if cached is not None and cached[0] == key else {}
+
+        missing = [cid for cid in valid_ids if cid not in chunk_by_id]
+        if missing:
+            # 埋め込みベクトル(embedding)など回答に使わない列は取得しない
+            chunk_by_id.update(
+                Chunk.objects.select_related("document__department")
+                .only(*SEARCH_RESULT_FIELDS)
+                .in_bulk(missing)
+            )
+        self._last_candidates = (key, chunk_by_id)
+        return chunk_by_id
+
+    def _search_index(self, xq: np.ndarray, k: int, *, prefetch_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        index.search のラッパー。
+        同じクエリベクトル・同じindex状態なら前回の結果をスライスして返す。
+        キャッシュミス時は prefetch_k 件まで一度に取り、拡張リトライや別スコープの検索もまとめて賄う。
+        """
+        key = (xq.tobytes(), id(self.index), int(self.index.ntotal), self._index_version)
+        cached = self._last_search
+        if cached is not None and cached[0] == key and cached[1] >= k:
+            return cached[2][:, :k], cached[3][:, :k]
+
+        fetch_k = max(k, prefetch_k)
+        D, I = self._run_index_search(xq, fetch_k)
+        self._last_search = (key, fetch_k, D, I)
+        return D[:, :k], I[:, :k]
+
+    def _run_index_search(self, xq: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """マイクロバッチが有効なら同時に来たクエリとまとめて、無効なら単独で index.search する"""
+        if self._coalescer is not None:
+            return self._coalescer.search(xq, k)
+        return self._index_search_locked(xq, k)
+
+    def _index_search_locked(self, xq: np.ndarray, k: int, selector=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        selector を渡すと、そのIDだけを対象に検索する。
+        読み取りロックで他の検索と並行に走るので、efSearch / nprobe は index を書き換えず検索パラメータで渡す。
+        """
+        with self._lock.read_locked():
+            params = None
+            if self._hnsw_base() is not None:
+                params = faiss.SearchParametersHNSW()
+                # efSearch は取り出す件数以上でないと k 件埋まらない
+                params.efSearch = max(self.HNSW_EF_SEARCH_MIN, k * 2)
+            elif (ivf := self._ivf_base()) is not None:
+                params = faiss.SearchParametersIVF()
+                # 学習時に nlist に合わせて決めた nprobe（index ファイルに保存される）をそのまま使う
+                params.nprobe = ivf.nprobe
+            elif selector is not None:
+                params = faiss.SearchParameters()
+            if params is None:
+                return self.index.search(xq, k)
+            if selector is not None:
+                params.sel = selector
+            return self.index.search(xq, k, params=params)
@@ -0,0 +1,114 @@
+from typing import Sequence
+import logging
+
+from django.db import connection, transaction
+
+from .base import SEARCH_RESULT_FIELDS, SearchBackend, SearchResult
+from documents.models import Chunk
+
+logger = logging.getLogger(__name__)
+
+# text-embedding-3-small の次元数。HNSW インデックス(マイグレーション)と揃えること
+EMBEDDING_DIMENSION = 1536
+
+
+class PgVectorSearchBackend(SearchBackend):
+    """
+    Chunk.embedding(float8[]) を pgvector の vector にキャストし、PostgreSQL 側で近傍検索する。
+    documents_chunk に張った HNSW(部分式インデックス)を使うため、別ファイルのインデックス管理は不要。
+    """
+    # HNSW 探索時の候補数。部門フィルタは索引走査後に掛かるため、既定(40)より広めに取る
+    EF_SEARCH = 200
+    # 部門で絞った結果が top_k 件に満たないときに広げる候補数（pgvector の ef_search の上限）
+    EF_SEARCH_MAX = 1000
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION) -> None:
+        self.dimension = dimension
+        # インデックス定義と完全に同じ式にしないとプランナが HNSW を使わない
+        self._vector_expr = f"c.embedding::vector({dimension})"
+
+    # --- index mutate ops ---
+    # Chunk 行そのものがインデックス対象なので、保存/削除時に追加の作業はない
+
+    def index_chunks(self, chunk_ids: Sequence[int]) -> None:
+        return None
+
+    def delete_chunks(self, chunk_ids: Sequence[int]) -> None:
+        return None
+
+    def rebuild_index(self) -> None:
+        with connection.cursor() as cursor:
+            # pgvector が無い環境ではマイグレーションがインデックスを作らない
+            cursor.execute("SELECT to_regclass('chunk_embedding_hnsw')")
+            if cursor.fetchone()[0] is None:
+                logger.warning("pgvector:rebuild skipped (index chunk_embedding_hnsw does not exist)")
+                return
+            cursor.execute("REINDEX INDEX chunk_embedding_hnsw")
+
+    def search(self, query_embedding: list[float], top_k: int = 5, filters: dict | None = None) -> list[SearchResult]:
+        if len(query_embedding) != self.dimension:
+            logger.warning(
+                "pgvector:search dimension mismatch expected=%d got=%d", self.dimension, len(query_embedding)
+            )
+            return []
+
+        department_id = None
+        department_code = None
+        if filters:
+            department_id = filters.get("department_id")
+            department_code = filters.get("department_code")
+
+        where = [f"array_length(c.embedding, 1) = {self.dimension}"]
+        params: list = []
+        joins = ""
+        if department_id is not None or department_code is not None:
+            joins = " JOIN documents_document d ON d.id = c.document_id"
+        if department_id is not None:
+            where.append("d.department_id = %s")
+            params.append(department_id)
+        if department_code is not None:
+            joins += " JOIN accounts_department dep ON dep.id = d.department_id"
+            where.append("dep.code = %s")
+            params.append(department_code)
+
+        query_vector = "[" + ",".join(map(str, query_embedding)) + "]"
+        sql = (
+            f"SELECT c.id, {self._vector_expr} <=> %s::vector AS distance"
+            f" FROM documents_chunk c{joins}"
+            f" WHERE {' AND '.join(where)}"
+            " ORDER BY distance LIMIT %s"
+        )
+
+        sql_params = [query_vector, *params, top_k]
+        rows = self._nearest_rows(sql, sql_params, ef_search=max(self.EF_SEARCH, top_k))
+        if params and len(rows) < top_k:
+            # 部門フィルタは HNSW の候補に後から掛かるので、小さい部門は候補にほとんど残らないことがある。
+            # 候補を上限まで広げ、それでも足りなければ索引を使わず部門の行だけを厳密に並べる
+            rows = self._nearest_rows(sql, sql_params, ef_search=self.EF_SEARCH_MAX)
+            if len(rows) < top_k:
+                rows = self._nearest_rows(sql, sql_params, exact=True)
+
+        if not rows:
+            return []
+
+        chunk_by_id = (
+            Chunk.objects.select_related("document__department")
+            .only(*SEARCH_RESULT_FIELDS)
+            .in_bulk([chunk_id for chunk_id, _ in rows])
+        )
+        # cosine距離 → 類似度(FAISS の内積スコアと同じ尺度)
+        return [
+            SearchResult(chunk=chunk_by_id[chunk_id], score=1.0 - float(distance))
+            for chunk_id, distance in rows
+            if chunk_id in chunk_by_id
+        ]
+
+    def _nearest_rows(self, sql: str, params: list, *, ef_search: int | None = None, exact: bool = False) -> list:
+        """近傍検索のSQLを実行する。exact=True なら索引走査を止めて厳密に並べる"""
+        with transaction.atomic(), connection.cursor() as cursor:
+            if exact:
+                cursor.execute("SET LOCAL enable_indexscan = off")
+            else:
+                cursor.execute("SET LOCAL hnsw.ef_search = %s", [ef_search])
+            cursor.execute(sql, params)
+            return cursor.fetchall()
@@ -3,29 +3,99 @@ from __future__ import annotations
 from dataclasses import dataclass, field
 from pathlib import Path
 from abc import ABC, abstractmethod
-from typing import Any, List, Optional, Dict, Tuple
+from typing import Any, Callable, List, Optional, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import codecs
 import csv
-
+import io
+import logging
+import math
+import multiprocessing
+import re
+import threading
+
+import numpy as np
+from django.conf import settings
 from PyPDF2 import PdfReader
 import warnings as pywarnings
 from PyPDF2.errors import PdfReadWarning
 
 
+try:
+    from numba import njit
+except ImportError:  # numba は任意。なければ numpy のマスク集計で同じ結果を作る
+    njit = None
+
+try:
+    from charset_normalizer import from_bytes as _detect_charset
+except ImportError:  # 任意。なければ候補の文字コードを順に試す
+    _detect_charset = None
+
 try:
     import fitz  # PyMuPDF
 except Exception:  # pragma: no cover
     fitz = None
 
+# PyMuPDF はスレッドセーフではないので、プロセス内で fitz を使うのは同時に1スレッドだけにする
+# （全件再インデックスの並行取り込みや、非同期アップロードのワーカーから同時に呼ばれる）
+_fitz_lock = threading.Lock()
+
+
+logger = logging.getLogger(__name__)
 
 REPLACEMENT_CHAR = "\uFFFD"  # �文字化け
 
+# PyPDF2 が未対応の文字エンコーディングに当たったときの PdfReadWarning
+_ADVANCED_ENCODING_RE = re.compile(r"Advanced encoding.*not implemented", re.S)
+
+# 文字コード推定に使う先頭バイト数
+ENCODING_DETECT_SAMPLE_BYTES = 64 * 1024
+
+# PyPDF2 でページ数がこれ未満のPDFはプロセスに分けずに抽出する（各ワーカーでのPDFの読み直しと受け渡しの方が高くつく）
+# PyMuPDF は C 実装で順次でも十分速く、プロセスに分けるとかえって遅くなるので並列化しない
+PARALLEL_MIN_PAGES = 64
 
-@dataclass
+
+@dataclass(init=False)
 class ExtractedContent:
-    full_text: str
+    """
+    full_text を省略して pages (または rows) だけを渡した場合、full_text は初回参照時に改行で結合して組み立てる。
+    PDF はページ単位、CSV は行単位でチャンク化するので、結合した本文を作らずに済むことが多い。
+    """
     pages: Optional[List[str]] = None  # PDFなどのページ概念があるもので使用
     num_pages: Optional[int] = None
+    rows: Optional[List[str]] = None  # CSVの正規化済みレコード（1要素=1行）
     metadata: Dict[str, Any] = field(default_factory=dict)  # Noneを避ける
+    _full_text: Optional[str] = field(default=None, repr=False)
+    # 本文の文字数・文字種比率のキャッシュ。_content_ratios() 経由で使う
+    _ratios: Optional[Dict[str, float]] = field(default=None, repr=False, compare=False)
+
+    def __init__(
+        self,
+        full_text: Optional[str] = None,
+        pages: Optional[List[str]] = None,
+        num_pages: Optional[int] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        rows: Optional[List[str]] = None,
+    ) -> None:
+        self._full_text = full_text
+        self.pages = pages
+        self.num_pages = num_pages
+        self.rows = rows
+        self.metadata = metadata if metadata is not None else {}
+        self._ratios = None
+
+    @property
+    def full_text(self) -> str:
+        if self._full_text is None:
+            parts = self.pages if self.pages is not None else self.rows
+            self._full_text = "\n".join(parts or []).strip()
+        return self._full_text
+
+    @full_text.setter
+    def full_text(self, value: str) -> None:
+        self._full_text = value
+        self._ratios = None
 
 
 class ContentExtractor(ABC):
@@ -44,43 +114,127 @@ class ContentExtractor(ABC):
 # 共通ヘルパ
 # -----------------------------
 def _normalize_newlines(s: str) -> str:
+    # PDFのページ本文は \r を含まないことが多い。含まなければ置換（走査+コピー2回）を丸ごと省く
+    if "\r" not in s:
+        return s
     return s.replace("\r\n", "\n").replace("\r", "\n")
 
 
-def _replacement_ratio(text: str) -> float:
-    if not text:
-        return 0.0
-    return text.count(REPLACEMENT_CHAR) / max(len(text), 1)
+def _codepoints(text: str) -> np.ndarray:
+    """文字列をコードポイントの uint32 配列にする"""
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
 
-def _c1_control_ratio(text: str) -> float:
+def _text_replacement_ratio(text: str) -> float:
+    """置換文字の比率だけが要る箇所用。str.count(C実装)で数え、コードポイント配列への変換を省く"""
     if not text:
         return 0.0
-    n = sum(1 for ch in text if 0x80 <= ord(ch) <= 0x9F)
-    return n / max(len(text), 1)
+    return text.count(REPLACEMENT_CHAR) / len(text)
 
 
-def _latin1_ratio(text: str) -> float:
-    if not text:
-        return 0.0
-    n = sum(1 for ch in text if 0xA0 <= ord(ch) <= 0xFF)
-    return n / max(len(text), 1)
+if njit is not None:
 
+    @njit(cache=True)
+    def _classify_codepoints_nb(cp):
+        """_classify_codepoints と同じ集計を1ループで行う（中間のマスク配列を作らない）"""
+        r = c1 = l1 = jp = 0
+        for i in range(cp.shape[0]):
+            x = cp[i]
+            if x == 0xFFFD:
+                r += 1
+            elif 0x80 <= x <= 0x9F:
+                c1 += 1
+            elif 0xA0 <= x <= 0xFF:
+                l1 += 1
+            elif (0x3040 <= x <= 0x30FF) or (0x4E00 <= x <= 0x9FFF) or (0xFF66 <= x <= 0xFF9D):
+                jp += 1
+        return r, c1, l1, jp
 
-def _japanese_ratio(text: str) -> float:
-    if not text:
-        return 0.0
+else:
+    _classify_codepoints_nb = None
 
-    def is_jp(ch: str) -> bool:
-        o = ord(ch)
-        return (
-            (0x3040 <= o <= 0x309F)  # Hiragana
-            or (0x30A0 <= o <= 0x30FF)  # Katakana
-            or (0x4E00 <= o <= 0x9FFF)  # CJK Unified Ideographs
-            or (0xFF66 <= o <= 0xFF9D)  # Halfwidth Katakana
-        )
 
-    n = sum(1 for ch in text if is_jp(ch))
-    return n / max(len(text), 1)
+def _classify_codepoints(cp: np.ndarray) -> Tuple[int, int, int, int]:
+    """
+    置換文字 / C1制御文字 / Latin-1補助 / 日本語 の文字数を (r, c1, l1, jp) で返す。
+    4つの比率を1つの関数で数え、本文の変換・走査を1回にまとめる。numba があれば JIT 版を使う。
+    """
+    if _classify_codepoints_nb is not None:
+        r, c1, l1, jp = _classify_codepoints_nb(cp)
+        return int(r), int(c1), int(l1), int(jp)
+    r = np.count_nonzero(cp == ord(REPLACEMENT_CHAR))
+    c1 = np.count_nonzero((cp >= 0x80) & (cp <= 0x9F))
+    l1 = np.count_nonzero((cp >= 0xA0) & (cp <= 0xFF))
+    is_jp = (
+        ((cp >= 0x3040) & (cp <= 0x30FF))  # Hiragana + Katakana
+        | ((cp >= 0x4E00) & (cp <= 0x9FFF))  # CJK Unified Ideographs
+        | ((cp >= 0xFF66) & (cp <= 0xFF9D))  # Halfwidth Katakana
+    )
+    return int(r), int(c1), int(l1), int(np.count_nonzero(is_jp))
+
+
+def _stripped_segments(pages: List[str]) -> List[str]:
+    """
+    "\\n".join(pages).strip() を結合せずに表す断片のリスト（断片どうしは "\\n" 1文字で区切られる）。
+    前後の空白だけのページを除き、先頭/末尾ページの空白を落とす。
+    """
+    nonblank = [i for i, p in enumerate(pages) if p.strip()]
+    if not nonblank:
+        return []
+    first, last = nonblank[0], nonblank[-1]
+    if first == last:
+        return [pages[first].strip()]
+    return [pages[first].lstrip(), *pages[first + 1:last], pages[last].rstrip()]
+
+
+def _compute_all_ratios(segments: List[str]) -> Dict[str, float]:
+    """
+    "\\n" 区切りで連結した本文の文字数("len")と文字種比率を返す。
+    区切りの改行はどの文字種にも入らないので、断片ごとに数えて合算する。
+    """
+    length = sum(len(seg) for seg in segments) + max(len(segments) - 1, 0)
+    if length == 0:
+        return {"len": 0, "replacement": 0.0, "c1": 0.0, "latin1": 0.0, "jp": 0.0}
+    r = c1 = l1 = jp = 0
+    for seg in segments:
+        counts = _classify_codepoints(_codepoints(seg))
+        r += counts[0]
+        c1 += counts[1]
+        l1 += counts[2]
+        jp += counts[3]
+    return {"len": length, "replacement": r / length, "c1": c1 / length, "latin1": l1 / length, "jp": jp / length}
+
+
+def _content_ratios(content: ExtractedContent) -> Dict[str, float]:
+    """
+    content.full_text の文字数・文字種比率を返す。品質判定・結果比較・メトリクス記録で同じ本文を
+    何度も走査しないよう ExtractedContent にキャッシュする（full_text を差し替えると破棄される）。
+    full_text がまだ組み立てられていなければ、pages から直接数えて結合を避ける。
+    """
+    if content._ratios is None:
+        if content._full_text is None and content.pages is not None:
+            segments = _stripped_segments(content.pages)
+        else:
+            segments = [content.full_text or ""]
+        content._ratios = _compute_all_ratios(segments)
+    return content._ratios
+
+
+def _order_by_detected_encoding(data: bytes, encodings: List[str]) -> List[str]:
+    """
+    先頭 ENCODING_DETECT_SAMPLE_BYTES を charset_normalizer で1回だけ判定し、推定が候補にあれば先頭に移す。
+    cp932 と euc_jp のように互いのバイト列を（誤って）読めてしまう組み合わせでも、推定の方を優先できる。
+    """
+    if _detect_charset is None or not encodings:
+        return encodings
+    best = _detect_charset(data[:ENCODING_DETECT_SAMPLE_BYTES]).best()
+    if best is None:
+        return encodings
+    guessed = codecs.lookup(best.encoding).name
+    for enc in encodings:
+        if codecs.lookup(enc).name == guessed:
+            return [enc] + [e for e in encodings if e != enc]
+    return encodings
 
 
 def _decode_bytes_with_fallback(
@@ -89,9 +243,19 @@ def _decode_bytes_with_fallback(
 ) -> Tuple[str, str, List[str]]:
     """
     Returns: (decoded_text, used_encoding, warnings)
+    先頭の UTF-8 系の候補で読めなければ、残りの候補は先頭サンプルから推定した文字コードを先に試す。
     """
     warnings: List[str] = []
-    for enc in encodings:
+    n_utf = 0
+    while n_utf < len(encodings) and codecs.lookup(encodings[n_utf]).name.startswith("utf"):
+        n_utf += 1
+    for enc in encodings[:n_utf]:
+        try:
+            return _normalize_newlines(data.decode(enc)), enc, warnings
+        except UnicodeDecodeError:
+            continue
+
+    for enc in _order_by_detected_encoding(data, encodings[n_utf:]):
         try:
             return _normalize_newlines(data.decode(enc)), enc, warnings
         except UnicodeDecodeError:
@@ -104,53 +268,139 @@ def _decode_bytes_with_fallback(
 
 
 # -----------------------------
-# PDF Extractor (PyPDF2 -> PyMuPDF fallback)
+# PDF ページ範囲の抽出（ワーカープロセスで実行するためモジュール直下に置く）
+# 文書ハンドルはプロセス間で共有できないので、各ワーカーが自分でファイルを開く
+# -----------------------------
+def _pypdf2_page_text(page) -> str:
+    try:
+        text = page.extract_text() or ""
+    except Exception:
+        text = ""
+    return _normalize_newlines(text)
+
+
+def _extract_pypdf2_range(path_str: str, start: int, end: int) -> Tuple[List[str], List[str]]:
+    """PyPDF2 で [start, end) ページを抽出する。Returns: (pages_text, PdfReadWarning のメッセージ)"""
+    with pywarnings.catch_warnings(record=True) as w:
+        pywarnings.simplefilter("always", PdfReadWarning)
+        reader = PdfReader(path_str)
+        pages_text = [_pypdf2_page_text(reader.pages[i]) for i in range(start, end)]
+    return pages_text, [str(x.message) for x in w]
+
+
+def _is_likely_scan_pdf(
+    path: Path, head_bytes: int = 1 << 20, min_ratio: float = 10.0, sample_pages: int = 5
+) -> bool:
+    """
+    スキャン画像だけのPDFかを、全ページを抽出せずに判定する。
+    まず先頭 head_bytes の生バイト中の "/Image" と "/Font" の出現数を比べ（bytes.count だけなのでパースより桁違いに速い）、
+    画像ばかりでフォントのほぼ無いPDFだけを候補にする。フォント定義は圧縮されたオブジェクトストリームの中にあると
+    生バイトに現れないので、候補は PyMuPDF で sample_pages ページを抜き出して抽出し、どのページにも文字がなければスキャンとみなす。
+    PyMuPDF がなければ確かめられないので False（通常どおり抽出する）。
+    """
+    with path.open("rb") as f:
+        raw = f.read(head_bytes)
+    if raw.count(b"/Image") / max(1, raw.count(b"/Font")) <= min_ratio:
+        return False
+    if fitz is None:
+        return False
+    with _fitz_lock, fitz.open(str(path)) as doc:
+        num_pages = doc.page_count
+        if num_pages == 0:
+            return False
+        # 先頭・末尾を含めて均等に抜き出す（表紙だけ画像のPDFを取りこぼさない）
+        indices = sorted({round(i * (num_pages - 1) / max(1, sample_pages - 1)) for i in range(sample_pages)})
+        return not any((doc.load_page(i).get_text("text") or "").strip() for i in indices)
+
+
+# -----------------------------
+# PDF Extractor (PyMuPDF -> PyPDF2 fallback)
 # -----------------------------
 class PDFContentExtractor(ContentExtractor):
+    # これ以上のサイズのPDFは、抽出前に生バイトでスキャンPDFかを判定する（小さいPDFは抽出しても安い）
+    SCAN_PREFILTER_MIN_BYTES = 5 * 1024 * 1024
+
     def __init__(
         self,
         min_text_len: int = 100,
         max_replacement_ratio: float = 0.01,  # 1%
         empty_page_ratio_threshold: float = 0.60,
         enable_pymupdf_fallback: bool = True,
+        num_workers: Optional[int] = None,
+        small_pdf_bytes: int = 64 * 1024,
     ) -> None:
+        """
+        enable_pymupdf_fallback: False なら PyMuPDF を使わず PyPDF2 だけで抽出する。
+        num_workers: ページ数の多いPDFを PyPDF2 で抽出するとき、ページ範囲に分けて並列抽出するプロセス数
+        （1なら並列化しない）。省略時は settings.PDF_EXTRACT_WORKERS。
+        PyPDF2 のテキスト復号は pure Python で GIL に縛られるため、スレッドではなくプロセスで分ける。
+        small_pdf_bytes: これ未満のサイズのPDFは1つ目のエンジンの結果をそのまま使い、もう一方では抽出し直さない
+        （品質の警告は付ける）。0 なら常にフォールバックを判定する。
+        """
         self.min_text_len = min_text_len
         self.max_replacement_ratio = max_replacement_ratio
         self.empty_page_ratio_threshold = empty_page_ratio_threshold
         self.enable_pymupdf_fallback = enable_pymupdf_fallback
+        self.num_workers = num_workers if num_workers is not None else getattr(settings, "PDF_EXTRACT_WORKERS", 1)
+        self.small_pdf_bytes = small_pdf_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
 
     def can_handle(self, path: Path) -> bool:
         return path.suffix.lower() == ".pdf"
 
     def extract_content(self, path: Path) -> ExtractedContent:
-        # 1) PyPDF2
-        pypdf2_content = self._extract_with_pypdf2(path)
-        pypdf2_warnings = self._assess_pdf_quality(pypdf2_content)
+        # 大きなスキャンPDFは、どちらのエンジンでも文字が取れないので抽出自体を省く（取り込み側で弾かれる）
+        file_size = path.stat().st_size
+        if file_size >= self.SCAN_PREFILTER_MIN_BYTES and _is_likely_scan_pdf(path):
+            return ExtractedContent(
+                pages=[],
+                metadata={
+                    "type": "pdf",
+                    "engine": "scan_prefilter",
+                    "warnings": ["image_pdf_suspected", "no_text_extracted"],
+                },
+            )
 
-        # フォールバック不可ならそのまま返す
+        # PyMuPDF が使えなければ PyPDF2 だけで抽出する
         if not self.enable_pymupdf_fallback or fitz is None:
+            pypdf2_content = self._extract_with_pypdf2(path)
+            pypdf2_warnings = self._assess_pdf_quality(pypdf2_content)
             md = pypdf2_content.metadata
             md["engine"] = "pypdf2"
             md["warnings"] = sorted(set(pypdf2_warnings + (["pymupdf_not_installed"] if (self.enable_pymupdf_fallback and fitz is None) else [])))
             return pypdf2_content
 
-        # フォールバック判定
-        if not self._should_fallback(pypdf2_warnings):
-            md = pypdf2_content.metadata
-            md["engine"] = "pypdf2"
-            md["warnings"] = pypdf2_warnings
-            return pypdf2_content
-
-        # 2) PyMuPDF
+        # 1) PyMuPDF（C実装で速く、日本語のCIDフォントにも強いので先に試す）
         try:
             pymupdf_content = self._extract_with_pymupdf(path)
-            pymupdf_warnings = self._assess_pdf_quality(pymupdf_content)
         except Exception as e:
+            pypdf2_content = self._extract_with_pypdf2(path)
+            pypdf2_warnings = self._assess_pdf_quality(pypdf2_content)
             md = pypdf2_content.metadata
             md["engine"] = "pypdf2"
             md["warnings"] = sorted(set(pypdf2_warnings + ["pymupdf_extract_failed"]))
-            md["fallback"] = {"from": "pypdf2", "to": "pypdf2", "error": str(e), "trigger_warnings": pypdf2_warnings}
+            md["fallback"] = {"from": "pymupdf", "to": "pypdf2", "error": str(e), "trigger_warnings": []}
             return pypdf2_content
+        pymupdf_warnings = self._assess_pdf_quality(pymupdf_content)
+
+        # フォールバック判定（問題がなければ PyPDF2 は走らせない。小さいPDFは2回目の抽出に見合わないので判定しない）
+        if not self._should_fallback(pymupdf_warnings) or file_size < self.small_pdf_bytes:
+            md = pymupdf_content.metadata
+            md["engine"] = "pymupdf"
+            md["warnings"] = pymupdf_warnings
+            return pymupdf_content
+
+        # 2) PyPDF2
+        try:
+            pypdf2_content = self._extract_with_pypdf2(path)
+            pypdf2_warnings = self._assess_pdf_quality(pypdf2_content)
+        except Exception as e:
+            md = pymupdf_content.metadata
+            md["engine"] = "pymupdf"
+            md["warnings"] = sorted(set(pymupdf_warnings + ["pypdf2_extract_failed"]))
+            md["fallback"] = {"from": "pymupdf", "to": "pymupdf", "error": str(e), "trigger_warnings": pymupdf_warnings}
+            return pymupdf_content
 
         # 3) どちらを採用するか決める
         chosen, engine, warnings = self._choose_better_result(
@@ -160,9 +410,9 @@ class PDFContentExtractor(ContentExtractor):
         chosen.metadata["engine"] = engine
         chosen.metadata["warnings"] = warnings
         chosen.metadata["fallback"] = {
-            "from": "pypdf2",
+            "from": "pymupdf",
             "to": engine,
-            "trigger_warnings": pypdf2_warnings,
+            "trigger_warnings": pymupdf_warnings,
             "metrics": {
                 "pypdf2": self._quality_metrics(pypdf2_content, pypdf2_warnings),
                 "pymupdf": self._quality_metrics(pymupdf_content, pymupdf_warnings),
@@ -170,33 +420,64 @@ class PDFContentExtractor(ContentExtractor):
         }
         return chosen
 
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # 初回の並列抽出時に作り、以降は使い回す（プロセス起動は1回だけ）
+        # fork だと Web サーバのスレッドやDB接続ごと複製されるので spawn で起動する
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.num_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+        return self._pool
+
+    def _extract_pages_parallel(self, worker: Callable, path: Path, num_pages: int) -> Optional[List[Any]]:
+        """
+        ページを num_workers 個の範囲に分けて worker(path, start, end) をプロセスで実行し、範囲順に結果を返す。
+        ページ数が少ない / 並列化しない設定 / プロセスプールが使えない場合は None（呼び出し側で順次抽出する）。
+        """
+        if self.num_workers <= 1 or num_pages < PARALLEL_MIN_PAGES:
+            return None
+        size = math.ceil(num_pages / self.num_workers)
+        try:
+            pool = self._get_pool()
+            futures = [
+                pool.submit(worker, str(path), start, min(start + size, num_pages))
+                for start in range(0, num_pages, size)
+            ]
+            return [f.result() for f in futures]
+        except Exception:
+            logger.exception("parallel pdf extraction failed, falling back to sequential: %s", path)
+            return None
+
     def _extract_with_pypdf2(self, path: Path) -> ExtractedContent:
         with pywarnings.catch_warnings(record=True) as w:
             pywarnings.simplefilter("always", PdfReadWarning)
 
             reader = PdfReader(str(path))
             meta = getattr(reader, "metadata", None)
-
-            pages_text: List[str] = []
-            for page in reader.pages:
-                try:
-                    text = page.extract_text() or ""
-                except Exception:
-                    text = ""
-                pages_text.append(_normalize_newlines(text))
-
-            full_text = "\n".join(pages_text).strip()
             num_pages = len(reader.pages)
 
-        pdfread_warning_msgs = [str(x.message) for x in w]
+            parts = self._extract_pages_parallel(_extract_pypdf2_range, path, num_pages)
+            worker_warning_msgs: List[str] = []
+            if parts is None:
+                pages_text = [_pypdf2_page_text(page) for page in reader.pages]
+            else:
+                pages_text = []
+                for part_pages, part_warnings in parts:
+                    pages_text.extend(part_pages)
+                    worker_warning_msgs.extend(part_warnings)
+
+        pdfread_warning_msgs = [str(x.message) for x in w] + worker_warning_msgs
 
         def safe_get(attr_name: str) -> str:
             if meta is None:
                 return ""
             return getattr(meta, attr_name, "") or ""
 
+        # full_text は必要になった時に pages から組み立てる
         return ExtractedContent(
-            full_text=full_text,
             pages=pages_text,
             num_pages=num_pages,
             metadata={
@@ -216,63 +497,59 @@ class PDFContentExtractor(ContentExtractor):
         if fitz is None:
             raise RuntimeError("PyMuPDF (fitz) is not installed.")
 
-        doc = fitz.open(str(path))
-        pages_text: List[str] = []
-        for i in range(doc.page_count):
-            page = doc.load_page(i)
-            text = page.get_text("text") or ""
-            pages_text.append(_normalize_newlines(text))
+        with _fitz_lock, fitz.open(str(path)) as doc:
+            num_pages = doc.page_count
+            pages_text = [_normalize_newlines(doc.load_page(i).get_text("text") or "") for i in range(num_pages)]
 
-        full_text = "\n".join(pages_text).strip()
         return ExtractedContent(
-            full_text=full_text,
             pages=pages_text,
-            num_pages=doc.page_count,
+            num_pages=num_pages,
             metadata={
                 "type": "pdf",
             },
         )
 
     def _assess_pdf_quality(self, content: ExtractedContent) -> List[str]:
-        warnings: List[str] = []
+        # 重複は set で吸収し、返す時に1回だけ並べる
+        warnings: set[str] = set()
 
-        text = content.full_text or ""
+        ratios = _content_ratios(content)
 
-        # 基本ヒューリスティック
-        if len(text) < self.min_text_len:
-            warnings.append("low_text_volume")
+        # 基本ヒューリスティック（PDFの本文は strip 済みなので、長さ0 = 空白しかない）
+        if ratios["len"] < self.min_text_len:
+            warnings.add("low_text_volume")
 
-        if _replacement_ratio(text) > self.max_replacement_ratio:
-            warnings.append("replacement_characters_many")
+        if ratios["replacement"] > self.max_replacement_ratio:
+            warnings.add("replacement_characters_many")
         
-        if len(text.strip()) == 0:
-            warnings.append("no_text_extracted")
+        if ratios["len"] == 0:
+            warnings.add("no_text_extracted")
 
         pages = content.pages or []
         if pages:
             empty_pages = sum(1 for p in pages if len((p or "").strip()) == 0)
             empty_ratio = empty_pages / max(len(pages), 1)
             if empty_ratio >= self.empty_page_ratio_threshold:
-                warnings.append("image_pdf_suspected")
+                warnings.add("image_pdf_suspected")
 
         # mojibake（あなたの提示例に対応）
-        c1 = _c1_control_ratio(text)
-        l1 = _latin1_ratio(text)
-        jp = _japanese_ratio(text)
+        c1 = ratios["c1"]
+        l1 = ratios["latin1"]
+        jp = ratios["jp"]
 
         # 推奨判定：
         # - C1制御文字は強いシグナルなので単体でも疑う
         # - Latin-1は補助（日本語比率が低い時に強く疑う）
         if c1 > 0.003:
-            warnings.append("mojibake_suspected")
+            warnings.add("mojibake_suspected")
         elif (l1 > 0.02) and (jp < 0.10):
-            warnings.append("mojibake_suspected")
+            warnings.add("mojibake_suspected")
 
         msgs = content.metadata.get("pypdf2_pdfread_warnings") or []
-        if any("Advanced encoding" in m and "not implemented" in m for m in msgs):
-            warnings.append("pypdf2_advanced_encoding_unimplemented")
-        # warningsの重複を抑える（監査ログを綺麗に）
-        return sorted(set(warnings))
+        if any(_ADVANCED_ENCODING_RE.search(m) for m in msgs):
+            warnings.add("pypdf2_advanced_encoding_unimplemented")
+        # 並びを固定する（監査ログを綺麗に）
+        return sorted(warnings)
 
 
     def _should_fallback(self, warnings: List[str]) -> bool:
@@ -297,16 +574,17 @@ class PDFContentExtractor(ContentExtractor):
             return p_content, "pypdf2", p_warn
 
         # 3) テキスト量(大差がある場合)
-        p_len = len(p_content.full_text or "")
-        m_len = len(m_content.full_text or "")
+        p_len = _content_ratios(p_content)["len"]
+        m_len = _content_ratios(m_content)["len"]
         if m_len > p_len * 1.10:
             return m_content, "pymupdf", m_warn
         if p_len > m_len * 1.10:
             return p_content, "pypdf2", p_warn
 
         # 4) 置換文字比率
-        p_rr = _replacement_ratio(p_content.full_text or "")
-        m_rr = _replacement_ratio(m_content.full_text or "")
+        # 両方とも _assess_pdf_quality で計算済みの比率を使う
+        p_rr = _content_ratios(p_content)["replacement"]
+        m_rr = _content_ratios(m_content)["replacement"]
         if m_rr < p_rr:
             return m_content, "pymupdf", m_warn
         if p_rr < m_rr:
@@ -319,7 +597,7 @@ class PDFContentExtractor(ContentExtractor):
         return p_content, "pypdf2", p_warn
     
     def _quality_metrics(self, content: ExtractedContent, warns: list[str]) -> dict[str, Any]:
-        text = content.full_text or ""
+        ratios = _content_ratios(content)
         pages = content.pages or []
         empty_ratio = None
         if pages:
@@ -327,11 +605,11 @@ class PDFContentExtractor(ContentExtractor):
             empty_ratio = empty_pages / max(len(pages), 1)
 
         return {
-            "len": len(text),
-            "replacement_ratio": _replacement_ratio(text),
-            "c1_ratio": _c1_control_ratio(text),
-            "latin1_ratio": _latin1_ratio(text),
-            "jp_ratio": _japanese_ratio(text),
+            "len": ratios["len"],
+            "replacement_ratio": ratios["replacement"],
+            "c1_ratio": ratios["c1"],
+            "latin1_ratio": ratios["latin1"],
+            "jp_ratio": ratios["jp"],
             "empty_page_ratio": empty_ratio,
             "warnings": warns,
         }
@@ -356,7 +634,7 @@ class TextContentExtractor(ContentExtractor):
         data = path.read_bytes()
         text, used_enc, warnings = _decode_bytes_with_fallback(data, self.encodings)
 
-        if _replacement_ratio(text) > self.max_replacement_ratio:
+        if _text_replacement_ratio(text) > self.max_replacement_ratio:
             warnings.append("replacement_characters_many")
 
         warnings = sorted(set(warnings))
@@ -374,6 +652,19 @@ class TextContentExtractor(ContentExtractor):
         )
 
 
+CSV_DELIMITER_SAMPLE_CHARS = 4096
+CSV_DELIMITER_CANDIDATES = (",", "\t", ";", "|")
+
+
+def _guess_csv_delimiter(sample: str) -> str:
+    """
+    先頭サンプルで最も多く出てくる区切り文字候補を返す（どれも無ければ ","）。
+    csv.Sniffer は pure Python で遅く、日本語の値が多いと空白などを区切りと誤判定しやすいため使わない。
+    """
+    best = max(CSV_DELIMITER_CANDIDATES, key=sample.count)
+    return best if sample.count(best) > 0 else ","
+
+
 # -----------------------------
 # CSV Extractor（表構造を壊さないために key=value 正規化まで実施）
 # -----------------------------
@@ -391,21 +682,17 @@ class CSVContentExtractor(ContentExtractor):
 
     def extract_content(self, path: Path) -> ExtractedContent:
         data = path.read_bytes()
-        text, used_enc, warnings = _decode_bytes_with_fallback(data, self.encodings)
+        text, used_enc, decode_warnings = _decode_bytes_with_fallback(data, self.encodings)
+        # 行ごとの警告も入るので set で持ち、返す時に1回だけ並べる
+        warnings = set(decode_warnings)
 
-        delimiter = ","
-        try:
-            sample = text[:4096]
-            dialect = csv.Sniffer().sniff(sample)
-            delimiter = dialect.delimiter
-        except Exception:
-            warnings.append("csv_dialect_sniff_failed")
+        delimiter = _guess_csv_delimiter(text[:CSV_DELIMITER_SAMPLE_CHARS])
 
-        reader = csv.reader(text.splitlines(), delimiter=delimiter)
-        rows = list(reader)
-        warnings = sorted(set(warnings))
-        if not rows:
-            warnings.append("csv_empty")
+        # 行リストを作らず、文字列から直接1行ずつ読む（text は改行を \n に正規化済み）
+        reader = csv.reader(io.StringIO(text, newline=""), delimiter=delimiter)
+        first_row = next(reader, None)
+        if first_row is None:
+            warnings.add("csv_empty")
             return ExtractedContent(
                 full_text="",
                 metadata={
@@ -413,26 +700,31 @@ class CSVContentExtractor(ContentExtractor):
                     "engine": "csv",
                     "encoding": used_enc,
                     "delimiter": delimiter,
-                    "warnings": warnings,
+                    "warnings": sorted(warnings),
                     "csv_header": [],
                     "rows_per_chunk_hint": self.rows_per_chunk_hint,
                 },
             )
 
-        header = [h.strip() for h in rows[0]]
-        body = rows[1:]
+        # 引用符内の改行は、従来（行に分割してから読んでいた）と同じく詰めて1レコード1行にする
+        header = [h.replace("\n", "").strip() for h in first_row]
+        width = len(header)
+        # "key=" は列ごとに1回だけ作る。key は strip 済みなので f"{k}={v}".strip() と同じになるのは v の末尾だけ
+        prefixes = [f"{k}=" for k in header]
 
         normalized_lines: List[str] = []
-        for row in body:
-            if len(row) != len(header):
-                warnings.append("csv_inconsistent_columns")
-            row2 = (row + [""] * len(header))[: len(header)]
-            kv = [f"{k}={v}".strip() for k, v in zip(header, row2)]
-            normalized_lines.append(" / ".join(kv))
-
-        warnings = sorted(set(warnings))
+        for row in reader:
+            if len(row) != width:
+                warnings.add("csv_inconsistent_columns")
+                row = (row + [""] * width)[:width]
+            line = " / ".join([p + v.rstrip() for p, v in zip(prefixes, row)])
+            if "\n" in line:
+                line = line.replace("\n", "")
+            normalized_lines.append(line)
+
+        # 行リストのまま渡し、取り込み側で結合→再分割しない（full_text は参照時に組み立てる）
         return ExtractedContent(
-            full_text="\n".join(normalized_lines).strip(),
+            rows=normalized_lines,
             pages=None,
             num_pages=None,
             metadata={
@@ -440,7 +732,7 @@ class CSVContentExtractor(ContentExtractor):
                 "engine": "csv",
                 "encoding": used_enc,
                 "delimiter": delimiter,
-                "warnings": warnings,
+                "warnings": sorted(warnings),
                 "csv_header": header,
                 "rows_per_chunk_hint": self.rows_per_chunk_hint,
             },
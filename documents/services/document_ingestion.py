@@ -1,10 +1,13 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Optional, List, Tuple
+import threading
+from typing import Any, Optional, List
 
+from django.conf import settings
 from django.core.files.storage import default_storage
+from django.db import transaction
 
 from documents.models import Document, Chunk
 from langchain_text_splitters import RecursiveCharacterTextSplitter
@@ -13,8 +16,19 @@ from documents.services.embedding_service import EmbeddingService
 from documents.services.content_extractor import get_extractor, ExtractedContent
 
 
-# Embeddingサービスの初期化（現状踏襲）
-embedding_service = EmbeddingService()
+# Embeddingサービスは初回のインジェスト時に生成する（import時にOpenAIクライアントを作らない）
+_embedding_service: EmbeddingService | None = None
+_embedding_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    global _embedding_service
+    # 並列インジェスト(スレッド)から同時に呼ばれても1つだけ生成する
+    if _embedding_service is None:
+        with _embedding_service_lock:
+            if _embedding_service is None:
+                _embedding_service = EmbeddingService()
+    return _embedding_service
 
 
 @dataclass
@@ -24,27 +38,33 @@ class IngestionResult:
     warnings: List[str]
     extractor_metadata: dict[str, Any]
     num_pages: Optional[int] = None
+    # 保存した Chunk の ID（FAISS 登録用。DB から引き直さずに済ませる）
+    chunk_ids: List[int] = field(default_factory=list)
 
 
 class DocumentIngestionService:
+    CHUNK_SIZE = 300
+    CHUNK_OVERLAP = 80
     # 既存値を踏襲しつつ、種別で splitter を使い分け
     pdf_splitter = RecursiveCharacterTextSplitter(
         separators=["\n\n", "\n", "。", "、", " ", ""],
-        chunk_size=300,
-        chunk_overlap=80,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
     )
     text_splitter = RecursiveCharacterTextSplitter(
         separators=["\n\n", "\n", "# ", "## ", "### ", "。", "、", " ", ""],
-        chunk_size=300,
-        chunk_overlap=80,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
     )
     generic_splitter = RecursiveCharacterTextSplitter(
         separators=["\n\n", "\n", "。", "、", " ", ""],
-        chunk_size=300,
-        chunk_overlap=80,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
     )
 
     CSV_LINES_PER_CHUNK_DEFAULT = 20
+    # 1536次元のベクトルを含むので、1回のINSERTに載せる行数を抑える（settings.BULK_CREATE_BATCH_SIZE が優先）
+    BULK_CREATE_BATCH_SIZE = 100
 
     @classmethod
     def ingest_document(cls, document: Document) -> IngestionResult:
@@ -76,17 +96,31 @@ class DocumentIngestionService:
             document.save(update_fields=["num_page"])
 
         # 3. チャンク化（pagesがあればページ単位、なければfull_text）
-        page_chunk_pairs: List[Tuple[Optional[int], str]] = []
+        # ページ番号と本文は別々のリストに積む（chunk_texts をそのまま埋め込みに渡せる）
+        page_indices: List[Optional[int]] = []
+        chunk_texts: List[str] = []
 
         if content.pages:
+            # 分割は順次で行う。split_text は大半が Python 側の結合処理で、re も GIL を手放さないため
+            # スレッドに分けても速くならない（300ページで数十ms程度。埋め込みのAPI待ちに比べて無視できる）
             for page_idx, page_text in enumerate(content.pages, start=1):
                 page_text = (page_text or "").strip()
                 if not page_text:
                     continue
-                for chunk_text in cls.pdf_splitter.split_text(page_text):
-                    ct = chunk_text.strip()
-                    if ct:
-                        page_chunk_pairs.append((page_idx, ct))
+                for chunk_text in cls._split(cls.pdf_splitter, page_text):
+                    if chunk_text and not chunk_text.isspace():
+                        page_indices.append(page_idx)
+                        chunk_texts.append(chunk_text)
+        elif doc_type == "csv" and content.rows is not None:
+            # 抽出時に正規化した行（前後の空白なし）をそのまま使う
+            lines = [ln for ln in content.rows if ln]
+            if not lines:
+                raise IngestionError(
+                    "抽出テキストが空のため、チャンクを生成できません。",
+                    extract_meta=extract_meta,
+                )
+            chunk_texts.extend(cls._chunk_csv_lines(lines, extract_meta))
+            page_indices.extend([None] * len(chunk_texts))
         else:
             full_text = (content.full_text or "").strip()
             if not full_text:
@@ -96,33 +130,33 @@ class DocumentIngestionService:
                 )
 
             if doc_type == "csv":
-                page_chunk_pairs.extend(cls._chunk_csv(full_text, extract_meta))
+                chunk_texts.extend(cls._chunk_csv(full_text, extract_meta))
+                page_indices.extend([None] * len(chunk_texts))
             elif doc_type == "text":
-                for chunk_text in cls.text_splitter.split_text(full_text):
-                    ct = chunk_text.strip()
-                    if ct:
-                        page_chunk_pairs.append((None, ct))
+                for chunk_text in cls._split(cls.text_splitter, full_text):
+                    if chunk_text and not chunk_text.isspace():
+                        page_indices.append(None)
+                        chunk_texts.append(chunk_text)
             else:
-                for chunk_text in cls.generic_splitter.split_text(full_text):
-                    ct = chunk_text.strip()
-                    if ct:
-                        page_chunk_pairs.append((None, ct))
+                for chunk_text in cls._split(cls.generic_splitter, full_text):
+                    if chunk_text and not chunk_text.isspace():
+                        page_indices.append(None)
+                        chunk_texts.append(chunk_text)
 
-        if not page_chunk_pairs:
+        if not chunk_texts:
             raise IngestionError(
                 "チャンクが生成されませんでした（抽出結果が空/分割不能）。",
                 extract_meta=extract_meta,
             )
         
 
-        # 4. 埋め込み
-        chunk_texts = [text for (_, text) in page_chunk_pairs]
-        vectors = embedding_service.embed_chunks(chunk_texts)
-
-        # 5. Chunkをbulk_create
-        chunk_objs: list[Chunk] = []
-        for idx, ((page_idx, chunk_text), vec) in enumerate(zip(page_chunk_pairs, vectors)):
-            chunk_objs.append(
+        # 4. 埋め込み → 5. Chunkをbulk_create
+        # 埋め込みはバッチ単位で並行に進むので、届いたバッチから順に Chunk を組み立てて残りの API 待ちと重ねる。
+        # INSERT は全バッチが揃ってから1つのトランザクションで行う（API 待ちの間トランザクションを開いたままにしない）
+        chunk_objs: List[Chunk] = []
+        for batch_vectors in get_embedding_service().iter_embed_chunks(chunk_texts, known=cls._stored_embeddings(document)):
+            start, end = len(chunk_objs), len(chunk_objs) + len(batch_vectors)
+            chunk_objs.extend(
                 Chunk(
                     document=document,
                     chunk_index=idx,
@@ -130,40 +164,76 @@ class DocumentIngestionService:
                     content=chunk_text,
                     embedding=vec,
                 )
+                for idx, (page_idx, chunk_text, vec) in enumerate(
+                    zip(page_indices[start:end], chunk_texts[start:end], batch_vectors), start=start
+                )
             )
 
-        Chunk.objects.bulk_create(chunk_objs)
+        batch_size = getattr(settings, "BULK_CREATE_BATCH_SIZE", None) or cls.BULK_CREATE_BATCH_SIZE
+        with transaction.atomic():
+            # 1文のINSERTが巨大にならないよう batch_size 件ずつ
+            Chunk.objects.bulk_create(chunk_objs, batch_size=batch_size)
+        # PostgreSQL の bulk_create は RETURNING で pk を埋めて返す
+        chunk_ids = [c.pk for c in chunk_objs]
+        chunk_count = len(chunk_objs)
 
         return IngestionResult(
-            chunk_count=len(chunk_objs),
+            chunk_count=chunk_count,
             extractor_engine=engine,
             warnings=warnings,
             extractor_metadata=extract_meta,
             num_pages=content.num_pages,
+            chunk_ids=chunk_ids,
         )
 
+    @staticmethod
+    def _stored_embeddings(document: Document) -> dict[str, list[float]]:
+        """
+        取り込み直し(再インデックス)のとき、この文書の既存チャンクの 本文 → 埋め込み を返す。
+        本文が変わっていないチャンクは保存済みの埋め込みを使い回し、API で埋め込み直さない。
+        埋め込みモデルを変えて取り込み直すときは settings.EMBEDDING_REUSE_ENABLED を無効にする。
+        """
+        if not getattr(settings, "EMBEDDING_REUSE_ENABLED", True):
+            return {}
+        return dict(document.chunks.filter(embedding__isnull=False).values_list("content", "embedding"))
+
     @classmethod
-    def _chunk_csv(cls, full_text: str, meta: dict[str, Any]) -> List[Tuple[Optional[int], str]]:
+    def _split(cls, splitter: RecursiveCharacterTextSplitter, text: str) -> List[str]:
+        """
+        CHUNK_SIZE 未満の（strip 済み）テキストは分割しても自分自身の1チャンクにしかならないので、
+        区切り文字の走査・再結合を省いてそのまま返す。短いページが多いPDFで効く。
+        splitter は strip_whitespace=True（既定）なので、返るチャンクは前後の空白が除かれている。
+        """
+        if len(text) < cls.CHUNK_SIZE:
+            return [text]
+        return splitter.split_text(text)
+
+    @classmethod
+    def _chunk_csv(cls, full_text: str, meta: dict[str, Any]) -> List[str]:
         """
         full_text: 1行=1レコードの key=value 正規化済み想定
         - ヘッダを各チャンクに付与
         - N行ずつまとめてチャンク化（表構造を壊しにくい）
         """
-        header = meta.get("csv_header") or []
-        header_line = f"CSVヘッダ: {', '.join(header)}" if header else ""
-
         lines = [ln.strip() for ln in full_text.splitlines() if ln.strip()]
+        return cls._chunk_csv_lines(lines, meta)
+
+    @classmethod
+    def _chunk_csv_lines(cls, lines: List[str], meta: dict[str, Any]) -> List[str]:
+        """lines: 空行を除いた正規化済みの行"""
         if not lines:
             return []
 
+        header = meta.get("csv_header") or []
+        header_line = f"CSVヘッダ: {', '.join(header)}" if header else ""
+
         n = int(meta.get("rows_per_chunk_hint") or cls.CSV_LINES_PER_CHUNK_DEFAULT)
 
-        pairs: List[Tuple[Optional[int], str]] = []
+        chunks: List[str] = []
         for i in range(0, len(lines), n):
             block = "\n".join(lines[i : i + n])
-            chunk_text = f"{header_line}\n{block}".strip() if header_line else block
-            pairs.append((None, chunk_text))
-        return pairs
+            chunks.append(f"{header_line}\n{block}".strip() if header_line else block)
+        return chunks
 # -----------------------------
 # 例外クラス
 # -----------------------------
@@ -2,34 +2,46 @@
 from __future__ import annotations
 
 from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+import logging
 
 from django.core.files.storage import default_storage
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Max
 from django.conf import settings
 
-from documents.models import Document, AuditLog
+from documents.models import Document, Chunk, AuditLog
+from documents.signals import documents_changed
 from documents.services.document_ingestion import DocumentIngestionService, IngestionResult
 from documents.search_backends.faiss_backend import FaissSearchBackend
 
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4)
+def _faiss_backend_for(index_path: str) -> FaissSearchBackend:
+    return FaissSearchBackend(index_path=index_path)
+
 
 def _get_faiss_backend() -> FaissSearchBackend:
-    return FaissSearchBackend(index_path=settings.FAISS_INDEX_PATH)
+    # 呼び出しのたびに index を読み直さないよう、index ファイルごとに1インスタンスを使い回す
+    # （他プロセスが保存した更新は、index_chunks 等の中で mtime を見てリロードされる）
+    return _faiss_backend_for(str(settings.FAISS_INDEX_PATH))
 
 
 def upload_document(*, actor, uploaded_file, department) -> Document:
     """
     アップロード → Document作成 → ingest → FAISS登録 → 監査ログ
-    （同期インジェスト）
+    （settings.DOCUMENT_INGEST_ASYNC なら、ingest 以降はリクエスト外のワーカーで行う）
     """
-    subdir = f"documents/{getattr(department, 'code', department.id)}"
-    relative_path = f"{subdir}/{uploaded_file.name}"
     file_path = None
     document = None
     try:
         # 1. ファイル保存
-        file_path = default_storage.save(relative_path, uploaded_file)
+        file_path = default_storage.save(_upload_relative_path(uploaded_file, department), uploaded_file)
 
         # 2. Document作成
         document = Document.objects.create(
@@ -39,71 +51,176 @@ def upload_document(*, actor, uploaded_file, department) -> Document:
             uploaded_by=actor,
         )
 
-        # 3. ingest（Chunk + embedding をDBへ）
-        result: IngestionResult = DocumentIngestionService.ingest_document(document)
+        if getattr(settings, "DOCUMENT_INGEST_ASYNC", False):
+            # 抽出・埋め込み(外部API)は大きいPDFだと数十秒かかるので、リクエストはここで返す
+            from documents.tasks import enqueue_ingest_and_index
 
-        # 4. FAISSへ即登録
-        chunk_ids = list(document.chunks.values_list("id", flat=True))
-        faiss = _get_faiss_backend()
-        if chunk_ids:
-            faiss.index_chunks(chunk_ids)
+            enqueue_ingest_and_index(document.id, getattr(actor, "id", None))
+            return document
 
-        # 5. 監査ログ（engine/warningsも残す）
-        AuditLog.objects.create(
+        # 3〜5. ingest → FAISS登録 → 監査ログ
+        ingest_and_index_document(actor=actor, document=document)
+        return document
+
+    except Exception as e:
+        _rollback_failed_upload(
             actor=actor,
-            action=AuditLog.Action.UPLOAD,
-            status=AuditLog.Status.SUCCESS,
-            document=document,
             department=department,
-            message="アップロード時に即インジェスト・即インデックス",
-            meta={
-                "file_path": file_path,
-                "file_ext": Path(file_path).suffix.lower(),
-                "chunk_count": result.chunk_count,
-                "extract_engine": result.extractor_engine,
-                "extract_warnings": result.warnings,
-                # ログ肥大化を避けるために必要最小限キーのみ抽出
-                "extract_meta": {
-                    k: result.extractor_metadata.get(k)
-                    for k in ["type", "engine", "warnings", "encoding", "delimiter", "fallback", "csv_header"]
-                    if k in (result.extractor_metadata or {})
-                },
-            },
+            document=document,
+            file_path=file_path,
+            filename=getattr(uploaded_file, "name", ""),
+            error=e,
         )
+        raise
 
-        return document
 
-    except Exception as e:
-        extract_meta = getattr(e, "extract_meta", None)
-        # 補償削除（ベストエフォート）
-        if document is not None:
-            try:
-                document.delete()
-            except Exception:
-                pass
-        if file_path:
+def ingest_and_index_document(*, actor, document: Document) -> IngestionResult:
+    """保存済みの Document を ingest し、FAISS に登録して監査ログを残す。失敗時は例外をそのまま投げる"""
+    # 3. ingest（Chunk + embedding をDBへ）
+    result: IngestionResult = DocumentIngestionService.ingest_document(document)
+
+    # 4. FAISSへ即登録（保存した Chunk の ID は ingest の結果から受け取る）
+    faiss = _get_faiss_backend()
+    if result.chunk_ids:
+        faiss.index_chunks(result.chunk_ids)
+    documents_changed.send(sender=__name__)
+
+    # 5. 監査ログ（engine/warningsも残す）
+    _upload_success_log(actor=actor, document=document, result=result).save()
+    return result
+
+
+def upload_documents_batch(*, actor, uploaded_files, department) -> list[Document]:
+    """
+    複数ファイルのアップロード。取り込みはファイルごとに行い、FAISS 登録と成功の監査ログは最後にまとめて1回で行う
+    （index ファイルの書き出しがファイル数ぶん走らない）。
+    失敗したファイルは単体アップロードと同じく補償削除して失敗ログを残し、残りのファイルは続ける。
+    戻り値は取り込めた Document のリスト。
+    """
+    if getattr(settings, "DOCUMENT_INGEST_ASYNC", False):
+        # 取り込みはワーカー側で1件ずつ行うので、ここでまとめるものはない
+        documents = []
+        for uploaded_file in uploaded_files:
             try:
-                default_storage.delete(file_path)
+                documents.append(upload_document(actor=actor, uploaded_file=uploaded_file, department=department))
             except Exception:
-                pass
+                # 補償削除と失敗の監査ログは upload_document 側で済んでいる。残りのファイルは続ける
+                logger.exception(
+                    "documents:upload failed filename=%s", getattr(uploaded_file, "name", "")
+                )
+        return documents
+
+    ingested: list[tuple[Document, IngestionResult]] = []
+    for uploaded_file in uploaded_files:
+        file_path = None
+        document = None
+        try:
+            file_path = default_storage.save(_upload_relative_path(uploaded_file, department), uploaded_file)
+            document = Document.objects.create(
+                title=uploaded_file.name,
+                file_path=file_path,
+                department=department,
+                uploaded_by=actor,
+            )
+            ingested.append((document, DocumentIngestionService.ingest_document(document)))
+        except Exception as e:
+            _rollback_failed_upload(
+                actor=actor,
+                department=department,
+                document=document,
+                file_path=file_path,
+                filename=getattr(uploaded_file, "name", ""),
+                error=e,
+            )
 
-        AuditLog.objects.create(
-            actor=actor,
-            action=AuditLog.Action.UPLOAD,
-            status=AuditLog.Status.FAILED,
-            document=None,
-            department=department,
-            message="アップロード処理失敗",
-            meta={
-                "filename": getattr(uploaded_file, "name", ""),
-                "file_ext": Path(getattr(uploaded_file, "name", "")).suffix.lower(),
-                "error": str(e),
-                "extract_meta": extract_meta,
-                "extract_engine": (extract_meta or {}).get("engine"),
-                "extract_warnings": (extract_meta or {}).get("warnings"),
+    if not ingested:
+        return []
+
+    chunk_ids = [chunk_id for _, result in ingested for chunk_id in result.chunk_ids]
+    try:
+        if chunk_ids:
+            _get_faiss_backend().index_chunks(chunk_ids)
+    except Exception as e:
+        # 検索できない文書を残さないよう、単体アップロードと同じく取り込んだ分も取り消す
+        for document, _ in ingested:
+            _rollback_failed_upload(
+                actor=actor,
+                department=department,
+                document=document,
+                file_path=document.file_path,
+                filename=document.title,
+                error=e,
+            )
+        return []
+    documents_changed.send(sender=__name__)
+
+    AuditLog.objects.bulk_create(
+        [_upload_success_log(actor=actor, document=document, result=result) for document, result in ingested]
+    )
+    return [document for document, _ in ingested]
+
+
+def _upload_relative_path(uploaded_file, department) -> str:
+    subdir = f"documents/{getattr(department, 'code', department.id)}"
+    return f"{subdir}/{uploaded_file.name}"
+
+
+def _upload_success_log(*, actor, document: Document, result: IngestionResult) -> AuditLog:
+    """アップロード成功の監査ログ（未保存）。engine/warnings も残す"""
+    file_path = document.file_path
+    return AuditLog(
+        actor=actor,
+        action=AuditLog.Action.UPLOAD,
+        status=AuditLog.Status.SUCCESS,
+        document=document,
+        department_id=document.department_id,
+        message="アップロード時に即インジェスト・即インデックス",
+        meta={
+            "file_path": file_path,
+            "file_ext": Path(file_path).suffix.lower(),
+            "chunk_count": result.chunk_count,
+            "extract_engine": result.extractor_engine,
+            "extract_warnings": result.warnings,
+            # ログ肥大化を避けるために必要最小限キーのみ抽出
+            "extract_meta": {
+                k: result.extractor_metadata.get(k)
+                for k in ["type", "engine", "warnings", "encoding", "delimiter", "fallback", "csv_header"]
+                if k in (result.extractor_metadata or {})
             },
-        )
-        raise
+        },
+    )
+
+
+def _rollback_failed_upload(*, actor, department, document, file_path, filename: str, error: Exception) -> None:
+    """アップロード失敗時の補償削除（ベストエフォート）と失敗の監査ログ"""
+    extract_meta = getattr(error, "extract_meta", None)
+    if document is not None:
+        try:
+            document.delete()
+        except Exception:
+            pass
+    if file_path:
+        try:
+            default_storage.delete(file_path)
+        except Exception:
+            pass
+
+    AuditLog.objects.create(
+        actor=actor,
+        action=AuditLog.Action.UPLOAD,
+        status=AuditLog.Status.FAILED,
+        document=None,
+        department=department,
+        message="アップロード処理失敗",
+        meta={
+            "filename": filename,
+            "file_ext": Path(filename).suffix.lower(),
+            "error": str(error),
+            "extract_meta": extract_meta,
+            "extract_engine": (extract_meta or {}).get("engine"),
+            "extract_warnings": (extract_meta or {}).get("warnings"),
+        },
+    )
 
 
 def delete_document(*, actor, document: Document) -> None:
@@ -119,8 +236,13 @@ def delete_document(*, actor, document: Document) -> None:
 
     try:
         with transaction.atomic():
-            # 1. FAISSからChunk削除
-            chunk_ids = list(document.chunks.values_list("id", flat=True))
+            # 1. Chunk削除 → FAISSからも削除
+            # ID の SELECT と DELETE を分けず、消した行の ID を RETURNING で受け取る
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {Chunk._meta.db_table} WHERE document_id = %s RETURNING id", [document.id]
+                )
+                chunk_ids = [row[0] for row in cursor.fetchall()]
             if chunk_ids:
                 faiss = _get_faiss_backend()
                 faiss.delete_chunks(chunk_ids)
@@ -129,8 +251,9 @@ def delete_document(*, actor, document: Document) -> None:
             if document.file_path:
                 default_storage.delete(document.file_path)
 
-            # 3. Document削除（ChunkはCASCADE）
+            # 3. Document削除（Chunk は削除済みなので CASCADE で消す行はない）
             document.delete()
+        documents_changed.send(sender=__name__)
 
         AuditLog.objects.create(
             actor=actor,
@@ -155,46 +278,132 @@ def delete_document(*, actor, document: Document) -> None:
         raise
 
 
+# 全件再インデックスで、差し替え前のチャンクを1回の DELETE で消す文書数
+REINDEX_DELETE_BATCH_SIZE = 5000
+# FAISS を差分で更新するチャンク数の上限。index_chunks は対象を一度に埋め込むので、
+# これを超えるときは 256 件ずつ流す rebuild_index に任せる
+REINDEX_INCREMENTAL_MAX_CHUNKS = 50_000
+
+
+def sync_document_department(sender, instance: Document, created: bool = False, update_fields=None, **kwargs) -> None:
+    """
+    Document の部門が管理画面などで変更されたら、FAISS の部門対応表を付け替える（post_save の receiver）。
+    付け替えた場合は、部門ごとの回答キャッシュ・ルーティングも古くなるので documents_changed を送る。
+    """
+    if created or (update_fields is not None and "department" not in update_fields):
+        return
+    if not Path(settings.FAISS_INDEX_PATH).exists():
+        return
+    document_id, department_id = instance.id, instance.department_id
+
+    def _sync():
+        if _get_faiss_backend().update_document_department(document_id, department_id):
+            documents_changed.send(sender=__name__)
+
+    # 保存がロールバックされた場合に対応表だけ書き換わらないよう、コミット後に行う
+    transaction.on_commit(_sync)
+
+
+def _reindex_one(doc: Document, close_connection: bool = False):
+    """1文書を取り込み直し、(doc, result, error) を返す。例外は呼び出し側で集計するため投げない"""
+    try:
+        # Chunk の INSERT は ingest_document の中で1トランザクションにまとまっている。
+        # ここで外側のトランザクションを張ると、埋め込み(API待ち)の間も開いたままになるので張らない
+        return doc, DocumentIngestionService.ingest_document(doc), None
+    except Exception as e:
+        return doc, None, e
+    finally:
+        # ワーカースレッドはそれぞれ自分の DB 接続を開くので、使い終わったら閉じる
+        if close_connection:
+            connection.close()
+
+
 def reindex_all_documents(*, actor) -> dict:
     total = Document.objects.count()
+    # これ以下のIDが差し替え前のチャンク（新しく作るチャンクは必ずこれより大きいIDになる）
+    old_max_chunk_id = Chunk.objects.aggregate(max_id=Max("id"))["max_id"] or 0
+    replaced_doc_ids: list[int] = []
     success = 0
     failed = 0
     failures: list[dict] = []
 
-    engine_counts = Counter()
-    warning_counts = Counter()
+    # 件数は最後に Counter でまとめて数える（文書ごとに dict を更新しない）
+    engine_names: list[str] = []
+    warning_names: list[str] = []
 
-    qs = Document.objects.all().order_by("id")
-
-    for doc in qs:
-        try:
-            with transaction.atomic():
-                doc.chunks.all().delete()
-                result: IngestionResult = DocumentIngestionService.ingest_document(doc)
-
-            success += 1
-            engine_counts[result.extractor_engine] += 1
-            for w in (result.warnings or []):
-                warning_counts[w] += 1
+    # 全件をメモリに載せず、200件ずつ読みながら処理する（取り込みで使う列だけ読む）
+    qs = (
+        Document.objects.all()
+        .order_by("id")
+        .only("id", "title", "department_id", "file_path")
+        .iterator(chunk_size=200)
+    )
 
-        except Exception as e:
+    def collect(doc, result, error) -> None:
+        nonlocal success, failed
+        if error is not None:
             failed += 1
             failures.append(
-                {"document_id": doc.id, "title": doc.title, "error": str(e)}
+                {"document_id": doc.id, "title": doc.title, "error": str(error)}
             )
+            return
+        replaced_doc_ids.append(doc.id)
+        success += 1
+        engine_names.append(result.extractor_engine)
+        warning_names.extend(result.warnings or [])
+
+    concurrency = max(1, getattr(settings, "REINDEX_CONCURRENCY", 1))
+    if concurrency == 1:
+        for doc in qs:
+            collect(*_reindex_one(doc))
+    else:
+        # 文書ごとの取り込みは独立しているのでスレッドで並べる（埋め込みAPI待ちとPDF抽出を重ねる）。
+        # 投入済みの文書数は 2×スレッド数 までにして、iterator で読んだ文書を溜め込まない
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="reindex") as pool:
+            pending = set()
+            for doc in qs:
+                pending.add(pool.submit(_reindex_one, doc, close_connection=True))
+                if len(pending) >= concurrency * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(*future.result())
+            for future in pending:
+                collect(*future.result())
+        # 完了順に集まるので、監査ログの並びは従来どおり文書ID順にそろえる
+        replaced_doc_ids.sort()
+        failures.sort(key=lambda f: f["document_id"])
+
+    # 取り込めた文書の古いチャンクを文書ごとではなくまとめて消す。
+    # 失敗した文書は従来どおり古いチャンクを残す（検索対象から消えない）
+    stale_chunk_ids: list[int] = []
+    new_chunk_ids: list[int] = []
+    for i in range(0, len(replaced_doc_ids), REINDEX_DELETE_BATCH_SIZE):
+        doc_ids = replaced_doc_ids[i : i + REINDEX_DELETE_BATCH_SIZE]
+        stale_qs = Chunk.objects.filter(document_id__in=doc_ids, id__lte=old_max_chunk_id)
+        stale_chunk_ids.extend(stale_qs.values_list("id", flat=True))
+        new_chunk_ids.extend(
+            Chunk.objects.filter(document_id__in=doc_ids, id__gt=old_max_chunk_id).values_list("id", flat=True)
+        )
+        stale_qs.delete()
 
+    # 変わったチャンクだけ FAISS を更新する。全件作り直すのは IVF の学習し直しが要るときだけ。
+    # 新しいチャンクを先に足してから古いチャンクを外す（途中で検索にヒットしない時間を作らない）
     faiss = _get_faiss_backend()
-    faiss.rebuild_index()
+    if len(new_chunk_ids) > REINDEX_INCREMENTAL_MAX_CHUNKS or faiss.needs_rebuild():
+        faiss.rebuild_index()
+    else:
+        faiss.index_chunks(new_chunk_ids)
+        faiss.delete_chunks(stale_chunk_ids)
+    documents_changed.send(sender=__name__)
 
-    
     meta = {
         "scope": "all",
         "total_documents": total,
         "success_documents": success,
         "failed_documents": failed,
         "failures": failures[:50],
-        "engine_counts": dict(engine_counts),
-        "warning_counts": dict(warning_counts),
+        "engine_counts": dict(Counter(engine_names)),
+        "warning_counts": dict(Counter(warning_names)),
     }
 
     AuditLog.objects.create(
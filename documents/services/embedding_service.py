@@ -1,22 +1,158 @@
+from collections import deque
+from collections.abc import Iterator, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+
+import httpx
+import numpy as np
 from langchain_openai import OpenAIEmbeddings
-from django.conf import settings
+
+# 大きなドキュメントの埋め込みをバッチ単位で並行してAPIに投げるためのスレッドプール
+_embed_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="embed-batch")
+
+# OpenAIEmbeddings はプロセスで1つを共有する（インスタンスごとに HTTP クライアントと TLS 接続を作り直さない）
+_shared_embeddings: OpenAIEmbeddings | None = None
+_shared_embeddings_lock = threading.Lock()
+
+
 class EmbeddingService:
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-small",
-            )
+    MODEL = "text-embedding-3-small"
+    # text-embedding-3-small の出力次元数。検索バックエンドはこれを見て、起動時の試し埋め込み(API呼び出し)を省く
+    dimension = 1536
+    # 同一モデル・同一テキストの埋め込みは決定的なので、クエリ側はプロセス内でメモ化する
+    QUERY_CACHE_SIZE = 1024
+    # 1リクエストで送るチャンク数。これを超える分はバッチに分けて並行で埋め込む
+    EMBED_BATCH_SIZE = 256
+    # 同時に投げておくバッチ数の上限。取り出されていない結果(ベクトル)をこれ以上抱えない
+    MAX_BATCHES_IN_FLIGHT = 8
+    # バッチを並行で投げると 429(レート制限)に当たりやすい。OpenAI クライアントの再試行
+    # （Retry-After に従う指数バックオフ+ジッタ）の回数を既定の2回より増やしておく
+    MAX_RETRIES = 6
+
+    def __init__(self, batch_size: int | None = None, max_in_flight: int | None = None):
+        """batch_size / max_in_flight を渡すと EMBED_BATCH_SIZE / MAX_BATCHES_IN_FLIGHT をこのインスタンスだけ変える"""
+        if batch_size is not None:
+            self.EMBED_BATCH_SIZE = batch_size
+        if max_in_flight is not None:
+            self.MAX_BATCHES_IN_FLIGHT = max_in_flight
+        self.embeddings = self._get_shared_embeddings()
+        self._embed_query_cached = lru_cache(maxsize=self.QUERY_CACHE_SIZE)(self._embed_query)
+
+    @classmethod
+    def _get_shared_embeddings(cls) -> OpenAIEmbeddings:
+        """
+        共有の OpenAIEmbeddings を返す。最初の呼び出しで作る。
+        バッチを並行で投げるので、keep-alive の接続を並行数ぶん残せるプールを持たせる。
+        """
+        global _shared_embeddings
+        if _shared_embeddings is None:
+            with _shared_embeddings_lock:
+                if _shared_embeddings is None:
+                    http_client = httpx.Client(
+                        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                        timeout=httpx.Timeout(60.0, connect=5.0),
+                    )
+                    _shared_embeddings = OpenAIEmbeddings(
+                        model=cls.MODEL,
+                        max_retries=cls.MAX_RETRIES,
+                        http_client=http_client,
+                    )
+        return _shared_embeddings
+
+    def embed_chunks(self, chunks: list[str]) -> np.ndarray:
+        """
+        複数テキスト(チャンク)用。(FAISS への登録時に使います。)
+        戻り値：(チャンク数, 次元数) の float32 配列。FAISS にはコピーせずそのまま渡せる
+        バッチ数が多い場合は並行で呼び出し、待ち時間をバッチ合計から最も遅いバッチ程度に抑える
+        届いたバッチから結果の配列に書き込むので、全件ぶんの list[list[float]] は作らない
+        """
+        if not chunks:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        vectors: np.ndarray | None = None
+        start = 0
+        for batch_vectors in self.iter_embed_chunks(chunks):
+            if vectors is None:
+                # 次元数は最初のバッチから決める（モデルの既定値と違う次元でも動くように）
+                vectors = np.empty((len(chunks), len(batch_vectors[0])), dtype=np.float32)
+            end = start + len(batch_vectors)
+            vectors[start:end] = batch_vectors
+            start = end
+        return vectors
+
+    def iter_embed_chunks(
+        self, chunks: list[str], known: Mapping[str, Sequence[float]] | None = None
+    ) -> Iterator[list[Sequence[float]]]:
+        """
+        embed_chunks と同じ埋め込みを、EMBED_BATCH_SIZE 件ごとのバッチ単位で入力順に返す。
+        API で埋め込むのは known(本文 → 保存済みの埋め込み)にない本文だけで、同じ本文が何度出てきても1回だけにする。
+        """
+        if not chunks:
+            return
+        vectors: dict[str, Sequence[float]] = dict(known or {})
+        # まだ埋め込みのない本文を、重複を除いて入力順に並べる（先頭のバッチから順に埋まるように）
+        miss_texts = list(dict.fromkeys(chunk for chunk in chunks if chunk not in vectors))
+        if not known and len(miss_texts) == len(chunks):
+            # 使い回せるものがなければ、そのまま API のバッチを返す
+            yield from self._iter_embed_uncached(chunks)
+            return
+        misses = self._iter_embed_uncached(miss_texts)
 
-    def embed_chunks(self, chunks: list[str]) -> list[list[float]]:
+        size = self.EMBED_BATCH_SIZE
+        received = 0
+        try:
+            for start in range(0, len(chunks), size):
+                window = chunks[start : start + size]
+                # このバッチの本文がすべて揃うまで、埋め込み結果を受け取る
+                while any(chunk not in vectors for chunk in window):
+                    batch_vectors = next(misses)
+                    vectors.update(zip(miss_texts[received : received + len(batch_vectors)], batch_vectors))
+                    received += len(batch_vectors)
+                yield [vectors[chunk] for chunk in window]
+        finally:
+            misses.close()
+
+    def _iter_embed_uncached(self, chunks: list[str]) -> Iterator[list[list[float]]]:
         """
-        複数テキスト(チャンク)用。(ドキュメント登録時に使います。)
-        戻り値：「ベクトル、ベクトル、…」のlist[list[float]]
+        chunks を EMBED_BATCH_SIZE 件ごとに API で埋め込み、バッチ単位で入力順に返す。
+        先のバッチを MAX_BATCHES_IN_FLIGHT 個まで投げておくので、呼び出し側が先頭バッチを処理している間も
+        埋め込みが進む。1バッチ取り出されるごとに次を投げるため、手元のベクトルは文書の大きさによらず一定量に収まる。
         """
-        return self.embeddings.embed_documents(chunks)
+        size = self.EMBED_BATCH_SIZE
+        if len(chunks) <= size:
+            yield self.embeddings.embed_documents(chunks)
+            return
+
+        starts = iter(range(0, len(chunks), size))
+        in_flight = deque()
+
+        def submit_next() -> None:
+            start = next(starts, None)
+            if start is not None:
+                in_flight.append(_embed_executor.submit(self.embeddings.embed_documents, chunks[start : start + size]))
+
+        for _ in range(self.MAX_BATCHES_IN_FLIGHT):
+            submit_next()
+        try:
+            # 投げた順に取り出すので、チャンクとベクトルの対応は崩れない
+            while in_flight:
+                batch_vectors = in_flight.popleft().result()
+                submit_next()
+                yield batch_vectors
+        finally:
+            # 途中で失敗・中断したら、まだ始まっていないバッチは API を呼ばずに捨てる
+            for future in in_flight:
+                future.cancel()
     
     def embed_text(self, text: str) -> list[float]:
         """
         単一テキストをベクトル化します。
         ユーザの質問用に使用
+        同じテキストの2回目以降はAPIを呼ばずにキャッシュから返す
         戻り値:１本のベクトル
         """
-        return self.embeddings.embed_query(text)
\ No newline at end of file
+        return list(self._embed_query_cached(text))
+
+    def _embed_query(self, text: str) -> tuple[float, ...]:
+        # キャッシュ内の値が呼び出し側で書き換えられないよう tuple で保持する
+        return tuple(self.embeddings.embed_query(text))
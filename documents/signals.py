@@ -0,0 +1,12 @@
+from django.dispatch import Signal
+
+# 文書の取り込み・削除・再インデックスで検索対象が変わったときに送る（sender は呼び出し元のモジュール名）。
+# 検索結果から作った回答をキャッシュしている側は、これを受けて破棄する
+documents_changed = Signal()
+
+
+def document_saved(sender, instance, **kwargs) -> None:
+    """Document の post_save receiver。FAISS など重い依存は、実際に保存されたときに初めて import する"""
+    from documents.services.document_service import sync_document_department
+
+    sync_document_department(sender, instance, **kwargs)
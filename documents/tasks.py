@@ -0,0 +1,55 @@
+"""
+アップロード後の取り込み（抽出→埋め込み→FAISS登録→監査ログ）をリクエスト外で行う。
+settings.DOCUMENT_INGEST_ASYNC が有効なときに upload_document から使われる。
+"""
+from __future__ import annotations
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+from documents.models import Document
+
+logger = logging.getLogger(__name__)
+
+# 取り込みは1件ずつ順に流す（埋め込みAPIのバッチ並行は EmbeddingService 側で行っている）
+_ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="document-ingest")
+
+
+def enqueue_ingest_and_index(document_id: int, actor_id: int | None) -> None:
+    """Document 行がコミットされてから、ワーカースレッドで取り込みを始める"""
+    transaction.on_commit(lambda: _ingest_executor.submit(ingest_and_index, document_id, actor_id))
+
+
+def ingest_and_index(document_id: int, actor_id: int | None) -> None:
+    """
+    保存済みの Document を取り込む。結果(成功/失敗)は監査ログに残す。
+    失敗したら同期アップロードと同じく Document とファイルを消す。
+    """
+    from documents.services.document_service import _rollback_failed_upload, ingest_and_index_document
+
+    try:
+        document = Document.objects.filter(id=document_id).first()
+        if document is None:
+            # 取り込み前に削除された
+            return
+        actor = get_user_model().objects.filter(id=actor_id).first() if actor_id is not None else None
+        try:
+            ingest_and_index_document(actor=actor, document=document)
+        except Exception as e:
+            logger.exception("documents:ingest failed document_id=%d", document_id)
+            _rollback_failed_upload(
+                actor=actor,
+                department=document.department,
+                document=document,
+                file_path=document.file_path,
+                filename=document.title,
+                error=e,
+            )
+    except Exception:
+        logger.exception("documents:ingest task crashed document_id=%d", document_id)
+    finally:
+        # ワーカースレッドの DB 接続は使い終わったら閉じる
+        connection.close()
@@ -0,0 +1,248 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from documents.services import content_extractor
+from documents.services.content_extractor import (
+    PARALLEL_MIN_PAGES,
+    CSVContentExtractor,
+    ExtractedContent,
+    PDFContentExtractor,
+    _classify_codepoints,
+    _codepoints,
+    _compute_all_ratios,
+    _content_ratios,
+    _decode_bytes_with_fallback,
+    _guess_csv_delimiter,
+    _text_replacement_ratio,
+)
+
+
+class TextRatioTests(unittest.TestCase):
+    def test_ratios_count_codepoint_ranges(self):
+        # ひらがな2 + 漢字1 + 半角カナ1 + C1制御1 + Latin-1 1 + 置換文字1 + ASCII 1 + 絵文字(サロゲート外)1
+        cp = _codepoints("あい漢ｱ\x85é\ufffdA😀")
+        self.assertEqual(cp.size, 9)
+        self.assertEqual(_classify_codepoints(cp), (1, 1, 1, 4))
+        self.assertAlmostEqual(_text_replacement_ratio("あい漢ｱ\x85é\ufffdA😀"), 1 / 9)
+
+    @unittest.skipIf(content_extractor._classify_codepoints_nb is None, "numba is not installed")
+    def test_numba_kernel_matches_numpy(self):
+        cp = _codepoints("日本語のテキスト abc é\x85\ufffdｶﾅ" * 50)
+        with mock.patch.object(content_extractor, "_classify_codepoints_nb", None):
+            expected = _classify_codepoints(cp)
+        self.assertEqual(_classify_codepoints(cp), expected)
+
+    def test_empty_text(self):
+        self.assertEqual(set(_compute_all_ratios("").values()), {0.0})
+        self.assertEqual(_text_replacement_ratio(""), 0.0)
+
+    def test_content_ratios_are_cached_per_text(self):
+        content = ExtractedContent(full_text="あいう\ufffd")
+        first = _content_ratios(content)
+        self.assertIs(_content_ratios(content), first)
+        self.assertAlmostEqual(first["replacement"], 1 / 4)
+
+        content.full_text = "abcd"
+        self.assertEqual(_content_ratios(content)["jp"], 0.0)
+
+    def test_pages_only_content_counts_without_joining(self):
+        pages = ["  \n", "\xa0\x85あい\ufffd", "", "é漢字 ", "\x85\n ", " "]
+        lazy = ExtractedContent(pages=pages)
+        ratios = _content_ratios(lazy)
+        self.assertIsNone(lazy._full_text)
+
+        joined = ExtractedContent(full_text="\n".join(pages).strip())
+        self.assertEqual(ratios, _content_ratios(joined))
+        self.assertEqual(lazy.full_text, joined.full_text)
+        self.assertEqual(ratios["len"], len(joined.full_text))
+
+
+class DecodeFallbackTests(unittest.TestCase):
+    ENCODINGS = ["utf-8-sig", "utf-8", "cp932", "shift_jis", "euc_jp", "iso2022_jp"]
+    TEXT = "社内規程：経費精算の手続きについて。申請は月末までに行うこと。\n" * 20
+
+    def test_legacy_encodings_decode_with_and_without_detector(self):
+        for detector in (content_extractor._detect_charset, None):
+            with mock.patch.object(content_extractor, "_detect_charset", detector):
+                for enc in ("utf-8", "cp932", "euc_jp"):
+                    with self.subTest(detector=detector is not None, enc=enc):
+                        text, used, warnings = _decode_bytes_with_fallback(self.TEXT.encode(enc), self.ENCODINGS)
+                        self.assertEqual(text, self.TEXT)
+                        self.assertEqual(warnings, [])
+
+    def test_utf8_does_not_run_detector(self):
+        with mock.patch.object(content_extractor, "_detect_charset") as detector:
+            _, used, _ = _decode_bytes_with_fallback(self.TEXT.encode("utf-8"), self.ENCODINGS)
+        detector.assert_not_called()
+        self.assertEqual(used, "utf-8-sig")
+
+
+class CSVExtractionTests(unittest.TestCase):
+    def test_rows_are_chunked_without_rejoining(self):
+        from documents.services.document_ingestion import DocumentIngestionService
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "items.csv"
+            path.write_text("name,price\nりんご,100\nみかん, 80\nぶどう,300\n", encoding="utf-8")
+            content = CSVContentExtractor(rows_per_chunk_hint=2).extract_content(path)
+
+        self.assertEqual(content.rows, ["name=りんご / price=100", "name=みかん / price= 80", "name=ぶどう / price=300"])
+        self.assertEqual(content.full_text, "\n".join(content.rows))
+        meta = content.metadata
+        chunks = DocumentIngestionService._chunk_csv_lines(content.rows, meta)
+        self.assertEqual(chunks, DocumentIngestionService._chunk_csv(content.full_text, meta))
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(chunks[0].startswith("CSVヘッダ: name, price\n"))
+
+    def test_guess_delimiter(self):
+        self.assertEqual(_guess_csv_delimiter("氏名\t部署\n山田 太郎\t経理 部\n"), "\t")
+        self.assertEqual(_guess_csv_delimiter(" a , b ,c\n1 , x ,y\n"), ",")
+        self.assertEqual(_guess_csv_delimiter("a;b;c\n1;2;3\n"), ";")
+        self.assertEqual(_guess_csv_delimiter("単一列\n値\n"), ",")
+
+
+@unittest.skipIf(content_extractor.fitz is None, "PyMuPDF is not installed")
+class PDFParallelExtractionTests(unittest.TestCase):
+    """ページ範囲を複数プロセスに分けても、順次抽出と同じ結果（ページ順）になること"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = Path(cls.tmpdir.name) / "many_pages.pdf"
+        doc = content_extractor.fitz.open()
+        for i in range(PARALLEL_MIN_PAGES + 3):
+            page = doc.new_page()
+            page.insert_text((72, 72), f"page {i} body text")
+        doc.save(str(cls.path))
+        doc.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_clean_pdf_is_extracted_by_pymupdf_only(self):
+        extractor = PDFContentExtractor(num_workers=1)
+        with mock.patch.object(extractor, "_extract_with_pypdf2") as pypdf2:
+            content = extractor.extract_content(self.path)
+        pypdf2.assert_not_called()
+        self.assertEqual(content.metadata["engine"], "pymupdf")
+        self.assertNotIn("fallback", content.metadata)
+
+    def test_small_pdf_skips_the_second_engine(self):
+        path = Path(self.tmpdir.name) / "short.pdf"
+        doc = content_extractor.fitz.open()
+        doc.new_page().insert_text((72, 72), "short")
+        doc.save(str(path))
+        doc.close()
+
+        extractor = PDFContentExtractor(num_workers=1)
+        with mock.patch.object(extractor, "_extract_with_pypdf2") as pypdf2:
+            content = extractor.extract_content(path)
+        pypdf2.assert_not_called()
+        self.assertEqual(content.metadata["engine"], "pymupdf")
+        self.assertIn("low_text_volume", content.metadata["warnings"])
+
+        # しきい値を外せば従来どおり PyPDF2 でも抽出して比べる
+        content = PDFContentExtractor(num_workers=1, small_pdf_bytes=0).extract_content(path)
+        self.assertEqual(content.metadata["fallback"]["from"], "pymupdf")
+
+    def test_image_only_pdf_is_rejected_before_extraction(self):
+        path = Path(self.tmpdir.name) / "scan.pdf"
+        doc = content_extractor.fitz.open()
+        for i in range(12):
+            page = doc.new_page()
+            pixmap = content_extractor.fitz.Pixmap(content_extractor.fitz.csRGB, content_extractor.fitz.IRect(0, 0, 20, 20), 0)
+            pixmap.clear_with(i * 10)
+            page.insert_image(page.rect, pixmap=pixmap)
+        doc.save(str(path))
+        doc.close()
+
+        self.assertTrue(content_extractor._is_likely_scan_pdf(path))
+        self.assertFalse(content_extractor._is_likely_scan_pdf(self.path))
+
+        extractor = PDFContentExtractor(num_workers=1)
+        extractor.SCAN_PREFILTER_MIN_BYTES = 0
+        with mock.patch.object(extractor, "_extract_with_pymupdf") as pymupdf:
+            content = extractor.extract_content(path)
+        pymupdf.assert_not_called()
+        self.assertEqual(content.metadata["engine"], "scan_prefilter")
+        self.assertIn("image_pdf_suspected", content.metadata["warnings"])
+
+    def test_text_pdf_with_compressed_object_streams_is_not_rejected(self):
+        # フォント定義が圧縮されたオブジェクトストリームに入り、生バイトには "/Font" が現れないPDF
+        path = Path(self.tmpdir.name) / "objstm.pdf"
+        doc = content_extractor.fitz.open()
+        for i in range(15):
+            page = doc.new_page()
+            pixmap = content_extractor.fitz.Pixmap(content_extractor.fitz.csRGB, content_extractor.fitz.IRect(0, 0, 20, 20), 0)
+            pixmap.clear_with(i * 10)
+            page.insert_image(content_extractor.fitz.Rect(72, 100, 300, 300), pixmap=pixmap)
+            page.insert_text((72, 72), f"page {i} body text " * 5)
+        doc.save(str(path), garbage=3, deflate=True, use_objstms=1)
+        doc.close()
+        self.assertEqual(path.read_bytes().count(b"/Font"), 0)
+
+        self.assertFalse(content_extractor._is_likely_scan_pdf(path))
+        extractor = PDFContentExtractor(num_workers=1)
+        extractor.SCAN_PREFILTER_MIN_BYTES = 0
+        content = extractor.extract_content(path)
+        self.assertEqual(content.metadata["engine"], "pymupdf")
+        self.assertNotIn("no_text_extracted", content.metadata["warnings"])
+        self.assertIn("page 14 body text", content.pages[-1])
+
+    def test_parallel_matches_sequential(self):
+        sequential = PDFContentExtractor(num_workers=1)
+        parallel = PDFContentExtractor(num_workers=2)
+        try:
+            # PyMuPDF は順次の方が速いので、num_workers があってもプロセスプールを使わない
+            parallel._extract_with_pymupdf(self.path)
+            self.assertIsNone(parallel._pool)
+
+            expected = sequential._extract_with_pypdf2(self.path)
+            actual = parallel._extract_with_pypdf2(self.path)
+            self.assertEqual(actual.pages, expected.pages)
+            self.assertEqual(actual.full_text, expected.full_text)
+            self.assertEqual(actual.num_pages, PARALLEL_MIN_PAGES + 3)
+            self.assertIn(f"page {PARALLEL_MIN_PAGES + 2}", actual.pages[-1])
+            self.assertIsNotNone(parallel._pool)
+        finally:
+            if parallel._pool is not None:
+                parallel._pool.shutdown()
+
+    def test_parallel_extraction_is_off_by_default(self):
+        self.assertEqual(PDFContentExtractor().num_workers, 1)
+
+    def test_pymupdf_is_not_used_from_two_threads_at_once(self):
+        """全件再インデックスなどで複数スレッドから抽出しても、fitz は同時に1スレッドしか使わないこと"""
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        real_fitz = content_extractor.fitz
+        active = []
+        overlaps = []
+
+        class _TrackedDocument:
+            def __init__(self, path):
+                self._doc = real_fitz.open(path)
+
+            def __enter__(self):
+                active.append(threading.current_thread())
+                overlaps.append(len(active) > 1)
+                time.sleep(0.01)
+                return self._doc.__enter__()
+
+            def __exit__(self, *exc):
+                active.remove(threading.current_thread())
+                return self._doc.__exit__(*exc)
+
+        tracked_fitz = mock.Mock(open=_TrackedDocument)
+        extractor = PDFContentExtractor(num_workers=1)
+        with mock.patch.object(content_extractor, "fitz", tracked_fitz), ThreadPoolExecutor(max_workers=4) as pool:
+            contents = list(pool.map(lambda _: extractor.extract_content(self.path), range(4)))
+
+        self.assertEqual(len(overlaps), 4)
+        self.assertFalse(any(overlaps))
+        self.assertTrue(all(c.num_pages == PARALLEL_MIN_PAGES + 3 for c in contents))
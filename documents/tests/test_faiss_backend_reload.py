@@ -2,7 +2,10 @@ import hashlib
 import os
 import time
 from tempfile import TemporaryDirectory
+from unittest import mock
 
+import faiss
+import numpy as np
 from django.test import TestCase
 
 from documents.models import Document, Chunk, Department
@@ -21,11 +24,14 @@ class DummyEmbeddingService:
 
     def _vec(self, text: str) -> list[float]:
         h = hashlib.sha256(text.encode("utf-8")).digest()
-        # 0..255 を 0..1 にスケールして dim 個取り出す
-        return [h[i] / 255.0 for i in range(self.dim)]
+        # 0..255 を 0..1 にスケールして dim 個取り出す（1バイトずつの Python ループにしない）
+        return (np.frombuffer(h, dtype=np.uint8, count=self.dim) * np.float32(1.0 / 255.0)).tolist()
 
-    def embed_chunks(self, texts: list[str]) -> list[list[float]]:
-        return [self._vec(t) for t in texts]
+    def embed_chunks(self, texts: list[str]) -> np.ndarray:
+        # ダイジェストを1つのバッファに連結し、(n, 32) として先頭 dim 列をまとめて変換する
+        buf = b"".join(hashlib.sha256(t.encode("utf-8")).digest() for t in texts)
+        digests = np.frombuffer(buf, dtype=np.uint8).reshape(-1, 32)
+        return np.ascontiguousarray(digests[:, : self.dim], dtype=np.float32) * np.float32(1.0 / 255.0)
 
     def embed_text(self, text: str) -> list[float]:
         return self._vec(text)
@@ -131,3 +137,270 @@ class FaissSearchBackendReloadTests(TestCase):
             r = backend_a.search(q, top_k=3, filters=None)
             # データ自体は消えているので DB一致を求めない（ここでは“破壊しない”が目的）
             self.assertIsInstance(r, list)
+
+    def test_hnsw_index_handles_delete_and_reindex_without_remove_ids(self):
+        """
+        HNSW(remove_ids非対応)でも、削除は墓標で除外され、再登録しても結果が重複しないこと。
+        無効エントリが増えたら詰め直されること。
+        """
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            c1 = Chunk.objects.create(document=self.doc, chunk_index=0, page=0, content="VPN接続方法の手順")
+            c2 = Chunk.objects.create(document=self.doc, chunk_index=1, page=0, content="有給休暇の申請手順")
+
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="hnsw")
+            backend.index_chunks([c1.id, c2.id])
+            backend.index_chunks([c1.id])  # 再登録（旧エントリが残る）
+
+            results = backend.search(emb.embed_text("VPN接続方法の手順"), top_k=5, filters=None)
+            self.assertEqual(sorted(r.chunk.id for r in results), sorted([c1.id, c2.id]))
+
+            backend.delete_chunks([c2.id])
+            results = backend.search(emb.embed_text("有給休暇の申請手順"), top_k=5, filters=None)
+            self.assertEqual([r.chunk.id for r in results], [c1.id])
+            # 無効エントリ(再登録1 + 削除1)が閾値を超えたので詰め直されている
+            self.assertEqual(backend.index.ntotal, 1)
+
+    def test_hnsw_tombstones_are_shared_with_other_instances(self):
+        """墓標と無効エントリ数は index の隣に保存され、別インスタンス（別ワーカー相当）でも効くこと"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunks = Chunk.objects.bulk_create(
+                Chunk(document=self.doc, chunk_index=i, page=0, content=f"社内規程 {i}") for i in range(10)
+            )
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="hnsw")
+            backend.index_chunks([c.id for c in chunks])
+
+            target = chunks[3]
+            # 無効エントリ 1 件は詰め直しの閾値未満なので、墓標のまま残る
+            backend.delete_chunks([target.id])
+            self.assertEqual(backend.index.ntotal, 10)
+
+            reader = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            self.assertEqual((reader._tombstones, reader._stale_entries), ({target.id}, 1))
+            # 墓標を除けば対応表が index を網羅しているので、部門フィルタは IDSelector で掛かる
+            self.assertTrue(reader._departments_cover_index())
+            results = reader.search(emb.embed_text(target.content), top_k=10, filters={"department_code": "it"})
+            self.assertNotIn(target.id, [r.chunk.id for r in results])
+            self.assertEqual(len(results), 9)
+
+    def test_department_filter_follows_document_department_change(self):
+        """文書の部門を変えたら、対応表の付け替え前でも旧部門の検索に出ず、保存後は新部門で検索できること"""
+        from django.test import override_settings
+        from documents.services import document_service
+
+        emb = DummyEmbeddingService(dim=8)
+        hr = Department.objects.create(code="hr", name="人事")
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunk = Chunk.objects.create(document=self.doc, chunk_index=0, page=0, content="VPN接続方法の手順")
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            backend.index_chunks([chunk.id])
+            query = emb.embed_text(chunk.content)
+
+            # signal を通らない更新: 対応表は古いままだが、DB上の部門で除外される
+            Document.objects.filter(id=self.doc.id).update(department=hr)
+            self.assertEqual(backend.search(query, top_k=5, filters={"department_code": "it"}), [])
+
+            # 管理画面と同じく save() すると、コミット後に対応表が付け替わる
+            self.doc.department = hr
+            with override_settings(FAISS_INDEX_PATH=index_path), \
+                    mock.patch.object(document_service, "_get_faiss_backend", return_value=backend), \
+                    self.captureOnCommitCallbacks(execute=True):
+                self.doc.save()
+            self.assertEqual(backend._chunk_departments, {chunk.id: hr.id})
+
+            reader = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            results = reader.search(query, top_k=5, filters={"department_code": "hr"})
+            self.assertEqual([r.chunk.id for r in results], [chunk.id])
+
+    def test_unfiltered_search_does_not_prefetch_the_widest_k(self):
+        """部門指定なしの検索は search_k 件だけ取り、上限(top_k*50)まで先取りしないこと"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunks = Chunk.objects.bulk_create(
+                Chunk(document=self.doc, chunk_index=i, page=0, content=f"社内規程 {i}") for i in range(60)
+            )
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="hnsw")
+            backend.index_chunks([c.id for c in chunks])
+
+            with mock.patch.object(backend, "_run_index_search", wraps=backend._run_index_search) as run:
+                results = backend.search(emb.embed_text(chunks[0].content), top_k=1, filters=None)
+            self.assertEqual([r.chunk.id for r in results], [chunks[0].id])
+            self.assertEqual([c.args[1] for c in run.call_args_list], [5])
+
+    def test_stored_embeddings_are_indexed_without_embedding_again(self):
+        """Chunk.embedding が保存されている行は埋め込みAPIを呼ばず、保存されていない行だけ埋め込むこと"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            stored = Chunk.objects.create(
+                document=self.doc, chunk_index=0, page=0, content="VPN接続方法の手順",
+                embedding=emb.embed_text("VPN接続方法の手順"),
+            )
+            missing = Chunk.objects.create(document=self.doc, chunk_index=1, page=0, content="有給休暇の申請手順")
+
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            with mock.patch.object(emb, "embed_chunks", wraps=emb.embed_chunks) as embed_chunks:
+                backend.index_chunks([stored.id, missing.id])
+                backend.rebuild_index()
+            self.assertEqual([c.args[0] for c in embed_chunks.call_args_list], [[missing.content]] * 2)
+
+            results = backend.search(emb.embed_text(stored.content), top_k=1, filters=None)
+            self.assertEqual([r.chunk.id for r in results], [stored.id])
+
+    def test_ivfpq_index_is_trained_on_rebuild(self):
+        """
+        ivfpq は rebuild_index で学習した IVF-PQ になり、削除・部門フィルタ・別インスタンスからの読み込みが動くこと
+        """
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunks = Chunk.objects.bulk_create(
+                Chunk(document=self.doc, chunk_index=i, page=0, content=f"社内規程 {i}") for i in range(300)
+            )
+
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="ivfpq")
+            # 学習前は flat で動く
+            self.assertIsNone(backend._ivf_base())
+            # テストでは PQ の分割数を減らして学習時間を短くする
+            with mock.patch.object(FaissSearchBackend, "PQ_M", 2):
+                backend.rebuild_index()
+            self.assertIsNotNone(backend._ivf_base())
+            self.assertEqual(backend.index.ntotal, 300)
+
+            target = chunks[10]
+            results = backend.search(emb.embed_text(target.content), top_k=1, filters={"department_code": "it"})
+            self.assertEqual([r.chunk.id for r in results], [target.id])
+
+            backend.delete_chunks([target.id])
+            results = backend.search(emb.embed_text(target.content), top_k=5, filters=None)
+            self.assertNotIn(target.id, [r.chunk.id for r in results])
+
+            reader = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            self.assertIsNotNone(reader._ivf_base())
+            self.assertEqual(len(reader.search(emb.embed_text(chunks[0].content), top_k=3, filters=None)), 3)
+
+    def test_ivf_index_stays_flat_until_threshold(self):
+        """ivf は件数が閾値未満なら flat のまま、超えたら rebuild_index で IVF-Flat を学習すること"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunks = Chunk.objects.bulk_create(
+                Chunk(document=self.doc, chunk_index=i, page=0, content=f"社内規程 {i}") for i in range(300)
+            )
+
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="ivf")
+            backend.rebuild_index()
+            self.assertIsNone(backend._ivf_base())
+            self.assertFalse(backend.needs_rebuild())
+
+            # テストでは閾値とセルあたりの学習件数を下げて、小さいデータで学習させる
+            with mock.patch.object(FaissSearchBackend, "IVF_FLAT_MIN_VECTORS", 100), \
+                    mock.patch.object(FaissSearchBackend, "IVF_MIN_POINTS_PER_LIST", 4):
+                self.assertTrue(backend.needs_rebuild())
+                backend.rebuild_index()
+            ivf = backend._ivf_base()
+            self.assertIsNotNone(ivf)
+            self.assertEqual((ivf.nlist, ivf.nprobe), (69, 8))
+
+            # 検索時も学習時に決めた nprobe が使われる（IVF_NPROBE で上書きしない）
+            params = []
+            make_params = faiss.SearchParametersIVF
+
+            def recording_params():
+                params.append(make_params())
+                return params[-1]
+
+            target = chunks[10]
+            with mock.patch.object(faiss, "SearchParametersIVF", recording_params):
+                results = backend.search(emb.embed_text(target.content), top_k=1, filters=None)
+            self.assertEqual([r.chunk.id for r in results], [target.id])
+            self.assertEqual([p.nprobe for p in params], [8])
+
+    def test_sq8_index_is_trained_on_rebuild(self):
+        """sq8 は rebuild_index で学習した int8 の SQ index になり、差分更新・削除もできること"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunks = Chunk.objects.bulk_create(
+                Chunk(document=self.doc, chunk_index=i, page=0, content=f"社内規程 {i}") for i in range(50)
+            )
+
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="sq8")
+            self.assertFalse(backend._is_trained_as_configured())
+            backend.rebuild_index()
+            self.assertTrue(backend._is_trained_as_configured())
+            self.assertFalse(backend.needs_rebuild())
+
+            target = chunks[10]
+            results = backend.search(emb.embed_text(target.content), top_k=1, filters=None)
+            self.assertEqual([r.chunk.id for r in results], [target.id])
+
+            added = Chunk.objects.create(document=self.doc, chunk_index=50, page=0, content="追加の規程")
+            backend.index_chunks([added.id])
+            backend.delete_chunks([target.id])
+            self.assertEqual(backend.index.ntotal, 50)
+            results = backend.search(emb.embed_text(added.content), top_k=1, filters=None)
+            self.assertEqual([r.chunk.id for r in results], [added.id])
+
+    def test_rebuild_failure_keeps_existing_index(self):
+        """埋め込みが途中で失敗しても、追加用スレッドを止めて例外を返し、既存indexを上書きしないこと"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            Chunk.objects.create(document=self.doc, chunk_index=0, page=0, content="VPN接続方法の手順")
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            backend.rebuild_index()
+
+            with mock.patch.object(emb, "embed_chunks", side_effect=RuntimeError("embedding api down")):
+                with self.assertRaises(RuntimeError):
+                    backend.rebuild_index()
+
+            self.assertEqual(backend.index.ntotal, 1)
+            self.assertEqual(FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8).index.ntotal, 1)
+
+    def test_rebuild_keeps_result_when_update_runs_during_save(self):
+        """rebuild の書き出し中に同じインスタンスで差分更新が走っても、作り直した index が残ること"""
+        emb = DummyEmbeddingService(dim=8)
+
+        with TemporaryDirectory() as td:
+            index_path = os.path.join(td, "chunks.index")
+            chunks = Chunk.objects.bulk_create(
+                Chunk(document=self.doc, chunk_index=i, page=0, content=f"社内規程 {i}") for i in range(50)
+            )
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8, index_type="sq8")
+            backend.index_chunks([chunks[0].id])
+
+            write_index_tmp = backend._write_index_tmp
+            interleaved = []
+
+            def write_then_update(*args, **kwargs):
+                tmp_paths = write_index_tmp(*args, **kwargs)
+                if not interleaved:
+                    # 一時ファイルを書き終えてから swap するまでの間に、別スレッドの index_chunks が来た状況
+                    interleaved.append(True)
+                    backend.index_chunks([chunks[1].id])
+                return tmp_paths
+
+            with mock.patch.object(backend, "_write_index_tmp", side_effect=write_then_update):
+                backend.rebuild_index()
+
+            self.assertTrue(backend._is_trained_as_configured())
+            self.assertEqual(backend.index.ntotal, 50)
+            reader = FaissSearchBackend(index_path=index_path, embedding_service=emb, dimension=8)
+            self.assertTrue(reader._is_trained_as_configured())
+            self.assertEqual(reader.index.ntotal, 50)
+            self.assertEqual(len(reader._chunk_departments), 50)
@@ -0,0 +1,65 @@
+# python manage.py test documents.tests.test_pgvector_backend
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from documents.models import Chunk, Department, Document
+from documents.search_backends.pgvector_backend import PgVectorSearchBackend
+
+User = get_user_model()
+
+
+class PgVectorSearchBackendTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username="pgv", password="pass12345")
+        dep_fin = Department.objects.create(name="経理", code="finance")
+        dep_hr = Department.objects.create(name="人事総務", code="hr")
+        doc_fin = Document.objects.create(title="経理規程", file_path="dummy/fin.pdf", department=dep_fin, uploaded_by=user)
+        doc_hr = Document.objects.create(title="人事規程", file_path="dummy/hr.pdf", department=dep_hr, uploaded_by=user)
+        cls.chunk_fin = Chunk.objects.create(document=doc_fin, content="経費精算", chunk_index=0, embedding=[1.0, 0.0, 0.0])
+        cls.chunk_hr = Chunk.objects.create(document=doc_hr, content="有給休暇", chunk_index=0, embedding=[0.9, 0.1, 0.0])
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'vector'")
+            if cursor.fetchone() is None:
+                self.skipTest("pgvector extension is not installed")
+
+    def test_search_orders_by_similarity(self):
+        results = PgVectorSearchBackend(dimension=3).search([1.0, 0.0, 0.0], top_k=2)
+        self.assertEqual([r.chunk.id for r in results], [self.chunk_fin.id, self.chunk_hr.id])
+        self.assertAlmostEqual(results[0].score, 1.0, places=5)
+
+    def test_search_filters_by_department_code(self):
+        results = PgVectorSearchBackend(dimension=3).search(
+            [1.0, 0.0, 0.0], top_k=2, filters={"department_code": "hr"}
+        )
+        self.assertEqual([r.chunk.id for r in results], [self.chunk_hr.id])
+        self.assertEqual(results[0].chunk.document.department.code, "hr")
+
+    def test_short_department_result_widens_then_searches_exactly(self):
+        """部門で絞って top_k 件に満たなければ、候補を広げ、最後は索引を使わず厳密に検索すること"""
+        from unittest import mock
+
+        backend = PgVectorSearchBackend(dimension=3)
+        with mock.patch.object(backend, "_nearest_rows", wraps=backend._nearest_rows) as nearest:
+            results = backend.search([1.0, 0.0, 0.0], top_k=2, filters={"department_code": "hr"})
+        self.assertEqual([r.chunk.id for r in results], [self.chunk_hr.id])
+        self.assertEqual(
+            [c.kwargs for c in nearest.call_args_list],
+            [{"ef_search": 200}, {"ef_search": 1000}, {"exact": True}],
+        )
+
+    def test_unfiltered_short_result_is_not_retried(self):
+        from unittest import mock
+
+        backend = PgVectorSearchBackend(dimension=3)
+        with mock.patch.object(backend, "_nearest_rows", wraps=backend._nearest_rows) as nearest:
+            backend.search([1.0, 0.0, 0.0], top_k=5)
+        self.assertEqual(nearest.call_count, 1)
+
+    def test_rebuild_without_hnsw_index_is_skipped(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX IF EXISTS chunk_embedding_hnsw")
+        PgVectorSearchBackend().rebuild_index()
@@ -1,12 +1,15 @@
 # documents/tests.py
 from __future__ import annotations
 
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from tempfile import TemporaryDirectory
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 import numpy as np
 
 from django.contrib.auth import get_user_model
+from django.urls import reverse
 from documents.models import Department, Document, Chunk
 from documents.search_backends.faiss_backend import FaissSearchBackend
 
@@ -83,6 +86,80 @@ class FaissSearchBackendDepartmentFilterTests(TestCase):
             self.assertGreaterEqual(len(fin_results), 1)
             self.assertTrue(all(r.chunk.document.department.code == "finance" for r in fin_results))
 
+    def test_scope_searches_for_same_query_reuse_candidate_rows(self):
+        """
+        同じクエリで部門スコープだけ変えた検索は、DBに問い合わせずに絞り込むこと
+        """
+        with TemporaryDirectory() as d:
+            backend = FaissSearchBackend(index_path=Path(d) / "index.faiss", dimension=3)
+            vectors = np.array([[0.8, 0.0, 0.0], [1.0, 0.0, 0.0]], dtype="float32")
+            ids = np.array([self.chunk_fin.id, self.chunk_hr.id], dtype="int64")
+            backend.index.add_with_ids(vectors, ids)
+
+            query = [1.0, 0.0, 0.0]
+            backend.search(query_embedding=query, top_k=2, filters={"department_code": "hr"})
+            with self.assertNumQueries(0):
+                fin_results = backend.search(query_embedding=query, top_k=2, filters={"department_code": "finance"})
+            self.assertEqual([r.chunk.id for r in fin_results], [self.chunk_fin.id])
+
+    def test_indexed_chunks_are_filtered_by_department_inside_faiss(self):
+        """
+        index_chunks で登録した分は部門の対応表が保存され、FAISS 側で部門を絞って検索できること
+        """
+        class FixedEmbeddingService:
+            # hr=1.0, finance=0.8 のスコアになるベクトルを返す
+            vectors = {"経費精算のルール": [0.8, 0.6, 0.0], "有給休暇のルール": [1.0, 0.0, 0.0]}
+
+            def embed_chunks(self, texts):
+                return [self.vectors[t] for t in texts]
+
+        with TemporaryDirectory() as d:
+            index_path = Path(d) / "index.faiss"
+            backend = FaissSearchBackend(index_path=index_path, embedding_service=FixedEmbeddingService(), dimension=3)
+            backend.index_chunks([self.chunk_fin.id, self.chunk_hr.id])
+
+            # 別インスタンスでも保存された対応表で絞り込める
+            reader = FaissSearchBackend(index_path=index_path, dimension=3)
+            self.assertEqual(
+                reader._chunk_departments,
+                {self.chunk_fin.id: self.dep_fin.id, self.chunk_hr.id: self.dep_hr.id},
+            )
+            reader.search(query_embedding=[0.0, 0.0, 1.0], top_k=1, filters={"department_code": "finance"})
+
+            # 他部門のChunkは取得せず、返す1件分だけをDBから読む
+            with self.assertNumQueries(1):
+                fin_results = reader.search(
+                    query_embedding=[1.0, 0.0, 0.0], top_k=1, filters={"department_code": "finance"}
+                )
+            self.assertEqual([r.chunk.id for r in fin_results], [self.chunk_fin.id])
+
+    def test_asearch_matches_search(self):
+        """asearch は search と同じ結果を返すこと（部門フィルタあり/なし、対応表なしの経路）"""
+        from asgiref.sync import async_to_sync
+
+        class FixedEmbeddingService:
+            vectors = {"経費精算のルール": [0.8, 0.6, 0.0], "有給休暇のルール": [1.0, 0.0, 0.0]}
+
+            def embed_chunks(self, texts):
+                return [self.vectors[t] for t in texts]
+
+        with TemporaryDirectory() as d:
+            backend = FaissSearchBackend(
+                index_path=Path(d) / "index.faiss", embedding_service=FixedEmbeddingService(), dimension=3
+            )
+            backend.index_chunks([self.chunk_fin.id, self.chunk_hr.id])
+            query = [1.0, 0.0, 0.0]
+
+            for filters in (None, {"department_code": "finance"}, {"department_code": "unknown"}):
+                expected = [(r.chunk.id, r.score) for r in backend.search(query, top_k=2, filters=filters)]
+                actual = [(r.chunk.id, r.score) for r in async_to_sync(backend.asearch)(query, top_k=2, filters=filters)]
+                self.assertEqual(actual, expected)
+
+            # 対応表にないIDが index にある場合は search() の経路で絞り込む
+            backend.index.add_with_ids(np.array([[0.9, 0.0, 0.0]], dtype="float32"), np.array([999999], dtype="int64"))
+            results = async_to_sync(backend.asearch)(query, top_k=2, filters={"department_code": "finance"})
+            self.assertEqual([r.chunk.id for r in results], [self.chunk_fin.id])
+
     def test_search_expands_candidates_until_it_finds_filtered_hits(self):
         """
         上位が他部門で埋まっても、search_kを増やしてフィルタ部門を拾えること
@@ -147,6 +224,21 @@ class FaissBackendMoreTests(TestCase):
             page=1,
         )
 
+    def test_needs_rebuild_until_first_rebuild(self):
+        """rebuild の記録がなければ作り直し、記録後の flat index は差分更新で足りる"""
+        class FixedEmbeddingService:
+            def embed_chunks(self, texts):
+                return [[1.0, 0.0, 0.0] for _ in texts]
+
+        with TemporaryDirectory() as d:
+            backend = FaissSearchBackend(
+                index_path=Path(d) / "index.faiss", embedding_service=FixedEmbeddingService(), dimension=3
+            )
+            self.assertTrue(backend.needs_rebuild())
+            backend.rebuild_index()
+            self.assertEqual(backend._read_meta_file(), {"ntotal": 1, "avg_list_size": None})
+            self.assertFalse(backend.needs_rebuild())
+
     def test_search_returns_empty_when_index_empty(self):
         """インデックス空なら常に[]"""
         with TemporaryDirectory() as d:
@@ -190,4 +282,358 @@ class FaissBackendMoreTests(TestCase):
             backend.index.add_with_ids(vecs, np.array(extra_ids, dtype="int64"))
 
             res = backend.search(query_embedding=[1.0, 0.0, 0.0], top_k=3, filters={"department_code": "hr"})
-            self.assertLessEqual(len(res), 3)
\ No newline at end of file
+            self.assertLessEqual(len(res), 3)
+
+class SearchCoalescerTests(SimpleTestCase):
+    def test_concurrent_queries_share_one_index_search(self):
+        """同時に来たクエリは1回の検索にまとめられ、各呼び出しには自分の行が返ること"""
+        import threading
+        from documents.search_backends.faiss_backend import _SearchCoalescer
+
+        calls = []
+
+        def search_fn(xq, k):
+            calls.append(xq.shape[0])
+            # 行ごとに「クエリの先頭値」をスコアにして返す
+            return np.repeat(xq[:, :1], k, axis=1), np.zeros((xq.shape[0], k), dtype="int64")
+
+        coalescer = _SearchCoalescer(search_fn, max_wait=0.2)
+        barrier = threading.Barrier(4)
+        results = {}
+
+        def worker(i):
+            barrier.wait()
+            results[i] = coalescer.search(np.array([[float(i), 0.0]], dtype="float32"), 2)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertLess(len(calls), 4)
+        for i in range(4):
+            self.assertEqual(results[i][0].tolist(), [[float(i), float(i)]])
+
+class RWLockTests(SimpleTestCase):
+    def test_readers_share_and_writer_waits_for_them(self):
+        """読み取り同士は同時に入れ、書き込みは読み取りが抜けるまで待つこと"""
+        import threading
+        from documents.search_backends.faiss_backend import _RWLock
+
+        lock = _RWLock()
+        both_reading = threading.Barrier(2, timeout=5)
+        events = []
+
+        def reader(name):
+            with lock.read_locked():
+                both_reading.wait()  # 2本目が入れなければタイムアウトする
+                events.append(name)
+
+        def writer():
+            with lock.write_locked():
+                events.append("writer")
+
+        readers = [threading.Thread(target=reader, args=(f"r{i}",)) for i in range(2)]
+        with lock.read_locked():
+            for t in readers:
+                t.start()
+            w = threading.Thread(target=writer)
+            w.start()
+            w.join(timeout=0.2)
+            self.assertTrue(w.is_alive())  # 読み取り中は書き込めない
+        for t in readers:
+            t.join()
+        w.join()
+        self.assertEqual(events[-1], "writer")
+
+
+class DocumentIngestionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dep = Department.objects.create(name="経理", code="finance")
+        cls.user = User.objects.create_user(username="ingest", password="pass12345")
+
+    def _service(self, embed_documents):
+        from documents.services.embedding_service import EmbeddingService
+
+        # OpenAI クライアントを作らずに、バッチ分割・並行埋め込みの経路はそのまま通す
+        service = EmbeddingService.__new__(EmbeddingService)
+        service.EMBED_BATCH_SIZE = 2
+        service.embeddings = SimpleNamespace(embed_documents=embed_documents)
+        return service
+
+    def test_chunks_are_saved_in_order_across_embedding_batches(self):
+        from documents.services import document_ingestion
+
+        lines = [f"{i}行目の規程本文です。" * 30 for i in range(5)]
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            Path(media, "rules.txt").write_text("\n\n".join(lines), encoding="utf-8")
+            doc = Document.objects.create(title="規程", file_path="rules.txt", department=self.dep, uploaded_by=self.user)
+            service = self._service(lambda texts: [[float(len(t)), 0.0, 0.0] for t in texts])
+            with mock.patch.object(document_ingestion, "_embedding_service", service):
+                result = document_ingestion.DocumentIngestionService.ingest_document(doc)
+
+        chunks = list(doc.chunks.order_by("chunk_index"))
+        self.assertGreater(result.chunk_count, service.EMBED_BATCH_SIZE)
+        self.assertEqual([c.chunk_index for c in chunks], list(range(result.chunk_count)))
+        self.assertEqual(result.chunk_ids, [c.id for c in chunks])
+        self.assertTrue(all(c.embedding == [float(len(c.content)), 0.0, 0.0] for c in chunks))
+
+    def test_embedding_batches_in_flight_are_bounded(self):
+        import threading
+
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+        consumed = []
+
+        def embed_documents(texts):
+            with lock:
+                state["running"] += 1
+                # まだ取り出されていないバッチ数（実行中+完了済み）の最大値
+                state["peak"] = max(state["peak"], state["running"] - len(consumed))
+            return [[float(t)] for t in texts]
+
+        service = self._service(embed_documents)
+        service.MAX_BATCHES_IN_FLIGHT = 3
+        texts = [str(i) for i in range(21)]
+        vectors = []
+        for batch in service.iter_embed_chunks(texts):
+            consumed.append(batch)
+            vectors.extend(batch)
+
+        self.assertEqual(vectors, [[float(i)] for i in range(21)])
+        # 投げてあるバッチ + 呼び出し側が処理中の1バッチ
+        self.assertLessEqual(state["peak"], 3 + 1)
+
+    def test_embed_chunks_fills_one_float32_array_in_order(self):
+        service = self._service(lambda texts: [[float(t), 1.0] for t in texts])
+        vectors = service.embed_chunks([str(i) for i in range(5)])
+
+        self.assertEqual((vectors.dtype, vectors.shape), (np.float32, (5, 2)))
+        self.assertEqual(vectors[:, 0].tolist(), [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(service.embed_chunks([]).shape[0], 0)
+
+    def test_repeated_and_known_texts_are_not_embedded_again(self):
+        calls = []
+
+        def embed_documents(texts):
+            calls.append(list(texts))
+            return [[float(t), 0.5] for t in texts]
+
+        service = self._service(embed_documents)
+        texts = ["1", "2", "1", "3", "2"]
+        self.assertEqual(
+            [v for batch in service.iter_embed_chunks(texts) for v in batch],
+            [[float(t), 0.5] for t in texts],
+        )
+        self.assertEqual(sorted(t for batch in calls for t in batch), ["1", "2", "3"])
+
+        # 保存済みの埋め込みを渡した本文は API に送らない
+        calls.clear()
+        known = {"3": [3.0, 0.5], "1": [1.0, 0.5]}
+        self.assertEqual(
+            [v for batch in service.iter_embed_chunks(["3", "4", "1"], known=known) for v in batch],
+            [[3.0, 0.5], [4.0, 0.5], [1.0, 0.5]],
+        )
+        self.assertEqual(calls, [["4"]])
+
+    def test_reingest_reuses_stored_embeddings_for_unchanged_chunks(self):
+        from documents.services import document_ingestion
+
+        calls = []
+
+        def embed_documents(texts):
+            calls.extend(texts)
+            return [[float(len(t)), 0.0, 0.0] for t in texts]
+
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            path = Path(media, "rules.txt")
+            path.write_text("VPNの申請手順です。", encoding="utf-8")
+            doc = Document.objects.create(title="規程", file_path="rules.txt", department=self.dep, uploaded_by=self.user)
+            with mock.patch.object(document_ingestion, "_embedding_service", self._service(embed_documents)):
+                document_ingestion.DocumentIngestionService.ingest_document(doc)
+                path.write_text("VPNの申請手順です。\n\n" + "有給休暇の申請手順です。" * 30, encoding="utf-8")
+                calls.clear()
+                result = document_ingestion.DocumentIngestionService.ingest_document(doc)
+
+        self.assertGreater(result.chunk_count, 1)
+        # 本文が変わっていないチャンクは API に送らない
+        self.assertNotIn("VPNの申請手順です。", calls)
+        self.assertEqual(len(calls), result.chunk_count - 1)
+
+    def test_failed_embedding_batch_leaves_no_chunks(self):
+        from documents.services import document_ingestion
+
+        def embed_documents(texts):
+            if "4行目" in texts[-1]:
+                raise RuntimeError("embedding api down")
+            return [[1.0, 0.0, 0.0] for _ in texts]
+
+        lines = [f"{i}行目の規程本文です。" * 30 for i in range(5)]
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            Path(media, "rules.txt").write_text("\n\n".join(lines), encoding="utf-8")
+            doc = Document.objects.create(title="規程", file_path="rules.txt", department=self.dep, uploaded_by=self.user)
+            with mock.patch.object(document_ingestion, "_embedding_service", self._service(embed_documents)):
+                with self.assertRaises(RuntimeError):
+                    document_ingestion.DocumentIngestionService.ingest_document(doc)
+
+        self.assertFalse(doc.chunks.exists())
+
+    def test_batch_upload_indexes_once_and_skips_failed_files(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from documents.models import AuditLog
+        from documents.services import document_ingestion, document_service
+
+        files = [
+            SimpleUploadedFile("a.txt", ("経費精算の規程です。" * 40).encode("utf-8")),
+            SimpleUploadedFile("unsupported.xyz", b"binary"),
+            SimpleUploadedFile("b.txt", ("有給休暇の規程です。" * 40).encode("utf-8")),
+        ]
+        service = self._service(lambda texts: [[1.0, 0.0, 0.0] for _ in texts])
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media), \
+                mock.patch.object(document_ingestion, "_embedding_service", service), \
+                mock.patch.object(document_service, "_get_faiss_backend") as get_backend:
+            docs = document_service.upload_documents_batch(actor=self.user, uploaded_files=files, department=self.dep)
+
+        self.assertEqual([d.title for d in docs], ["a.txt", "b.txt"])
+        self.assertFalse(Document.objects.filter(title="unsupported.xyz").exists())
+        get_backend.return_value.index_chunks.assert_called_once_with(
+            list(Chunk.objects.filter(document__in=docs).order_by("id").values_list("id", flat=True))
+        )
+        statuses = sorted(AuditLog.objects.filter(action=AuditLog.Action.UPLOAD).values_list("status", flat=True))
+        self.assertEqual(statuses, [AuditLog.Status.FAILED, AuditLog.Status.SUCCESS, AuditLog.Status.SUCCESS])
+
+    def test_delete_document_removes_chunks_from_faiss(self):
+        from documents.models import AuditLog
+        from documents.services import document_service
+
+        doc = Document.objects.create(title="a", file_path="", department=self.dep, uploaded_by=self.user)
+        other = Document.objects.create(title="b", file_path="", department=self.dep, uploaded_by=self.user)
+        ids = [Chunk.objects.create(document=doc, content=str(i), chunk_index=i).id for i in range(3)]
+        kept = Chunk.objects.create(document=other, content="残る", chunk_index=0)
+
+        with mock.patch.object(document_service, "_get_faiss_backend") as get_backend:
+            document_service.delete_document(actor=self.user, document=doc)
+
+        self.assertEqual(sorted(get_backend.return_value.delete_chunks.call_args.args[0]), ids)
+        self.assertFalse(Document.objects.filter(id=doc.id).exists())
+        self.assertEqual(list(Chunk.objects.values_list("id", flat=True)), [kept.id])
+        self.assertTrue(AuditLog.objects.filter(action=AuditLog.Action.DELETE, status=AuditLog.Status.SUCCESS).exists())
+
+    def test_async_upload_defers_ingest_until_commit(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from documents import tasks
+        from documents.models import AuditLog
+        from documents.services import document_ingestion, document_service
+
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, DOCUMENT_INGEST_ASYNC=True):
+            upload = SimpleUploadedFile("rules.txt", ("経費精算の規程です。" * 40).encode("utf-8"))
+            with mock.patch.object(tasks._ingest_executor, "submit") as submit, \
+                    self.captureOnCommitCallbacks(execute=True):
+                doc = document_service.upload_document(actor=self.user, uploaded_file=upload, department=self.dep)
+                # コミットまではワーカーに渡さない
+                submit.assert_not_called()
+            submit.assert_called_once_with(tasks.ingest_and_index, doc.id, self.user.id)
+            self.assertFalse(doc.chunks.exists())
+
+            service = self._service(lambda texts: [[1.0, 0.0, 0.0] for _ in texts])
+            with mock.patch.object(document_ingestion, "_embedding_service", service), \
+                    mock.patch.object(document_service, "_get_faiss_backend") as get_backend, \
+                    mock.patch.object(tasks.connection, "close"):
+                tasks.ingest_and_index(doc.id, self.user.id)
+
+        get_backend.return_value.index_chunks.assert_called_once_with(list(doc.chunks.order_by("id").values_list("id", flat=True)))
+        log = AuditLog.objects.get(document=doc)
+        self.assertEqual((log.action, log.status, log.actor_id), (AuditLog.Action.UPLOAD, AuditLog.Status.SUCCESS, self.user.id))
+
+    def test_reindex_all_replaces_chunks_and_reports_failures(self):
+        from documents.services import document_ingestion, document_service
+
+        # ワーカースレッドの別接続からはテストのトランザクション内のデータが見えないので逐次で通す
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, REINDEX_CONCURRENCY=1):
+            Path(media, "a.txt").write_text("経費精算の規程です。" * 40, encoding="utf-8")
+            ok = Document.objects.create(title="a", file_path="a.txt", department=self.dep, uploaded_by=self.user)
+            missing = Document.objects.create(title="b", file_path="missing.txt", department=self.dep, uploaded_by=self.user)
+            stale = Chunk.objects.create(document=ok, content="古い", chunk_index=0, embedding=[0.0, 0.0, 0.0])
+            kept = Chunk.objects.create(document=missing, content="残る", chunk_index=0, embedding=[0.0, 0.0, 0.0])
+
+            service = self._service(lambda texts: [[1.0, 0.0, 0.0] for _ in texts])
+            with mock.patch.object(document_ingestion, "_embedding_service", service), \
+                    mock.patch.object(document_service, "_get_faiss_backend") as get_backend:
+                meta = document_service.reindex_all_documents(actor=self.user)
+
+        get_backend.return_value.rebuild_index.assert_called_once_with()
+        self.assertEqual((meta["total_documents"], meta["success_documents"], meta["failed_documents"]), (2, 1, 1))
+        self.assertEqual(meta["failures"][0]["document_id"], missing.id)
+        self.assertFalse(Chunk.objects.filter(id=stale.id).exists())
+        self.assertTrue(ok.chunks.exists())
+        # 取り込みに失敗した文書の既存チャンクは残す
+        self.assertEqual(list(missing.chunks.values_list("id", flat=True)), [kept.id])
+
+    def test_reindex_all_updates_faiss_incrementally(self):
+        from documents.services import document_ingestion, document_service
+
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, REINDEX_CONCURRENCY=1):
+            Path(media, "a.txt").write_text("経費精算の規程です。" * 40, encoding="utf-8")
+            doc = Document.objects.create(title="a", file_path="a.txt", department=self.dep, uploaded_by=self.user)
+            stale = Chunk.objects.create(document=doc, content="古い", chunk_index=0, embedding=[0.0, 0.0, 0.0])
+
+            service = self._service(lambda texts: [[1.0, 0.0, 0.0] for _ in texts])
+            with mock.patch.object(document_ingestion, "_embedding_service", service), \
+                    mock.patch.object(document_service, "_get_faiss_backend") as get_backend:
+                get_backend.return_value.needs_rebuild.return_value = False
+                document_service.reindex_all_documents(actor=self.user)
+
+        backend = get_backend.return_value
+        backend.rebuild_index.assert_not_called()
+        backend.index_chunks.assert_called_once_with(list(doc.chunks.order_by("id").values_list("id", flat=True)))
+        backend.delete_chunks.assert_called_once_with([stale.id])
+
+
+class DashboardViewTests(TestCase):
+    def test_upload_history_is_paginated(self):
+        from documents import views
+
+        dep = Department.objects.create(name="経理", code="finance")
+        admin = User.objects.create_superuser(username="admin", password="pass12345", department=dep)
+        for i in range(3):
+            Document.objects.create(title=f"doc{i}.pdf", file_path=f"doc{i}.pdf", department=dep, uploaded_by=admin)
+
+        self.client.force_login(admin)
+        with mock.patch.object(views, "UPLOAD_HISTORY_PER_PAGE", 2):
+            res = self.client.get(reverse("documents:dashboard"), {"page": 2})
+
+        self.assertEqual(res.status_code, 200)
+        page = res.context["upload_list"]
+        self.assertEqual((page.number, page.paginator.num_pages), (2, 2))
+        self.assertEqual([d.title for d in page], ["doc0.pdf"])
+        self.assertContains(res, "admin")
+
+
+class ParallelReindexTests(TransactionTestCase):
+    def test_reindex_all_in_worker_threads(self):
+        from documents.services import document_ingestion, document_service
+        from documents.services.embedding_service import EmbeddingService
+
+        dep = Department.objects.create(name="総務", code="general")
+        user = User.objects.create_user(username="reindex", password="pass12345")
+        service = EmbeddingService.__new__(EmbeddingService)
+        service.embeddings = SimpleNamespace(embed_documents=lambda texts: [[1.0, 0.0, 0.0] for _ in texts])
+
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, REINDEX_CONCURRENCY=2):
+            docs = []
+            for i in range(5):
+                Path(media, f"{i}.txt").write_text(f"{i}番目の規程です。" * 40, encoding="utf-8")
+                docs.append(Document.objects.create(title=str(i), file_path=f"{i}.txt", department=dep, uploaded_by=user))
+            missing = Document.objects.create(title="x", file_path="missing.txt", department=dep, uploaded_by=user)
+            stale = Chunk.objects.create(document=docs[0], content="古い", chunk_index=0, embedding=[0.0, 0.0, 0.0])
+
+            with mock.patch.object(document_ingestion, "_embedding_service", service), \
+                    mock.patch.object(document_service, "_get_faiss_backend"):
+                meta = document_service.reindex_all_documents(actor=user)
+
+        self.assertEqual((meta["success_documents"], meta["failed_documents"]), (5, 1))
+        self.assertEqual([f["document_id"] for f in meta["failures"]], [missing.id])
+        self.assertFalse(Chunk.objects.filter(id=stale.id).exists())
+        self.assertTrue(all(d.chunks.exists() for d in docs))
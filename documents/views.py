@@ -1,4 +1,6 @@
 from django.shortcuts import render,redirect,get_object_or_404
+from django.conf import settings
+from django.core.paginator import Paginator
 from .models import Document,Department
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
@@ -6,9 +8,14 @@ from django.http import HttpResponseForbidden
 from django.views.decorators.http import require_POST
 from .forms import DocumentUploadForm
 from accounts.services.permissions import can_delete_document
-from documents.services.document_service import upload_document
+from documents.services.document_service import upload_documents_batch
 from documents.services.document_service import delete_document as delete_service
 from documents.services.document_service import reindex_all_documents
+
+# アップロード履歴の1ページあたりの件数
+UPLOAD_HISTORY_PER_PAGE = 50
+
+
 # ログイン済みユーザのみこのメソッドを通す
 @login_required
 def dashboard(request):
@@ -22,15 +29,14 @@ def dashboard(request):
             else:
                 dept = request.user.department
 
-            success, failed = 0, 0
-            for f in files:
-                try:
-                    upload_document(actor=request.user, uploaded_file=f, department=dept)
-                    success += 1
-                except Exception:
-                    failed += 1
+            # 取り込みはファイルごと、FAISS 登録と監査ログはまとめて行う
+            documents = upload_documents_batch(actor=request.user, uploaded_files=files, department=dept)
+            success = len(documents)
+            failed = len(files) - success
 
-            if success and failed == 0:
+            if success and failed == 0 and settings.DOCUMENT_INGEST_ASYNC:
+                messages.success(request, f"ドキュメントをアップロードしました。取り込みはバックグラウンドで行います。（{success}件）")
+            elif success and failed == 0:
                 messages.success(request, f"ドキュメントをアップロードしました。（{success}件）")
             elif success and failed:
                 messages.warning(request, f"一部失敗しました。（成功:{success}件 / 失敗:{failed}件）")
@@ -43,25 +49,25 @@ def dashboard(request):
 
     department_list = Department.objects.all().order_by("id")
 
+    # 一覧で表示する列だけを読む（部門・アップロード者は表示しないので JOIN もしない）
     my_dept_list = (
         Document.objects.filter(department=request.user.department)
-        .select_related("department", "uploaded_by")
+        .only("id", "title", "num_page", "created_at")
         .order_by("-created_at")
     )
 
     # 第2セクション用(superuserのみ表示)
     if request.user.is_superuser:
-        upload_list = (
-            Document.objects.all()
-            .select_related("department", "uploaded_by")
-            .order_by("-created_at")
-        )
+        upload_qs = Document.objects.all()
     else:
-        upload_list = (
-            Document.objects.filter(department=request.user.department)
-            .select_related("department", "uploaded_by")
-            .order_by("-created_at")
-        )
+        upload_qs = Document.objects.filter(department=request.user.department)
+    upload_qs = (
+        upload_qs.select_related("department", "uploaded_by")
+        .only("id", "title", "created_at", "department__name", "uploaded_by__username")
+        .order_by("-created_at")
+    )
+    # 全部門の履歴は件数が増え続けるので、全件を読まずにページ単位で表示する
+    upload_list = Paginator(upload_qs, UPLOAD_HISTORY_PER_PAGE).get_page(request.GET.get("page"))
 
     return render(
         request,